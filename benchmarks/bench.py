@@ -0,0 +1,379 @@
+#!/usr/bin/python3
+#
+# bench.py - benchmarks of port-utils on synthetic Port system trees
+# Copyright (C) 2021 Michail Krasnov
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Usage:
+# bench.py [--sizes 1000,10000] [--repeat 5] [--output results.json]
+#          [--compare old.json] [--keep DIR]
+#
+# All files (the Port system, index, database, logs) are created in the
+# temporary directory, the system files aren't changed.
+#
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import py_compile
+import statistics
+import contextlib
+import subprocess
+import importlib.util
+
+import gen_tree
+
+BENCH_DIR   = os.path.dirname(os.path.abspath(__file__))
+PORT_UTILS  = os.path.join(BENCH_DIR, "..", "src", "port-utils.py")
+
+SAMPLE_PORTS = 200 # Порты для `info_port`, `plan`, `add_in_db`/`remove_from_db`
+
+STARTUP_RUNS   = 20    # Число запусков `port-utils --info`
+STARTUP_TARGET = 0.05  # Время запуска `--info`, которое не должно превышаться (секунды)
+
+# Модули, которые не должны импортироваться при `--info`
+HEAVY_MODULES = ["shutil", "tarfile", "subprocess", "hashlib", "ctypes", "concurrent.futures",
+                 "difflib", "gzip", "http.client", "urllib.parse", "ssl", "email"]
+
+# Запуск port-utils в отдельном процессе (как через `launcher.py`): модуль
+# загружается из скомпилированного байт-кода, пути берутся из `argv[1]`
+STARTUP_CODE = """
+import sys, json, importlib.util
+spec = importlib.util.spec_from_file_location("port_utils", sys.argv[1])
+pu = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(pu)
+for name, value in json.loads(sys.argv[2]).items():
+    setattr(pu, name, value)
+pu.main(sys.argv[3:])
+"""
+
+def load(path=PORT_UTILS):
+    """
+    Function for importing port-utils as the module
+    """
+
+    spec = importlib.util.spec_from_file_location("port_utils", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+def redirect(pu, work_dir):
+    """
+    Function for moving all files of port-utils into `work_dir`
+    """
+
+    pu.LOGDIR           = work_dir + "/log"
+    pu.LOGFILE          = pu.LOGDIR + "/port-utils.log"
+    pu.DBG_LOGFILE      = pu.LOGDIR + "/port-utils-dbg.log"
+    pu.BUILD_LOGDIR     = pu.LOGDIR + "/port-utils-build"
+    pu.PORTDIR          = work_dir + "/usr/ports"
+    pu.FILES_DIR        = work_dir + "/usr/share/ports"
+    pu.PORT_INDEX       = pu.FILES_DIR + "/index.db"
+    pu.PORT_MANIFEST    = pu.FILES_DIR + "/ports-files.json"
+    pu.METADATA         = pu.FILES_DIR + "/metadata.json"
+    pu.METADATA_HISTORY = pu.FILES_DIR + "/metadata-history.json"
+    pu.INITIAL_CONF     = pu.FILES_DIR + "/initial-conf.json"
+    pu.CACHE            = work_dir + "/var/cache/ports"
+    pu.DATABASE         = work_dir + "/var/db/ports/ports.db"
+    pu.SETTINGS         = work_dir + "/etc/port-utils.json"
+    pu.database_lock_file = work_dir + "/var/lock/port-utils.lock"
+
+    for directory in pu.LOGDIR, pu.FILES_DIR, pu.CACHE:
+        os.makedirs(directory, exist_ok=True)
+
+    if pu.ports_db.conn is not None:
+        pu.ports_db.conn.close()
+        pu.ports_db.conn = None
+
+    pu.deps_resolver.cache.clear()
+
+def measure(func, repeat, ops=1, setup=None):
+    """
+    Function for running `func` `repeat` times
+
+    `setup` is called before every run and isn't measured. Returns the
+    times of the runs and their statistics.
+    """
+
+    times = []
+
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            if setup is not None:
+                setup()
+
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+
+    return {
+        "ops": ops,
+        "times": times,
+        "min": min(times),
+        "median": statistics.median(times),
+        "per_op": statistics.median(times) / ops
+    }
+
+def bench_size(pu, size, repeat, work_dir):
+    """
+    Function for running all benchmarks on the tree with `size` ports
+    """
+
+    results = {}
+    tree_dir = work_dir + "/tree"
+    redirect(pu, work_dir)
+
+    start = time.perf_counter()
+    ports = gen_tree.generate(tree_dir, size)
+    generate_time = time.perf_counter() - start
+
+    rng = random.Random(size)
+    sample = rng.sample(ports, min(SAMPLE_PORTS, len(ports)))
+
+    # Распаковка и установка Port system
+    unpack_dir = work_dir + "/unpack"
+    results["unpack_file"] = measure(
+        lambda: pu.update_ports.unpack_file(tree_dir + "/ports.txz", unpack_dir),
+        repeat, setup=lambda: shutil.rmtree(unpack_dir, ignore_errors=True)
+    )
+
+    results["install_file"] = measure(
+        lambda: pu.update_ports.install_file(unpack_dir + "/ports", pu.PORTDIR),
+        repeat
+    )
+
+    results["index_build"] = measure(pu.port_index.build, repeat)
+
+    # Информация о портах
+    def info():
+        for port in sample:
+            pu.info_ports.info_port(pu.info_ports.get_config(port))
+
+    results["info_port"] = measure(info, repeat, len(sample))
+
+    # Разрешение зависимостей (каждый раз без кэша)
+    def plan():
+        for port in sample:
+            pu.deps_resolver.cache.clear()
+            pu.deps_resolver.plan([port], installed=set())
+
+    results["deps_plan"] = measure(plan, repeat, len(sample))
+
+    # База данных установленных портов
+    configs = [(port, pu.info_ports.get_config(port)) for port in sample]
+
+    def port_files(config):
+        # 10 файлов на порт в формате `(path, size, mode, sha256, mtime)`
+        return [("/usr/share/{0}/file{1}".format(config["name"], i), 1024, 0o100644, "0" * 64, 0.0)
+                for i in range(10)]
+
+    files = {port: port_files(config) for port, config in configs}
+
+    def add():
+        for port, config in configs:
+            pu.build_ports.add_in_db(port, config, files[port])
+
+    def remove():
+        for port, config in configs:
+            pu.remove_ports.remove_from_db(port, pu.PORTDIR + "/" + port + "/config.json")
+
+    def clean_db():
+        for name in os.listdir(os.path.dirname(pu.DATABASE)):
+            os.remove(os.path.dirname(pu.DATABASE) + "/" + name)
+        pu.ports_db.conn = None
+
+    os.makedirs(os.path.dirname(pu.DATABASE), exist_ok=True)
+    results["add_in_db"] = measure(add, repeat, len(configs), setup=clean_db)
+    results["remove_from_db"] = measure(remove, repeat, len(configs), setup=lambda: (clean_db(), add()))
+
+    # Поиск и обратные зависимости
+    with contextlib.redirect_stdout(io.StringIO()):
+        add()
+    installed = (set(config["name"] for port, config in configs), set(sample))
+    words = ["library", "tool net", "lib1", "python bindings"]
+
+    results["search"] = measure(lambda: [pu.port_index.search(word) for word in words], repeat, len(words))
+    results["rdeps"] = measure(
+        lambda: [pu.port_index.rdeps(port, installed) for port in ports[:20]],
+        repeat, min(20, len(ports))
+    )
+
+    results["startup_info"] = bench_startup(pu, sample[0])
+
+    results["generate"] = {"ops": 1, "times": [generate_time], "min": generate_time,
+                           "median": generate_time, "per_op": generate_time}
+
+    return results
+
+def import_times(stderr):
+    """
+    Function for parsing the `-X importtime` output
+
+    Returns the dict `{module: cumulative time (seconds)}` of the top-level
+    imports.
+    """
+
+    modules = {}
+
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+
+        # Вложенные импорты сдвинуты на два пробела на каждый уровень
+        name = fields[2][1:].rstrip()
+        if not name.startswith(" "):
+            modules[name] = int(fields[1]) / 1000000
+
+    return modules
+
+def bench_startup(pu, port, runs=STARTUP_RUNS, target=STARTUP_TARGET):
+    """
+    Function for measuring the startup time of `port-utils --info`
+
+    The program is compiled beforehand, like by `make install`. Returns
+    the times of the runs, the time of the bare interpreter start and
+    the top-level imports (from `-X importtime`).
+    """
+
+    py_compile.compile(PORT_UTILS, doraise=True)
+
+    paths = {name: getattr(pu, name) for name in (
+        "LOGDIR", "LOGFILE", "DBG_LOGFILE", "BUILD_LOGDIR", "PORTDIR", "FILES_DIR", "PORT_INDEX",
+        "PORT_MANIFEST", "METADATA", "CACHE", "DATABASE", "SETTINGS", "database_lock_file"
+    )}
+    command = [sys.executable, "-c", STARTUP_CODE, PORT_UTILS, json.dumps(paths), "--info", port]
+
+    def run(cmd):
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            times.append(time.perf_counter() - start)
+        return times
+
+    interpreter = run([sys.executable, "-c", "pass"])
+    times = run(command)
+
+    stderr = subprocess.run([sys.executable, "-X", "importtime"] + command[1:], stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True, check=True).stderr
+    imports = import_times(stderr)
+
+    return {
+        "ops": 1,
+        "times": times,
+        "min": min(times),
+        "median": statistics.median(times),
+        "per_op": statistics.median(times),
+        "interpreter": min(interpreter),
+        "target": target,
+        "ok": min(times) < target,
+        "heavy_imports": [module for module in HEAVY_MODULES if module in imports],
+        "top_imports": sorted(imports.items(), key=lambda item: item[1], reverse=True)[:10]
+    }
+
+def compare(results, old_file):
+    """
+    Function for printing the difference with the previous results
+    """
+
+    with open(old_file) as f:
+        old = json.load(f)
+
+    print("\n{0:>8} {1:<16} {2:>12} {3:>12} {4:>8}".format("ports", "benchmark", "old, s", "new, s", "ratio"))
+
+    for size, benches in results["sizes"].items():
+        for name, result in benches.items():
+            try:
+                old_time = old["sizes"][size][name]["median"]
+            except KeyError:
+                continue
+
+            print("{0:>8} {1:<16} {2:>12.4f} {3:>12.4f} {4:>7.2f}x".format(
+                size, name, old_time, result["median"], result["median"] / old_time if old_time else 0
+            ))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of port-utils")
+    parser.add_argument("--sizes", type=str, default="1000,10000", help="numbers of ports (e.g. 1000,10000,50000)")
+    parser.add_argument("--repeat", "-r", type=int, default=5, help="number of runs of every benchmark")
+    parser.add_argument("--output", "-o", type=str, default="bench-results.json", help="results file")
+    parser.add_argument("--compare", "-c", type=str, help="previous results file")
+    parser.add_argument("--keep", type=str, help="don't remove the work directory (created in KEEP)")
+    parser.add_argument("--check", action="store_true",
+                        help="exit with code 1 if the startup time of --info exceeds the target")
+    args = parser.parse_args()
+
+    pu = load()
+
+    results = {
+        "meta": {
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "fts5": pu.port_index.has_fts(sqlite3.connect(":memory:")),
+            "version": pu.NAME_VERSION,
+            "repeat": args.repeat
+        },
+        "sizes": {}
+    }
+
+    for size in [int(size) for size in args.sizes.split(",")]:
+        print("{} ports...".format(size), end=" ", flush=True)
+
+        if args.keep:
+            work_dir = os.path.join(args.keep, str(size))
+            shutil.rmtree(work_dir, ignore_errors=True)
+            os.makedirs(work_dir)
+            results["sizes"][str(size)] = bench_size(pu, size, args.repeat, work_dir)
+        else:
+            with tempfile.TemporaryDirectory(prefix="port-utils-bench.") as work_dir:
+                results["sizes"][str(size)] = bench_size(pu, size, args.repeat, work_dir)
+
+        print("done")
+
+        for name, result in results["sizes"][str(size)].items():
+            print("  {0:<16} median {1:10.4f} s  min {2:10.4f} s  per op {3:10.6f} s".format(
+                name, result["median"], result["min"], result["per_op"]
+            ))
+
+        startup = results["sizes"][str(size)]["startup_info"]
+        print("  --info startup: {0:.1f} ms (interpreter: {1:.1f} ms, target: {2:.0f} ms) - {3}".format(
+            startup["min"] * 1000, startup["interpreter"] * 1000, startup["target"] * 1000,
+            "OK" if startup["ok"] else "SLOW"
+        ))
+        if startup["heavy_imports"]:
+            print("  Modules imported by --info: {}".format(", ".join(startup["heavy_imports"])))
+
+    pu.logger.flush()
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+
+    print("Results: {}".format(args.output))
+
+    if args.compare:
+        compare(results, args.compare)
+
+    if args.check and not all(benches["startup_info"]["ok"] for benches in results["sizes"].values()):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
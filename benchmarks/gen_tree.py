@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+#
+# gen_tree.py - generator of synthetic Port system trees for benchmarks
+# Copyright (C) 2021 Michail Krasnov
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Usage:
+# gen_tree.py --ports 10000 --out /tmp/ports-10k [--seed 1] [--no-txz]
+#
+# Creates OUT/ports/<category>/<group>/<name>/{config.json,install,remove}
+# and OUT/ports.txz (the same tree as the Port system package).
+#
+
+import os
+import sys
+import json
+import random
+import tarfile
+import argparse
+
+CATEGORIES = {
+    "base": ["libs", "devel", "shells", "editors", "net", "system", "archive"],
+    "extra": ["libs", "devel", "multimedia", "net", "games", "docs", "python"],
+    "xorg": ["libs", "drivers", "fonts", "apps", "wm"]
+}
+
+WORDS = [
+    "library", "tool", "text", "editor", "terminal", "network", "graphics",
+    "audio", "video", "compiler", "shell", "font", "python", "perl", "ruby",
+    "parser", "compression", "archive", "daemon", "server", "client",
+    "bindings", "utilities", "framework", "driver", "protocol", "image"
+]
+
+MAINTAINERS = ["Linuxoid85", "Sergey", "Anna", "cov_id111", "Ivan"]
+
+INSTALL_SCRIPT = "#!/bin/sh\n# Synthetic port: nothing to build\nexit 0\n"
+REMOVE_SCRIPT = "#!/bin/sh\nexit 0\n"
+
+def port_config(name, version, deps):
+    """
+    Returns `config.json` of the synthetic port
+    """
+
+    return {
+        "name": name,
+        "version": version,
+        "description": " ".join(random.sample(WORDS, 3)),
+        "maintainer": random.choice(MAINTAINERS),
+        "priority": "system" if random.random() < 0.02 else "user",
+        "release": "1.1",
+        "sources": [{
+            "url": "https://example.org/{0}/{0}-{1}.tar.xz".format(name, version),
+            "sha256": "{:064x}".format(random.getrandbits(256))
+        }],
+        "deps": deps,
+        "bins": [],
+        "libs": [],
+        "dirs": []
+    }
+
+def generate(out_dir, count, seed=1, txz=True):
+    """
+    Function for generating the tree
+
+    Dependencies point only to the previously generated ports, so the
+    dependency graph has no cycles. Like in a real tree, most ports depend
+    on a few popular libraries and a few ports from the same group.
+
+    Returns the list of the generated ports (e.g. `base/libs/lib12`).
+    """
+
+    random.seed(seed)
+
+    ports_dir = out_dir + "/ports"
+    groups = [(category, group) for category in CATEGORIES for group in CATEGORIES[category]]
+    ports = []
+
+    for index in range(count):
+        category, group = random.choice(groups)
+        name = "{0}{1}".format(group.rstrip("s") if group.endswith("s") else group, index)
+        port = "{0}/{1}/{2}".format(category, group, name)
+
+        deps = {
+            "required": [], "runtime": [], "optional": [],
+            "recommend": [], "before": [], "conflict": []
+        }
+
+        if ports:
+            # Популярные библиотеки (первые порты дерева) и случайные порты
+            popular = ports[:max(1, len(ports) // 100)]
+            candidates = random.sample(popular, min(len(popular), random.randint(0, 2)))
+            candidates += random.sample(ports, min(len(ports), random.randint(0, 4)))
+
+            for dep in dict.fromkeys(candidates):
+                kind = random.random()
+                if kind < 0.6:
+                    deps["required"].append(dep)
+                elif kind < 0.85:
+                    deps["runtime"].append(dep)
+                else:
+                    deps["optional"].append(dep)
+
+        port_dir = ports_dir + "/" + port
+        os.makedirs(port_dir, exist_ok=True)
+
+        version = "{0}.{1}.{2}".format(random.randint(0, 9), random.randint(0, 30), random.randint(0, 9))
+        with open(port_dir + "/config.json", "w") as f:
+            json.dump(port_config(name, version, deps), f, indent=4)
+
+        for script, content in ("install", INSTALL_SCRIPT), ("remove", REMOVE_SCRIPT):
+            with open(port_dir + "/" + script, "w") as f:
+                f.write(content)
+            os.chmod(port_dir + "/" + script, 0o755)
+
+        ports.append(port)
+
+    if txz:
+        with tarfile.open(out_dir + "/ports.txz", "w:xz", preset=1) as tar:
+            tar.add(ports_dir, "ports")
+
+    return ports
+
+def main():
+    parser = argparse.ArgumentParser(description="Generator of synthetic Port system trees")
+    parser.add_argument("--ports", "-n", type=int, default=1000, help="number of ports")
+    parser.add_argument("--out", "-o", type=str, required=True, help="output directory")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    parser.add_argument("--no-txz", action="store_true", help="don't create ports.txz")
+    args = parser.parse_args()
+
+    if os.path.exists(args.out + "/ports"):
+        print("{}/ports already exists".format(args.out))
+        sys.exit(1)
+
+    ports = generate(args.out, args.ports, args.seed, not args.no_txz)
+    print("Generated {0} ports in {1}".format(len(ports), args.out))
+
+if __name__ == "__main__":
+    main()
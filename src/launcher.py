@@ -0,0 +1,22 @@
+#!/usr/bin/python3
+#
+# port-utils - Port system software (launcher)
+# Copyright (C) 2021 Michail Krasnov
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# The program is installed as the module (/usr/lib/port-utils/port_utils.py)
+# and started by this script, so Python uses the compiled byte code of the
+# module instead of compiling the whole program at every start.
+#
+
+import sys
+
+sys.path.insert(0, "/usr/lib/port-utils")
+
+from port_utils import main
+
+main()
@@ -214,9 +214,9 @@ class build_ports():
         f = open(port_config)
         data = json.load(f)
 
-        register = [(
+        register = (
             data["name"], data["version"], data["maintainer"], data["release"], add_time
-        )] # Запись, которая отправится в БД
+        ) # Запись, которая отправится в БД
 
         try:
             cursor.execute("INSERT INTO ports VALUES (?,?,?,?,?)", register)
@@ -269,10 +269,8 @@ class build_ports():
         conn = sqlite3.connect(DB)
         cursor = conn.cursor()
 
-        command = "DELETE from ports WHERE name = '" + name + "'"
-
         try:
-            cursor.execute(command)
+            cursor.execute("DELETE from ports WHERE name = ?", (name,))
             conn.commit()
         except:
             print(_("Error while removing package '{}' from database!").format(name))
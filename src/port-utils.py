@@ -24,18 +24,61 @@
 import os
 import sys
 import argparse
-import shutil
-import tarfile
-import wget
 import json
-import subprocess
 import sqlite3
+import atexit
+import io
+import collections
+import re
+import fcntl
+import errno
+import contextlib
 import gettext
+import importlib
+import threading
+import time
 from datetime import datetime
 
+class lazy_module(object):
+    """
+    Module which is imported at the first use of its attribute.
+
+    The modules needed only by some commands (downloading, building,
+    unpacking) are imported lazily, so the read-only commands (`--info`,
+    `--list`, ...) start faster. After the import the global name is
+    replaced by the module itself.
+
+    Usage:
+    `http = lazy_module("http.client")` - `http.client.HTTPConnection`
+    imports `http.client`.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        importlib.import_module(self.name)
+
+        module = sys.modules[self.name.split(".")[0]]
+        globals()[module.__name__] = module
+
+        return getattr(module, attr)
+
+shutil     = lazy_module("shutil")
+tarfile    = lazy_module("tarfile")
+subprocess = lazy_module("subprocess")
+hashlib    = lazy_module("hashlib")
+ctypes     = lazy_module("ctypes")
+heapq      = lazy_module("heapq")
+concurrent = lazy_module("concurrent.futures")
+difflib    = lazy_module("difflib")
+gzip       = lazy_module("gzip")
+http       = lazy_module("http.client")
+urllib     = lazy_module("urllib.parse")
+
 gettext.bindtextdomain('port-utils', '/usr/share/locale')
 gettext.textdomain('port-utils')
-_ = gettext.gettext
+_ = gettext.translation('port-utils', '/usr/share/locale', fallback=True).gettext # Каталог ищется один раз
 
 ## ABOUT PROGRAM ##
 PROGRAM_RELEASE = "beta build 1"
@@ -43,7 +86,8 @@ NAME_VERSION = "port-utils v1.0b1 DEV " + PROGRAM_RELEASE # Name + version
 
 ## BASE CONSTANTS ##
 LOGDIR         = "/var/log"                   # Log directory
-LOGFILE        = LOGDIR + "port-utils.log"    # Log file
+LOGFILE        = LOGDIR + "/port-utils.log"   # Log file
+DBG_LOGFILE    = LOGDIR + "/port-utils-dbg.log" # Debug messages log file
 PORTDIR        = "/usr/ports"                 # Port system directory
 FILES_DIR      = "/usr/share/ports"           # Files directory
 DOCDIR         = "/usr/share/doc/Calmira"     # Documentation dorectory
@@ -59,6 +103,15 @@ SETTINGS       = "/etc/port-utils.json"       # Program settings
 INITIAL_CONF   = FILES_DIR + "/initial-conf.json"
 CALM_RELEASE   = "/etc/calm-release"          # Calmira release info
 DATABASE       = "/var/db/ports/ports.db"     # Port system database
+BUILD_LOGDIR   = LOGDIR + "/port-utils-build" # Build logs of ports
+PORT_INDEX     = FILES_DIR + "/index.db"      # Index of all ports in the Port system
+PORT_MANIFEST  = FILES_DIR + "/ports-files.json" # Hashes of the installed Port system files
+METADATA_CACHE = CACHE + "/metadata.json"     # Downloaded metadata
+METADATA_HISTORY = FILES_DIR + "/metadata-history.json" # Changes of the seen Port system updates
+DOWNLOAD_CACHE = CACHE + "/downloads.json"    # Validators (ETag, Last-Modified, hash) of the downloaded files
+VERIFY_CACHE   = CACHE + "/verify.json"       # Stat data of the verified installed files
+PACKAGE_CACHE  = CACHE + "/packages"          # Binary packages of the built ports
+DISTFILES      = CACHE + "/distfiles"         # Downloaded sources of ports
 
 ## BASE MESSAGES ##
 OK_MSG   = _("[   ok   ]")
@@ -77,53 +130,157 @@ user_var_dir       = "~/.local/var"
 user_log_dir       = user_var_dir + "/log"
 user_cache_dir     = user_var_dir + "/cache/ports"
 
-# Checking in import
-if __name__ != "__main__":
-    print(_("The executable Port program must not be imported!"))
-    sys.exit(1)
-
 ## COMMAND LINE PARSING ##
-if sys.argv[1] == "-h" and sys.argv[2] == "usage":
-    import random
-    message_list = ["Windows - must die, GNU/Linux - forever!", "CalmiraLinux LX4 will be released 11/15/2021",
-    "Чтобы россияне могли как следует подготовиться к выборам 2018 года, в магазинах теперь будет продаваться только одна марка водки, а в аптеках - только один вид презервативов.",
-    "Девушкам на заметку: Если вы зимой опаздываете на свидание, то вас может ожидать холодный конец!"]
-    print(random.choice(message_list))
-    exit(255)
+class help_formatter(argparse.HelpFormatter):
+    """
+    Help formatter which gets the terminal width once.
+
+    `argparse` creates the formatter for every added argument, and the
+    default one asks the terminal size (and imports `shutil`) each time.
+    """
+
+    width = None
+
+    def __init__(self, prog):
+        if help_formatter.width is None:
+            try:
+                columns = int(os.environ.get("COLUMNS") or os.get_terminal_size(sys.__stdout__.fileno()).columns)
+            except (ValueError, OSError, AttributeError):
+                columns = 80
+
+            help_formatter.width = columns - 2
+
+        super().__init__(prog, width=help_formatter.width)
+
+def positive_int(value):
+    """
+    Type of the arguments which must be positive integers (e.g. `--jobs`)
+    """
+
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+
+    if number < 1:
+        raise argparse.ArgumentTypeError(_("must be a positive integer: '{}'").format(value))
+
+    return number
+
+def parse_args(argv=None):
+    """
+    Function for parsing the command line arguments
+
+    Usage:
+    `parse_args(argv)` (`sys.argv[1:]` by default)
+    """
+
+    if (sys.argv[1:] if argv is None else argv)[:2] == ["-h", "usage"]:
+        import random
+        message_list = ["Windows - must die, GNU/Linux - forever!", "CalmiraLinux LX4 will be released 11/15/2021",
+        "Чтобы россияне могли как следует подготовиться к выборам 2018 года, в магазинах теперь будет продаваться только одна марка водки, а в аптеках - только один вид презервативов.",
+        "Девушкам на заметку: Если вы зимой опаздываете на свидание, то вас может ожидать холодный конец!"]
+        print(random.choice(message_list))
+        exit(255)
 
-parser = argparse.ArgumentParser(description=_("port-utils - Port system software"),
-                                 epilog=_("Good luck ;)"))
+    parser = argparse.ArgumentParser(description=_("port-utils - Port system software"),
+                                     epilog=_("Good luck ;)"), formatter_class=help_formatter)
 
-# Install or update Port system
-parser.add_argument("--update", "-u",
-                    choices=["stable", "testing"],
-                    type=str, help=_("Install or update Port system"))
+    # Install or update Port system
+    parser.add_argument("--update", "-u",
+                        choices=["stable", "testing"],
+                        type=str, help=_("Install or update Port system"))
 
-# Install port package
-parser.add_argument("--install", "-i", type=str,
-                    help=_("Download, build and install port package"))
+    # Don't unpack the Port system package while downloading
+    parser.add_argument("--no-stream", help=_("Download the Port system package to the cache before unpacking it (with --update)"),
+                        action="store_true")
 
-# Remove port
-parser.add_argument("--remove", "-r", type=str,
-                    help=_("Remove port package from system"))
+    # Reinstall the whole Port system
+    parser.add_argument("--full", help=_("Reinstall the whole Port system instead of installing only the changed ports (with --update); hash all files (with --verify)"),
+                        action="store_true")
 
-# Show info about port package
-parser.add_argument("--info", "-I", type=str,
-                    help=_("Show information about port package"))
+    # Install port packages
+    parser.add_argument("--install", "-i", type=str, nargs="+", metavar="PORT",
+                        help=_("Download, build and install port packages (- - read the ports from stdin, @FILE - from the file)"))
 
-# Update the port-utils metadata
-parser.add_argument("--metadata", type=str,
-                    choices=["stable", "testing"], help=_("Update the port-utils metadata files"))
+    # Don't install the port dependencies
+    parser.add_argument("--no-deps", help=_("Don't build and install the port dependencies (with --install)"),
+                        action="store_true")
 
-# Clean the CalmiraLinux
-parser.add_argument("--clean", "-c", type=str,
-                    choices=["cache", "log", "src", "all"],
-                    help=_("Cleaning the CalmiraLinux system from old ports (and other) files"))
+    # Use the binary packages cache
+    parser.add_argument("--binpkg", help=_("Install ports from the binary packages cache and save the built ports in it (with --install)"),
+                        action="store_true")
 
-# About port-utils
-parser.add_argument("--about", "-a", help=_("About program"), action="store_true")
+    # Download the sources only
+    parser.add_argument("--fetch-only", help=_("Download the sources of the port and its dependencies without building (with --install)"),
+                        action="store_true")
 
-args = parser.parse_args()
+    # Number of parallel builds
+    parser.add_argument("--jobs", "-j", type=positive_int,
+                        help=_("Number of ports (and make jobs) built at the same time (with --install)"))
+
+    # Rebuild the changed ports
+    parser.add_argument("--upgrade", "-U", type=str, metavar="PORT",
+                        help=_("Rebuild the installed port (or all installed ports) if its files or dependencies are changed (with --full, rebuild it anyway)"))
+
+    # Remove ports
+    parser.add_argument("--remove", "-r", type=str, nargs="+", metavar="PORT",
+                        help=_("Remove port packages from system (- - read the ports from stdin, @FILE - from the file)"))
+
+    # Show info about port packages
+    parser.add_argument("--info", "-I", type=str, nargs="+", metavar="PORT",
+                        help=_("Show information about port packages (- - read the ports from stdin, @FILE - from the file)"))
+
+    # List all ports
+    parser.add_argument("--list", "-l", help=_("Show list of ports in the Port system"),
+                        action="store_true")
+
+    # Search ports
+    parser.add_argument("--search", "-s", type=str, metavar="QUERY",
+                        help=_("Search ports by the name, description and maintainer"))
+
+    # Show the installed ports which depend on the port
+    parser.add_argument("--rdeps", type=str, metavar="PORT",
+                        help=_("Show the installed ports which depend on the port"))
+
+    # Show the port which installed the file
+    parser.add_argument("--owner", "-o", type=str, metavar="PATH",
+                        help=_("Show the installed port which declares the file (in bins, libs or dirs of its config)"))
+
+    # Verify the installed files of the port
+    parser.add_argument("--verify", "-V", type=str, nargs="?", const="all", metavar="PORT",
+                        help=_("Check the declared files of the installed port (or of all ports) against the database (with --full, hash all files)"))
+
+    # Lock timeout
+    parser.add_argument("--wait", type=int, metavar="SECONDS",
+                        help=_("Time to wait for another instance of the program"))
+
+    # Another database of the installed ports
+    parser.add_argument("--db", type=str, metavar="PATH",
+                        help=_("Use another database of the installed ports"))
+
+    # Update the port-utils metadata
+    parser.add_argument("--metadata", type=str,
+                        choices=["stable", "testing"], help=_("Update the port-utils metadata files"))
+
+    # Clean the CalmiraLinux
+    parser.add_argument("--clean", "-c", type=str,
+                        choices=["cache", "log", "src", "all"],
+                        help=_("Cleaning the CalmiraLinux system from old ports (and other) files"))
+
+    # Timings of the program phases
+    parser.add_argument("--timings", type=str, nargs="?", const="text",
+                        choices=["text", "json"],
+                        help=_("Print the time spent in each phase of the update, build and removal to stderr"))
+
+    # Profiling
+    parser.add_argument("--profile", type=str, metavar="FILE",
+                        help=_("Save the cProfile statistics of the whole run to FILE"))
+
+    # About port-utils
+    parser.add_argument("--about", "-a", help=_("About program"), action="store_true")
+
+    return parser.parse_args(argv)
 
 ####################
 ##                ##
@@ -141,12 +298,12 @@ def about_msg():
     print(_("\n(C) Michail Krasnov <linuxoid85@gmail.com>"))
 
 # Logging
-def log_msg(message, status):
+def log_msg(message, status, phase=None, port=None):
     """
     Function for write messages in log file
 
     Usage:
-    `log_msg(message, status)`
+    `log_msg(message, status, phase, port)`
 
     Statuses:
     - 'ok',
@@ -154,53 +311,18 @@ def log_msg(message, status):
     - 'error',
     - 'fail',
     - 'emerge'
+
+    `phase` (e.g. 'update', 'build') and `port` are optional.
     """
-    log_message = message + " [ " + status + " ]\n" # Формирование сообщения, которое отправится в лог
-    gid = os.getgid()
 
-    if gid == 0:
-        f = open(LOGFILE, "a")
-        for index in log_message:
-            f.write(index)
-    else:
-        if os.path.isdir(user_log_dir):
-            pass
-        else:
-            os.makedirs(user_log_dir)
-        
-        log_msg_user = user_log_dir + "/port-utils.log"
-        f = open(log_msg_user, "a")
-        
-        for index in log_message:
-            f.write(index)
+    logger.write("main", message, status, phase, port)
 
 # Print debug messages
 def print_dbg(message):
-    gid = os.getgid()
-    f = open(SETTINGS, 'r')
-    settings_data = json.load(f)
-
-    if settings_data["debug"] == "True":
+    if settings.get("debug"):
         print(message)
     else:
-        message = message + "\n"
-        if gid == 0:
-            file = open("/var/log/port-utils-dbg.log", "a")
-        else:
-            if os.path.isdir(user_log_dir):
-                pass
-            else:
-                os.makedirs(user_log_dir)
-            
-            dbg_msg_file = user_log_dir + "/port-utils-dbg.log"
-            file = open(dbg_msg_file, "a")
-
-        for index in message:
-            file.write(index)
-        
-        file.close()
-    
-    f.close()
+        logger.write("debug", message, "debug")
 
 # Dialog message
 def dialog_msg(message=DIALOG_MESSAGE, return_code=0):
@@ -214,12 +336,60 @@ def dialog_msg(message=DIALOG_MESSAGE, return_code=0):
     'return code' - ONLY int type.
     """
     
-    run = input(message)
+    try:
+        run = input(message)
+    except EOFError:
+        # Ответ не получен (например, stdin занят списком портов)
+        print()
+        run = ""
+
     if run == "y" or run == "Y":
         pass
     else:
         sys.exit(return_code)
 
+# Reading the list of ports
+def read_ports(values):
+    """
+    Function for getting the list of ports from the command line arguments
+
+    Usage:
+    `read_ports(values)`
+
+    Each value is a port, `-` (read the ports from stdin) or `@FILE` (read
+    the ports from the file). In the lists the ports are separated by
+    spaces or new lines; the text after `#` is ignored. Repeated ports
+    are removed.
+    """
+
+    ports = []
+
+    for value in values:
+        if value != "-" and not value.startswith("@"):
+            ports.append(value)
+            continue
+
+        if value == "-":
+            text = sys.stdin.read()
+
+            # Ответы на вопросы читаются с терминала
+            try:
+                sys.stdin = open("/dev/tty")
+            except OSError:
+                pass
+        else:
+            try:
+                with open(value[1:]) as f:
+                    text = f.read()
+            except OSError as error:
+                print(_("Error reading {0}: {1}").format(value[1:], error.strerror))
+                sys.exit(1)
+
+        for line in text.splitlines():
+            ports += line.split("#")[0].split()
+
+    return list(dict.fromkeys(ports))
+
 # Checking to run a function as root
 def check_root(v_exit=True):
     """
@@ -282,542 +452,4109 @@ def check_ports(mode):
 ## MAIN CLASSES ##
 ##              ##
 ##################
-class update_ports(object):
+class logger(object):
     """
-    Class for update Port system and CalmiraLinux documentation
+    Buffered logger.
+
+    The records (time, status, phase, port, message) are collected in
+    memory and written by the background thread once per
+    `logger.flush_interval` seconds (and at the program exit) as JSON
+    lines. Each log file is opened once per process. When a log file
+    becomes larger than `logger.max_size`, it's compressed
+    (`port-utils.log.1.gz`, ...); `logger.keep` old logs are kept.
 
     Usage:
-    
-    `ports(mode, branch)`
+    `logger.write(log, message, status, phase, port)`
 
-    - 'mode' - work mode:
-      - 'port' - download port package.
-    - 'branch' - download branch:
-      - 'stable',
-      - 'testing'.
+    Logs:
+    - `main` - `LOGFILE` (`~/.local/var/log/port-utils.log` for users);
+    - `debug` - `DBG_LOGFILE` (`~/.local/var/log/port-utils-dbg.log`).
     """
-    def __init__(branch):
-        check_root() # Checking for run program as non-root user
 
-        update_ports.update_meta(branch) # Update metadata
-        if update_ports.check_meta():
-            update_ports.get_file(branch)  # Download the required files
-        else:
-            print(_("The metadata does not match the CalmiraLinux release!")) # FIXME: translate
-            dialog_msg(return_code=1)
-        
-        if os.path.isdir(PORT_CACHE_DIR):
-            try:
-                os.remove(PORT_CACHE_DIR)
-                os.makedirs(PORT_CACHE_DIR)
-            except:
-                print(_("Uknown error"))
-        
-        update_ports.unpack_file(PORT_CACHE, PORT_CACHE_DIR)
-        update_ports.install_file(PORT_CACHE_DIR, PORTDIR)
-    
-    def print_changes(self, change, message):
+    flush_interval = 1.0            # Период записи буфера (секунды)
+    max_records    = 1000           # Буфер записывается досрочно, если он больше
+    max_size       = 1024 * 1024    # Размер лога, после которого он сжимается
+    keep           = 5              # Число сохраняемых сжатых логов
+
+    buffer  = []
+    files   = {}                    # log -> (path, file object)
+    lock    = threading.Lock()      # Блокировка буфера
+    io_lock = threading.Lock()      # Блокировка записи в файлы
+    event   = threading.Event()
+    thread  = None
+
+    def path(log):
         """
-        Function for printing information about changes to stdout.
+        Returns the file of the log
+        """
+
+        if os.getgid() == 0:
+            return LOGFILE if log == "main" else DBG_LOGFILE
+
+        log_dir = os.path.expanduser(user_log_dir)
+        return log_dir + ("/port-utils.log" if log == "main" else "/port-utils-dbg.log")
+
+    def write(log, message, status, phase=None, port=None):
+        """
+        Function for adding the record to the buffer
 
         Usage:
-        `update_ports.print_changes(change, message)`
+        `logger.write(log, message, status, phase, port)`
         """
-        
-        self.change = change
-        self.message = message
 
-        try:
-            for package in change:
-                print("{0}: {1}".format(change, message))
-        except:
-            print(_("Uknown error"))
+        record = (log, time.time(), status, phase, port, message)
+
+        with logger.lock:
+            logger.buffer.append(record)
+            size = len(logger.buffer)
+
+            if logger.thread is None:
+                logger.thread = threading.Thread(target=logger.run, daemon=True)
+                logger.thread.start()
+                atexit.register(logger.flush)
 
-    def get_update_number(self, metadata):
+        if size >= logger.max_records:
+            logger.event.set()
+
+    def run():
+        """
+        Background thread function
         """
-        Function for checking update_number
 
-        Usage:
-        `check_update_meta(metadata)`
+        while True:
+            logger.event.wait(logger.flush_interval)
+            logger.event.clear()
+            logger.flush()
 
-        `metadata` - metadata file (e.g. /tmp/metadata.json)
+    def flush():
+        """
+        Function for writing the buffered records to the log files
         """
 
-        self.metadata = metadata
+        with logger.lock:
+            records = logger.buffer
+            logger.buffer = []
+
+        if not records:
+            return
+
+        with logger.io_lock:
+            lines = {}
+            for log, timestamp, status, phase, port, message in records:
+                record = {
+                    "time": datetime.fromtimestamp(timestamp).isoformat(timespec="milliseconds"),
+                    "status": status,
+                    "phase": phase,
+                    "port": port,
+                    "message": message
+                }
+                lines.setdefault(log, []).append(json.dumps(record, ensure_ascii=False) + "\n")
+
+            for log, log_lines in lines.items():
+                try:
+                    f = logger.open(log)
+                    f.write("".join(log_lines))
+                    f.flush()
 
-        if os.path.isfile(metadata):
-            f = open(metadata, "r")
-        else:
-            print(_("File {} not found").format(metadata))
-            return 1
-        
-        meta_data = json.load(f)
-        yield meta_data["update_number"]
-        f.close()
-    
-    def update_meta(self, branch):
+                    if f.tell() > logger.max_size:
+                        logger.rotate(log)
+                except OSError:
+                    pass # Лог недоступен - сообщения не должны мешать работе
+
+    def open(log):
+        """
+        Function for opening the log file (once per process)
         """
-        Function for update port-utils metadata
 
-        Files:
-        - `/usr/share/ports/metadata.json` - metadata file.
+        if log not in logger.files:
+            path = logger.path(log)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            logger.files[log] = (path, open(path, "a"))
 
-        Branches:
-        - 'stable',
-        - 'testing'.
+        return logger.files[log][1]
+
+    def rotate(log):
+        """
+        Function for compressing the log file
         """
 
-        self.branch = branch
+        path, f = logger.files.pop(log)
+        f.close()
 
-        log_msg("Updating metadata", "notice")
+        for index in range(logger.keep - 1, 0, -1):
+            old = "{0}.{1}.gz".format(path, index)
+            if os.path.isfile(old):
+                os.replace(old, "{0}.{1}.gz".format(path, index + 1))
 
-        # Check branches
-        if branch == "stable":
-            content_md = "https://raw.githubusercontent.com/CalmiraLinux/Ports/main/metadata.json"
-        elif branch == "testing":
-            content_md = "https://raw.githubusercontent.com/CalmiraLinux/Ports/testing/metadata.json"
-        else:
-            print(_("Uknown branch {}").format(branch))
-            sys.exit(1)
-        
-        METADATA_tmp = "/tmp/metadata_tmp.json"
+        with open(path, "rb") as src, gzip.open(path + ".1.gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
 
-        # Downloading metadata
-        if os.path.isfile(METADATA_tmp):
-            os.remove(METADATA_tmp)
-        
-        wget.download(content_md, METADATA_tmp)
+        os.remove(path)
 
-        # Checking
-        try:
-            f_i = open(METADATA_tmp)
-            metadata_file = json.load(f_i)
-        except FileNotFoundError:
-            print(_("File {} not found").format(METADATA_tmp))
-            sys.exit(1)
-        except:
-            print(_("Uknown error"))
-            sys.exit(1)
+class timings(object):
+    """
+    Timing spans of the program phases (`--timings`).
 
-        metadata_install = update_ports.check_update_meta(METADATA)
+    Each span records the wall time, the CPU time of the thread, the CPU
+    time of the child processes run by the thread during the span (the
+    port build scripts, see `timings.add_children_cpu()`), and the bytes
+    and files processed in the phase. The spans are recorded only if
+    `timings.enabled` is `True`.
 
-        if metadata_file["update_number"] > metadata_install:
-            changes = True
-        
-        elif metadata_file["update_number"] < metadata_install:
-            print(_("\nThe update number of the received metadata is less than the number of the installed ones. This means that you are rolling back the Ports system to a previous version. You may be using the testing branch and installing an update from stable."))
-            dialog_msg(return_code=1)
+    Usage:
+    ```
+    with timings.span("update", "download") as span:
+        ...
+        span["bytes"] += size
+        span["files"] += 1
+    ```
+
+    `timings.report(format)` prints the summary (`text`) or all spans
+    (`json`) to stderr.
+    """
 
-        else:
-            print(_("\nAn error occurred while checking for metadata updates. The update number of the metadata received or installed could not be parsed."))
-            f_i.close()
-            sys.exit(1)
-        
-        if changes:
-            difference = int(metadata_file["update_number"]) - int(update_ports.get_update_number(METADATA))
-            print(_("Number of changes: {}\n").format(difference))
+    enabled = False
 
-            print(_("Changes in the current update:"))
-            #print(_("Updates:"))
-            update_ports.print_changes(metadata_file["updates"], UPDATE_MSG)        # Updates
-            update_ports.print_changes(metadata_file["additions"], ADDITIONS_MSG)   # Additions
-            update_ports.print_changes(metadata_file["deletions"], DELETIONS_MSG)   # Deletions
+    spans = []
+    lock  = threading.Lock()
+    start = time.perf_counter()
+    local = threading.local() # Открытые спаны потока (`local.open`)
 
-            print(_("Changes in previous missed updates:"))
-            f_i.close()
-            
-            file = "https://github.com/CalmiraLinux/Ports/raw/" + metadata_file["prev"] + "/metadata.json"
-            while i <= difference:
-                if os.path.isfile(METADATA_tmp):
-                    os.remove(METADATA_tmp)
-                
-                wget.download(file, METADATA_tmp)
+    @contextlib.contextmanager
+    def span(phase, name, port=None):
+        """
+        Context manager of the span; yields the dict in which the caller
+        can count `bytes` and `files`
+        """
 
-                if os.path.isfile(METADATA_tmp):
-                    f_i = open(METADATA_tmp, "r")
-                    metadata_file = json.load(f_i)
+        record = {"phase": phase, "name": name, "port": port, "bytes": 0, "files": 0}
 
-                    print(_("\nUpdate ID: {}").format(metadata_file["prev"]))
+        if not timings.enabled:
+            yield record
+            return
 
-                    update_ports.print_changes(metadata_file["updates"], UPDATE_MSG)
-                    update_ports.print_changes(metadata_file["additions"], ADDITIONS_MSG)
-                    update_ports.print_changes(metadata_file["deletions"], DELETIONS_MSG)
+        start = time.perf_counter()
+        cpu = time.thread_time()
 
-                    f_i.close()
-                else:
-                    print(_("Error: old metadata file doesn't been downloaded!"))
-                    sys.exit(1)
-            
-            dialog_msg()
-    
-    def get_distro_version(self):
+        # Время дочерних процессов считается по каждому процессу отдельно
+        # (os.times() общий для всех потоков, а порты собираются параллельно)
+        record["children_cpu"] = 0.0
+        opened = timings.local.__dict__.setdefault("open", [])
+        opened.append(record)
+
+        try:
+            yield record
+        finally:
+            opened.remove(record)
+
+            record["start"] = start - timings.start
+            record["wall"] = time.perf_counter() - start
+            record["cpu"] = time.thread_time() - cpu
+
+            with timings.lock:
+                timings.spans.append(record)
+
+    def add_children_cpu(usage):
         """
-        Function for get CalmiraLinux version
+        Function for adding the CPU time of the finished child process
+        (`resource.struct_rusage` from `os.wait4()`) to the open spans of
+        the current thread
         """
-        f_distro = open(CALM_RELEASE)
-        distro = json.load(f_distro)
 
-        yield distro["distroVersion"]
-        f_distro.close()
+        for record in getattr(timings.local, "open", ()):
+            record["children_cpu"] += usage.ru_utime + usage.ru_stime
 
-    def check_meta(self):
+    def summary():
         """
-        Function for check metadata for compatible
-        with CalmiraLinux release
+        Returns the spans grouped by the phase and name:
+        `[(phase, name, count, wall, cpu, children_cpu, bytes, files)]`
         """
-        log_msg("Checking metadata compatible with this CalmiraLinux distribution", "notice")
 
-        for file in METADATA, CALM_RELEASE:
-            if os.path.isfile(file):
-                pass
-            else:
-                print(_("File {} not found").format(file))
-                sys.exit(1)
-        
-        f_meta = open(METADATA)
-        metadata = json.load(f_meta)
+        groups = {}
 
-        if int(metadata["system_version"]) == int(update_ports.get_distro_version()):
-            log_msg("metadata OK", "ok")
-            return_code =  0
-        else:
-            log_msg("metadata FAIL", "FAIL")
-            return_code =  1
-            
-        f_meta.close()
-        return return_code
+        with timings.lock:
+            spans = list(timings.spans)
 
-    def get_file(self, branch):
-        """
-        Function for download Port system and CalmiraLinux documentation
+        for record in spans:
+            group = groups.setdefault((record["phase"], record["name"]), [0, 0.0, 0.0, 0.0, 0, 0])
+            group[0] += 1
+            group[1] += record["wall"]
+            group[2] += record["cpu"]
+            group[3] += record["children_cpu"]
+            group[4] += record["bytes"]
+            group[5] += record["files"]
 
-        Usage:
+        return [key + tuple(value) for key, value in groups.items()]
 
-        `ports.get_file(mode, branch)`
-        * 'branch' - download branch:
-            * 'stable',
-            * 'testing'.
+    def report(output_format="text"):
+        """
+        Function for printing the timings report to stderr
         """
 
-        self.branch = branch
+        total = time.perf_counter() - timings.start
 
-        log_message = "Getting file from branch '" + branch + "'"
-        log_msg(log_message, "notice")
+        if output_format == "json":
+            with timings.lock:
+                spans = list(timings.spans)
 
-        try:
-            pkg_data = open(METADATA, 'r')
-        except FileNotFoundError:
-            log_msg("File not found", "error")
-            print(_("File {} not found").format(METADATA))
-            sys.exit(1)
-        except:
-            log_msg("Uknown error", "error")
-            print(_("Uknown error"))
-            sys.exit(1)
-        
-        package_data = json.load(pkg_data)
+            json.dump({"total": total, "spans": spans}, sys.stderr, indent=4)
+            sys.stderr.write("\n")
+            return
 
-        # Downloading
-        for file in PORT_CACHE, DOC_CACHE:
-            if os.path.isfile(file):
-                os.remove(file)
-        
-        try:
-            if branch == "stable":
-                download_file = package_data["ports_stable"] + "/" + package_data["port_file"]
-                wget.download(download_file, PORT_CACHE)
+        lines = [_("\nTimings (total: {:.3f} s):").format(total),
+                 "{0:<10} {1:<10} {2:>6} {3:>10} {4:>10} {5:>10} {6:>12} {7:>8}".format(
+                     _("phase"), _("step"), _("count"), _("wall, s"), _("CPU, s"),
+                     _("child CPU"), _("bytes"), _("files"))]
 
-            elif branch == "testing":
-                download_file = package_data["ports_unstable"] + "/" + package_data["port_file"]
-                wget.download(download_file, PORT_CACHE)
+        for phase, name, count, wall, cpu, children_cpu, size, files in timings.summary():
+            lines.append("{0:<10} {1:<10} {2:>6} {3:>10.3f} {4:>10.3f} {5:>10.3f} {6:>12} {7:>8}".format(
+                phase, name, count, wall, cpu, children_cpu, size or "-", files or "-"))
 
-            else:
-                print(_("Uknown mode or branch for 'download_file'!"))
-                sys.exit(1)
+        print("\n".join(lines), file=sys.stderr)
 
-        except:
-            # FIXME: очень часто неправильно выбирается исключение и тип ошибки "Uknown"
-            print(_("Uknown error"))
-            sys.exit(1)
-    
-    def unpack_file(self, file, extract_dir):
-        """
-        Function for unpacking files.
+class settings(object):
+    """
+    Program settings (`SETTINGS`)
 
-        Usage:
-        
-        `ports.unpack_file(mode)`
-        """
+    The file is parsed once per process and parsed again only if its
+    mtime is changed. The values are checked against `settings.params`
+    and converted to the types of the default values (e.g. `"True"` ->
+    `True`).
 
-        self.file = file
-        self.extract_dir = extract_dir
+    Usage:
+    `settings.get(param)`
+    """
 
-        if os.path.isfile(file):
-            try:
-                t = tarfile.open(file, 'r')
-                t.extractall(path=extract_dir)
+    params = {
+        "debug": False,
+        "print_error_message": False,
+        "pager": "/usr/bin/less",
+        "downgrade_with_fetch": False,
+        "repo": "https://github.com/CalmiraLinux/Ports/raw/",
+        "branch": "testing",
+        "jobs": 1,
+        "lock_timeout": 10,
+        "binary_packages": False
+    }
 
-            except tarfile.ReadError:
-                print(_("Package read error. Perhaps he is broken"))
-                sys.exit(1)
+    minimum = {"jobs": 1, "lock_timeout": 0} # Минимальные значения числовых параметров
 
-            except tarfile.CompressionError:
-                print(_("Package unpacking error. The format is not supported"))
-                sys.exit(1)
-            
-            except:
-                print(_("Uknown error"))
-                sys.exit(1)
-        else:
-            print(_("Package searching error. He's not found. It may have not been downloaded, or a third-party program changed it's name during unpacking"))
-            sys.exit(1)
-    
-    def install_file(self, net_dir, target_dir):
+    data  = None # Параметры (после проверки)
+    mtime = None # mtime файла, из которого прочитаны параметры
+
+    def convert(param, value):
         """
-        Function for install Port system or CalmiraLinux documentation package.
+        Function for converting the parameter value to the type of its
+        default value
 
-        Usage:
+        Raises `ValueError` if the value can't be converted.
+        """
 
-        `update_ports.install_file(net_dir, target_dir)`
+        default = settings.params[param]
 
-        * `net_dir` - что копировать;
-        * `target_dir` - куда копировать.
+        if isinstance(default, bool):
+            if isinstance(value, bool):
+                return value
+            if str(value).lower() in ("true", "yes", "1"):
+                return True
+            if str(value).lower() in ("false", "no", "0"):
+                return False
+            raise ValueError(value)
+
+        if isinstance(default, int):
+            value = int(value)
+            if value < settings.minimum.get(param, value):
+                raise ValueError(value)
+            return value
+
+        return str(value)
+
+    def load():
         """
+        Function for loading the settings
 
-        self.net_dir = net_dir
-        self.target_dir = target_dir
+        Returns the dict with all parameters. The missing, unknown and
+        wrong parameters are reported in the debug log; default values are
+        used for them.
+        """
 
-        # Checking for a previous version of package
-        if os.path.isdir(target_dir):
-            print(_("Found directory with previous Port system/CalmiraLinux documentation. Removing..."))
-            shutil.rmtree(target_dir)
-        else:
-            pass
-        
-        # Copying
         try:
-            print(_("Copying files..."))
-            shutil.copytree(net_dir, target_dir)
-        except:
-            print(_("Uknown error of copy target files"))
-            sys.exit(1)
+            mtime = os.stat(SETTINGS).st_mtime
+        except OSError:
+            mtime = None
 
-class port_functions():
+        if settings.data is not None and mtime == settings.mtime:
+            return settings.data
+
+        data = dict(settings.params)
+        settings.mtime = mtime
+        settings.data = data
+
+        if mtime is None:
+            return data
+
+        try:
+            with open(SETTINGS) as f:
+                file_data = json.load(f)
+        except (OSError, ValueError) as error:
+            print_dbg("settings: error reading {0}: {1}".format(SETTINGS, error))
+            return data
+
+        for param, value in file_data.items():
+            if param not in settings.params:
+                print_dbg("settings: unknown param '{}'".format(param))
+                continue
+
+            try:
+                data[param] = settings.convert(param, value)
+            except (TypeError, ValueError):
+                print_dbg("settings: wrong value of '{0}': {1}".format(param, value))
+
+        return data
+
+    def get(param):
+        """
+        Function for getting the parameter value
+
+        Usage:
+        `settings.get(param)`
+        """
+
+        return settings.load()[param]
+
+class downloader(object):
     """
-    Other functions for Port system
+    Class for downloading files over HTTP(S)
+
+    Usage:
+    `downloader.get(url, file)`
+
+    Features:
+    - the connections are kept alive and reused by all downloads of the
+      program (e.g. metadata, ports and documentation packages);
+    - large files are downloaded by several segments at the same time
+      (with `Range` requests) if the server supports it;
+    - the downloaded data is saved in `.part` files, so an interrupted
+      download is resumed from the place where it stopped;
+    - the failed requests are retried `downloader.retries` times.
     """
-    def clean_sys(self, mode):
+
+    threads     = 4           # Число одновременно скачиваемых сегментов
+    retries     = 3           # Число повторных попыток
+    segment_min = 1024 * 1024 # Минимальный размер сегмента
+    chunk_size  = 64 * 1024   # Размер блока при чтении ответа
+    timeout     = 30          # Таймаут соединения (секунды)
+    redirects   = 10          # Максимальное число перенаправлений
+
+    pool      = {}            # Открытые соединения: (scheme, host) -> [conn]
+    pool_lock = threading.Lock()
+
+    local = threading.local() # `local.quiet = True` - не выводить прогресс в этом потоке
+
+    def connection(scheme, host):
         """
-        Function for cleaning system
+        Function for getting a connection from the pool (or opening a new one)
 
-        Work modes:
-        - `cache` - clean the cache;
-        - `log` - clean the log dir.
+        Returns the `(conn, reused)` pair.
         """
 
-        self.mode = mode
-        
-        check_root()
-        
-        if mode == "cache":
-            # Очистка кеша
-            print(_("Checking for cache existence..."), end = " ")
+        with downloader.pool_lock:
+            conns = downloader.pool.get((scheme, host))
+            if conns:
+                return conns.pop(), True
 
-            if os.path.isdir(CACHE):
-                print(OK_MSG)
-                print(_("Removing {}...").format(CACHE))
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(host, timeout=downloader.timeout)
+        elif scheme == "http":
+            conn = http.client.HTTPConnection(host, timeout=downloader.timeout)
+        else:
+            raise ValueError("Unsupported URL scheme: " + scheme)
 
+        return conn, False
+
+    def release(scheme, host, conn):
+        """
+        Function for returning the connection to the pool after the response
+        was completely read
+        """
+
+        with downloader.pool_lock:
+            downloader.pool.setdefault((scheme, host), []).append(conn)
+
+    def close_all():
+        """
+        Function for closing all connections in the pool
+        """
+
+        with downloader.pool_lock:
+            for conns in downloader.pool.values():
+                for conn in conns:
+                    conn.close()
+            downloader.pool.clear()
+
+    def request(url, headers=None, method="GET"):
+        """
+        Function for sending the request (redirects are followed)
+
+        Usage:
+        `downloader.request(url, headers)`
+
+        Returns the `(response, release)` pair. The response must be
+        completely read, then `release()` must be called for returning the
+        connection to the pool; if the response isn't read completely (an
+        error), `release(close=True)` closes the connection.
+        `response.url` is the URL after redirects.
+        """
+
+        for redirect in range(downloader.redirects):
+            parts = urllib.parse.urlsplit(url)
+            path  = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+
+            conn, reused = downloader.connection(parts.scheme, parts.netloc)
+
+            try:
+                conn.request(method, path, headers=headers or {})
+                resp = conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if not reused:
+                    raise
+
+                # Сервер закрыл простаивающее соединение - открываем новое
+                conn, reused = downloader.connection(parts.scheme, parts.netloc)
                 try:
-                    shutil.rmtree(CACHE)
-                except:
-                    print(_("Error removing directory {}").format(CACHE))
-                    sys.exit(1)
-                
-                print(_("Make {}...").format(CACHE))
-                try:
-                    os.makedirs(CACHE)
+                    conn.request(method, path, headers=headers or {})
+                    resp = conn.getresponse()
                 except:
-                    print(_("Error making {}").format(CACHE))
-                    sys.exit(1)
-            else:
-                print(_("Fail: cache directory not found"))
-                sys.exit(1)
+                    conn.close()
+                    raise
 
-        elif mode == "log":
-            # Очистка лога
-            print(_("Checking for log files existence..."))
+            def release(close=False, scheme=parts.scheme, host=parts.netloc, conn=conn, resp=resp, released=[]):
+                # Соединение возвращается в пул (или закрывается) один раз
+                if released:
+                    return
+                released.append(True)
 
-            for file in LOGFILE, '/var/log/port-utils-dbg.log':
-                print(_("Checking file {}...").format(file), end = " ")
-                if os.path.isfile(file):
-                    print(OK_MSG)
+                if close or resp.will_close:
+                    conn.close()
                 else:
-                    print(FAIL_MSG)
-                    file_not_exists = True
-                
-            if file_not_exists == True:
-                sys.exit(1)
-                
+                    downloader.release(scheme, host, conn)
+
+            if resp.status in (301, 302, 303, 307, 308):
+                location = resp.getheader("Location")
+                resp.read()
+                release()
+
+                if location is None:
+                    raise http.client.HTTPException("Redirect without location")
+
+                url = urllib.parse.urljoin(url, location)
+                continue
+
+            resp.url = url # Адрес после перенаправлений
+            return resp, release
+
+        raise http.client.HTTPException("Too many redirects")
+
+    def parse_range(content_range):
+        """
+        Returns the full file size from the `Content-Range` header
+        (e.g. `bytes 0-0/1234`) or `None`.
+        """
+
+        try:
+            return int(content_range.rsplit("/", 1)[1])
+        except (AttributeError, IndexError, ValueError):
+            return None
+
+    def copy_body(resp, f, progress=None, stop=None):
+        """
+        Function for copying the response body to the file
+
+        If the `stop` event is set or the connection is closed before the
+        end of the body, the copying is interrupted with
+        `http.client.HTTPException`.
+        """
+
+        while True:
+            if stop is not None and stop.is_set():
+                raise http.client.HTTPException("Downloading is stopped")
+
+            data = resp.read(downloader.chunk_size)
+            if not data:
+                # `read(amt)` не сообщает об оборванном соединении
+                if resp.length:
+                    raise http.client.IncompleteRead(b"", resp.length)
+                break
+
+            f.write(data)
+            if progress is not None:
+                progress.append(len(data))
+
+    def get_segment(url, part_file, start, end, validator, progress, stop=None):
+        """
+        Function for downloading one segment of the file (`start` - `end`
+        bytes, inclusive) to the `part_file`.
+
+        If `part_file` exists, the download is continued from its end.
+        """
+
+        size = end - start + 1
+        last_error = None
+
+        for attempt in range(downloader.retries + 1):
+            if stop is not None and stop.is_set():
+                break
+
+            # Сегмент скачан - повторная попытка (и пауза перед ней) не нужна
+            done = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+            if done >= size:
+                return True
+
+            if attempt:
+                time.sleep(2 ** (attempt - 1))
+
+            headers = {"Range": "bytes={0}-{1}".format(start + done, end)}
+            if validator:
+                headers["If-Range"] = validator
+
+            release = None
             try:
-                os.remove(file)
-            except:
-                print(_("Error removing file {}").format(file))
-                sys.exit(1)
+                resp, release = downloader.request(url, headers)
 
-        elif mode == "src":
-            # Очистка директории /usr/src
+                if resp.status != 206:
+                    raise http.client.HTTPException("Unexpected HTTP status {}".format(resp.status))
 
-            src_dir = "/usr/src"
-            print(_("Checking for src directory existence..."), end = " ")
-            
-            if os.path.isdir(src_dir):
-                print(OK_MSG)
-            else:
-                print(FAIL_MSG)
-                file_non_exists = True
-            
-            if file_non_exists == True:
-                sys.exit(1)
-            
-            print(_("Removing {}...").format(src_dir))
+                with open(part_file, "ab") as f:
+                    downloader.copy_body(resp, f, progress, stop)
+                release()
+
+            except (http.client.HTTPException, OSError) as error:
+                # Недочитанный ответ - соединение нельзя вернуть в пул
+                if release is not None:
+                    release(close=True)
+                last_error = error
+                continue
+
+        done = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+        if done >= size:
+            return True
+
+        log_msg("Downloading of " + url + " failed: " + str(last_error), "error", phase="download")
+        return False
+
+    def get_stream(url, part_file, progress, stop=None):
+        """
+        Function for downloading the file without segments. It's used if
+        the server doesn't support `Range` requests or the file size is
+        unknown.
+        """
+
+        last_error = None
+
+        for attempt in range(downloader.retries + 1):
+            if stop is not None and stop.is_set():
+                break
+
+            if attempt:
+                time.sleep(2 ** (attempt - 1))
+
+            release = None
             try:
-                shutil.rmtree(src_dir)
-            except:
-                print(_("Error removing directory {}").format(src_dir))
-                sys.exit(1)
-            
-            print(_("Make {}...").format(src_dir))
+                resp, release = downloader.request(url)
+
+                if resp.status != 200:
+                    raise http.client.HTTPException("Unexpected HTTP status {}".format(resp.status))
+
+                with open(part_file, "wb") as f:
+                    downloader.copy_body(resp, f, progress, stop)
+                release()
+
+                return True
+
+            except (http.client.HTTPException, OSError) as error:
+                if release is not None:
+                    release(close=True)
+                last_error = error
+                continue
+
+        log_msg("Downloading of " + url + " failed: " + str(last_error), "error", phase="download")
+        return False
+
+    def print_progress(file, progress, size):
+        """
+        Function for printing the downloading progress
+        """
+
+        if not sys.stdout.isatty() or getattr(downloader.local, "quiet", False):
+            return
+
+        done = sum(progress)
+        if size:
+            print("\r{0}: {1}%".format(os.path.basename(file), done * 100 // size), end = " ")
+        else:
+            print("\r{0}: {1} KiB".format(os.path.basename(file), done // 1024), end = " ")
+
+    def print_error(message):
+        """
+        Function for printing the downloading error (if the output of this
+        thread isn't quiet)
+        """
+
+        if not getattr(downloader.local, "quiet", False):
+            print(message)
+
+    def get(url, file, cache=False, stop=None):
+        """
+        Function for downloading file
+
+        Usage:
+        `downloader.get(url, file, cache, stop)`
+
+        - `url` - URL of the file;
+        - `file` - where to save the file;
+        - `cache` - if `True`, the file isn't downloaded again while it
+          isn't changed on the server (conditional request with the
+          validators saved in `DOWNLOAD_CACHE`);
+        - `stop` - `threading.Event`; the downloading is interrupted when
+          it's set (the downloaded part is kept).
+
+        Returns `"downloaded"` if the file was downloaded, `"not_modified"`
+        if the previously downloaded file is up to date, `False` in case of
+        error.
+        """
+
+        part_file  = file + ".part"
+        state_file = part_file + ".json" # Параметры незавершённой загрузки
+        cache_url  = url if cache else None
+
+        headers = {"Range": "bytes=0-0"}
+        if cache:
+            headers.update(downloader.conditional_headers(url, file))
+
+        # Getting the file size and checking `Range` support
+        try:
+            resp, release = downloader.request(url, headers)
+        except (http.client.HTTPException, OSError, ValueError) as error:
+            log_msg("Downloading of " + url + " failed: " + str(error), "error", phase="download")
+            downloader.print_error(CONNECTION_ERROR_MSG)
+            return False
+
+        validators = {
+            "etag": resp.getheader("ETag"),
+            "last_modified": resp.getheader("Last-Modified")
+        }
+
+        if resp.status == 304:
+            resp.read()
+            release()
+            log_msg(url + " isn't modified", "ok", phase="download")
+            return "not_modified"
+
+        if resp.status not in (200, 206):
+            resp.read()
+            release()
+            log_msg("Downloading of {0} failed: HTTP {1}".format(url, resp.status), "error", phase="download")
+            downloader.print_error(_("Downloading error: HTTP {0} ({1})").format(resp.status, url))
+            return False
+
+        progress = []
+
+        if resp.status == 200:
+            # Сервер не поддерживает `Range` - файл уже передаётся целиком
+            downloader.clean_parts(file)
+
             try:
-                os.makedirs(src_dir)
-            except:
-                print(_("Error making {}").format(src_dir))
-                sys.exit(1)
+                with open(part_file, "wb") as f:
+                    downloader.copy_body(resp, f, progress, stop)
+                release()
+                ok = True
+            except (http.client.HTTPException, OSError):
+                release(close=True)
+                progress.clear()
+                ok = downloader.get_stream(url, part_file, progress, stop)
+
+            downloader.print_progress(file, progress, None)
+            return downloader.finish(file, ok, cache_url, validators)
+
+        # Адрес после перенаправлений (например, подписанная ссылка) может
+        # меняться при каждом запросе, поэтому незавершённая загрузка
+        # определяется исходным адресом и валидатором файла
+        location  = resp.url
+        size      = downloader.parse_range(resp.getheader("Content-Range"))
+        validator = resp.getheader("ETag") or resp.getheader("Last-Modified")
+        resp.read()
+        release()
+
+        if not size:
+            ok = downloader.get_stream(location, part_file, progress, stop)
+            downloader.print_progress(file, progress, size)
+            return downloader.finish(file, ok, cache_url, validators)
+
+        count  = max(1, min(downloader.threads, size // downloader.segment_min))
+        length = size // count
+        state  = {"url": url, "size": size, "validator": validator, "segments": count}
+
+        # Previous downloading of another file version can't be continued
+        try:
+            with open(state_file) as f:
+                prev_state = json.load(f)
+        except (OSError, ValueError):
+            prev_state = None
+
+        if prev_state != state:
+            downloader.clean_parts(file)
+
+        with open(state_file, "w") as f:
+            json.dump(state, f)
+
+        segments = []
+        for index in range(count):
+            start = index * length
+            end = size - 1 if index == count - 1 else start + length - 1
+            segments.append((part_file + str(index), start, end))
+
+            if os.path.isfile(part_file + str(index)):
+                progress.append(os.path.getsize(part_file + str(index)))
+
+        results = [False] * count
+
+        def run(index, part, start, end):
+            results[index] = downloader.get_segment(location, part, start, end, validator, progress, stop)
+
+        threads = [
+            threading.Thread(target=run, args=(index,) + segment, daemon=True)
+            for index, segment in enumerate(segments)
+        ]
+        for thread in threads:
+            thread.start()
+
+        while any(thread.is_alive() for thread in threads):
+            downloader.print_progress(file, progress, size)
+            time.sleep(0.2)
+
+        downloader.print_progress(file, progress, size)
+
+        ok = all(results)
+        if ok:
+            # Сборка файла из сегментов
+            with open(part_file, "wb") as f:
+                for part, start, end in segments:
+                    with open(part, "rb") as segment:
+                        shutil.copyfileobj(segment, f)
+                    os.remove(part)
+
+            ok = os.path.getsize(part_file) == size
+
+        return downloader.finish(file, ok, cache_url, validators)
+
+    def finish(file, ok, cache_url=None, validators=None):
+        """
+        Function for completing the download: the `.part` file is renamed
+        to the target file. If `cache_url` is set, the validators of the
+        file are saved for the next conditional requests.
+        """
+
+        part_file = file + ".part"
+
+        if sys.stdout.isatty() and not getattr(downloader.local, "quiet", False):
+            print()
+
+        if not ok:
+            downloader.print_error(CONNECTION_ABORT_MSG)
+            return False
+
+        os.replace(part_file, file)
+        if os.path.isfile(part_file + ".json"):
+            os.remove(part_file + ".json")
+
+        if cache_url is not None:
+            downloader.remember(cache_url, validators, file)
+
+        return "downloaded"
+
+    def load_cache():
+        """
+        Function for loading the validators of the downloaded files
+        (`DOWNLOAD_CACHE`)
+        """
 
-# Работа с файлами для класса install_ports
-class port_files(object):# Create database
-    def create_db(self, db):
+        try:
+            with open(DOWNLOAD_CACHE) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def remember(url, validators, file=None):
         """
-        Function for create database
+        Function for saving the validators (`ETag`, `Last-Modified`) of the
+        downloaded file and the hash of its contents
 
         Usage:
-        `port_files.create_db(db)`
+        `downloader.remember(url, validators, file)`
 
-        - `db` - file with database.
+        If `file` is `None`, the file wasn't saved (e.g. the package was
+        unpacked while downloading) and only the validators are saved.
         """
 
-        self.db = db
+        cache = downloader.load_cache()
 
-        if os.path.isfile(db):
-            return 1
+        if not validators or not (validators.get("etag") or validators.get("last_modified")):
+            cache.pop(url, None)
         else:
-            try:
-                conn   = sqlite3.connect(db, timeout=3)
-                cursor = conn.cursor()
-
-                cursor.execute("""
-                    CREATE TABLE ports (
-                        name TEXT, version TEXT, maintainer TEXT,
-                        description TEXT, priority TEXT
-                    );
-                    INSERT INTO ports VALUES (
-                        'ports', 'lx4/v1.1', 'Linuxoid85', 'Ports system for CalmiraLinux', 'system'
-                    );
-                    INSERT INTO ports VALUES (
-                        'port-utils', 'v1.0a2', 'Linuxoid85', 'Port system software', 'system'
-                    );
-                """)
-                conn.commit()
-                cursor.close()
-            
-            except sqlite3.Error as error:
-                print(_("SQLite3 connection error: {}").format(error))
-    
-    # FIXME: убрать устаревшие функции
-    # Lock database
-    def lock_db(self):
+            entry = dict(validators, file=file)
+
+            if file is not None:
+                stat = os.stat(file)
+                entry.update(sha256=update_ports.file_hash(file), size=stat.st_size,
+                             mtime=stat.st_mtime)
+
+            cache[url] = entry
+
+        os.makedirs(os.path.dirname(DOWNLOAD_CACHE), exist_ok=True)
+        with open(DOWNLOAD_CACHE + ".tmp", "w") as f:
+            json.dump(cache, f, indent=4)
+        os.replace(DOWNLOAD_CACHE + ".tmp", DOWNLOAD_CACHE)
+
+    def conditional_headers(url, file=None):
+        """
+        Function for getting the headers of the conditional request
+        (`If-None-Match`, `If-Modified-Since`) for the URL
+
+        If `file` is set, the headers are returned only if this file is
+        the same file which was downloaded (checked by the contents hash).
+        """
+
+        entry = downloader.load_cache().get(url)
+        if not entry or entry.get("file") != file:
+            return {}
+
+        if file is not None:
+            if not os.path.isfile(file):
+                return {}
+
+            stat = os.stat(file)
+            if stat.st_size != entry.get("size"):
+                return {}
+
+            # Хеш пересчитывается только если файл изменялся
+            if stat.st_mtime != entry.get("mtime") and update_ports.file_hash(file) != entry.get("sha256"):
+                return {}
+
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        return headers
+
+    def clean_parts(file):
         """
-        Function for locking database
+        Function for removing the `.part` files of the file
+        """
+
+        directory = os.path.dirname(file) or "."
+        prefix = os.path.basename(file) + ".part"
+
+        for name in os.listdir(directory):
+            if name.startswith(prefix):
+                os.remove(directory + "/" + name)
+
+class update_ports(object):
+    """
+    Class for update Port system and CalmiraLinux documentation
+
+    Usage:
+    
+    `ports(mode, branch)`
+
+    - 'mode' - work mode:
+      - 'port' - download port package.
+    - 'branch' - download branch:
+      - 'stable',
+      - 'testing'.
+    """
+    def __init__(self, branch, full=False, stream=True):
+        check_root() # Checking for run program as non-root user
+
+        with timings.span("update", "metadata"):
+            changes = update_ports.update_meta(branch) # Update metadata
+        if not update_ports.check_meta():
+            print(_("The metadata does not match the CalmiraLinux release!")) # FIXME: translate
+            dialog_msg(return_code=1)
+
+        ports = None if full else update_ports.incremental_ports(changes)
+
+        # Downloading and unpacking the package in one pass
+        if stream and update_ports.stream_install(branch, ports, changes):
+            return
+
+        update_ports.get_file(branch)  # Download the required files
+
+        if os.path.isdir(PORT_CACHE_DIR):
+            try:
+                with timings.span("update", "rmtree"):
+                    shutil.rmtree(PORT_CACHE_DIR)
+                os.makedirs(PORT_CACHE_DIR)
+            except:
+                print(_("Uknown error"))
+        
+        update_ports.unpack_file(PORT_CACHE, PORT_CACHE_DIR)
+
+        # Installing only the changed ports if it's possible
+        if full or not update_ports.apply_changes(PORT, PORTDIR, changes):
+            update_ports.install_file(PORT, PORTDIR)
+    
+    def print_changes(change, message):
+        """
+        Function for printing information about changes to stdout.
+
+        Usage:
+        `update_ports.print_changes(change, message)`
+        """
+
+        print(message)
+
+        try:
+            for package in change:
+                print(" - {}".format(package))
+        except:
+            print(_("Uknown error"))
+
+    def get_update_number(metadata):
+        """
+        Function for checking update_number
+
+        Usage:
+        `update_ports.get_update_number(metadata)`
+
+        `metadata` - metadata file (e.g. /tmp/metadata.json)
+
+        Returns `None` if the metadata file isn't found.
+        """
+
+        if os.path.isfile(metadata):
+            f = open(metadata, "r")
+        else:
+            return None
+        
+        meta_data = json.load(f)
+        f.close()
+
+        return int(meta_data["update_number"])
+    
+    def update_meta(branch):
+        """
+        Function for update port-utils metadata
+
+        Files:
+        - `/usr/share/ports/metadata.json` - metadata file.
+
+        Branches:
+        - 'stable',
+        - 'testing'.
+
+        Returns the changes since the installed metadata:
+        `{"from": update_number, "ports": [...]}`, where `ports` are the
+        updated, added and removed ports. `from` is `None` if the changes
+        are unknown (e.g. the metadata wasn't installed earlier or the
+        previous metadata can't be downloaded).
+        """
+
+        log_msg("Updating metadata", "notice", phase="update")
+
+        # Check branches
+        if branch == "stable":
+            content_md = "https://raw.githubusercontent.com/CalmiraLinux/Ports/main/metadata.json"
+        elif branch == "testing":
+            content_md = "https://raw.githubusercontent.com/CalmiraLinux/Ports/testing/metadata.json"
+        else:
+            print(_("Uknown branch {}").format(branch))
+            sys.exit(1)
+        
+        METADATA_tmp = METADATA_CACHE
+
+        # Downloading metadata (if it's changed since the previous downloading)
+        os.makedirs(CACHE, exist_ok=True)
+
+        if not downloader.get(content_md, METADATA_tmp, cache=True):
+            sys.exit(1)
+
+        # Checking
+        try:
+            f_i = open(METADATA_tmp)
+            metadata_file = json.load(f_i)
+            f_i.close()
+        except FileNotFoundError:
+            print(_("File {} not found").format(METADATA_tmp))
+            sys.exit(1)
+        except:
+            print(_("Uknown error"))
+            sys.exit(1)
+
+        # The installed Port system may be older than the metadata (e.g.
+        # after `--metadata`), so its own update number is preferred
+        metadata_install = update_ports.get_update_number(PORT_MANIFEST)
+        if metadata_install is None:
+            metadata_install = update_ports.get_update_number(METADATA)
+
+        changes = {"from": metadata_install, "ports": []}
+
+        try:
+            update_number = int(metadata_file["update_number"])
+        except (KeyError, ValueError):
+            print(_("\nAn error occurred while checking for metadata updates. The update number of the metadata received or installed could not be parsed."))
+            sys.exit(1)
+
+        if metadata_install is None:
+            print(_("The metadata isn't installed. The Port system will be installed completely."))
+            changes["from"] = None
+
+        elif update_number > metadata_install:
+            difference = update_number - metadata_install
+            print(_("Number of changes: {}\n").format(difference))
+
+            numbers = range(update_number, metadata_install, -1)
+            history = update_ports.get_history(content_md, metadata_file, numbers)
+
+            for number in numbers:
+                if number == update_number:
+                    print(_("Changes in the current update:"))
+                elif number == update_number - 1:
+                    print(_("Changes in previous missed updates:"))
+
+                entry = history.get(str(number))
+                if entry is None:
+                    print(_("Error: old metadata file doesn't been downloaded!"))
+                    changes["from"] = None
+                    break
+
+                if number != update_number:
+                    print(_("\nUpdate ID: {}").format(history[str(number + 1)].get("prev")))
+
+                for change, message in ("updates", UPDATE_MSG), ("additions", ADDITIONS_MSG), ("deletions", DELETIONS_MSG):
+                    update_ports.print_changes(entry.get(change, []), message)
+                    changes["ports"] += entry.get(change, [])
+
+            dialog_msg()
+
+        elif update_number < metadata_install:
+            print(_("\nThe update number of the received metadata is less than the number of the installed ones. This means that you are rolling back the Ports system to a previous version. You may be using the testing branch and installing an update from stable."))
+
+            if not settings.get("downgrade_with_fetch"):
+                print(_("Downgrading the port system is a bad idea."))
+                sys.exit(1)
+
+            dialog_msg(return_code=1)
+            changes["from"] = None
+
+        elif os.path.isdir(PORTDIR):
+            print(_("There are no changes in the port system."))
+            sys.exit(0)
+
+        # Installing new metadata
+        os.makedirs(FILES_DIR, exist_ok=True)
+        shutil.copyfile(METADATA_tmp, METADATA)
+
+        return changes
+    
+    def history_entry(metadata):
+        """
+        Returns the part of the metadata saved in the metadata history
+        """
+
+        entry = {
+            change: metadata.get(change, [])
+            for change in ("updates", "additions", "deletions")
+        }
+        entry["prev"] = metadata.get("prev")
+
+        return entry
+
+    def get_history(content_md, metadata_file, numbers):
+        """
+        Function for getting the changes of the missed updates
+
+        Usage:
+        `update_ports.get_history(content_md, metadata_file, numbers)`
+
+        * `content_md` - URL of the downloaded metadata;
+        * `metadata_file` - the downloaded metadata;
+        * `numbers` - the required update numbers.
+
+        The changes of the already seen updates are taken from the local
+        metadata history (`METADATA_HISTORY`). The other ones are taken from
+        the changelog of the branch (`changelog.json` next to the metadata,
+        with the changes of all updates) by one request. If it isn't
+        available, the previous metadata files are downloaded one by one
+        (by the `prev` links).
+
+        Returns the dict `{update_number: changes}` (the numbers are strings).
+        """
+
+        try:
+            with open(METADATA_HISTORY) as f:
+                history = json.load(f)
+        except (OSError, ValueError):
+            history = {}
+
+        history[str(metadata_file["update_number"])] = update_ports.history_entry(metadata_file)
+        missing = [number for number in numbers if str(number) not in history]
+
+        # Changelog with all updates
+        if missing:
+            changelog_url  = content_md.rsplit("/", 1)[0] + "/changelog.json"
+            changelog_file = CACHE + "/changelog.json"
+
+            if downloader.get(changelog_url, changelog_file, cache=True):
+                try:
+                    with open(changelog_file) as f:
+                        changelog = json.load(f)
+
+                    for number, entry in changelog.items():
+                        history.setdefault(str(int(number)), update_ports.history_entry(entry))
+                except (OSError, ValueError, AttributeError):
+                    log_msg("Broken changelog " + changelog_url, "error", phase="update")
+
+            missing = [number for number in numbers if str(number) not in history]
+
+        # Previous metadata files
+        METADATA_prev = METADATA_CACHE + ".prev"
+
+        for number in missing:
+            prev = (history.get(str(number + 1)) or {}).get("prev")
+            file = "https://github.com/CalmiraLinux/Ports/raw/" + str(prev) + "/metadata.json"
+
+            if prev is None or not downloader.get(file, METADATA_prev):
+                break
+
+            try:
+                with open(METADATA_prev) as f:
+                    prev_metadata = json.load(f)
+                os.remove(METADATA_prev)
+
+                if int(prev_metadata["update_number"]) != number:
+                    break
+            except (OSError, ValueError, KeyError):
+                break
+
+            history[str(number)] = update_ports.history_entry(prev_metadata)
+
+        os.makedirs(os.path.dirname(METADATA_HISTORY), exist_ok=True)
+        with open(METADATA_HISTORY + ".tmp", "w") as f:
+            json.dump(history, f)
+        os.replace(METADATA_HISTORY + ".tmp", METADATA_HISTORY)
+
+        return history
+
+    def get_distro_version():
+        """
+        Function for get CalmiraLinux version
+        """
+        f_distro = open(CALM_RELEASE)
+        distro = json.load(f_distro)
+        f_distro.close()
+
+        return distro["distroVersion"]
+
+    def check_meta():
+        """
+        Function for check metadata for compatible
+        with CalmiraLinux release
+        """
+        log_msg("Checking metadata compatible with this CalmiraLinux distribution", "notice", phase="update")
+
+        for file in METADATA, CALM_RELEASE:
+            if os.path.isfile(file):
+                pass
+            else:
+                print(_("File {} not found").format(file))
+                sys.exit(1)
+        
+        f_meta = open(METADATA)
+        metadata = json.load(f_meta)
+        f_meta.close()
+
+        if str(metadata["system_version"]) == str(update_ports.get_distro_version()):
+            log_msg("metadata OK", "ok", phase="update")
+            return True
+        else:
+            log_msg("metadata FAIL", "FAIL", phase="update")
+            return False
+
+    def get_url(branch):
+        """
+        Function for getting URL of the Port system package from the
+        installed metadata
+
+        Usage:
+
+        `update_ports.get_url(branch)`
+        """
+
+        try:
+            pkg_data = open(METADATA, 'r')
+        except FileNotFoundError:
+            log_msg("File not found", "error", phase="update")
+            print(_("File {} not found").format(METADATA))
+            sys.exit(1)
+        except:
+            log_msg("Uknown error", "error", phase="update")
+            print(_("Uknown error"))
+            sys.exit(1)
+        
+        package_data = json.load(pkg_data)
+        pkg_data.close()
+
+        try:
+            if branch == "stable":
+                download_file = package_data["ports_stable"] + "/" + package_data["port_file"]
+
+            elif branch == "testing":
+                download_file = package_data["ports_unstable"] + "/" + package_data["port_file"]
+
+            else:
+                print(_("Uknown mode or branch for 'download_file'!"))
+                sys.exit(1)
+
+        except KeyError:
+            print(_("Uknown error"))
+            sys.exit(1)
+
+        return download_file
+
+    def get_file(branch):
+        """
+        Function for download Port system and CalmiraLinux documentation
+
+        Usage:
+
+        `update_ports.get_file(branch)`
+        * 'branch' - download branch:
+            * 'stable',
+            * 'testing'.
+        """
+
+        log_message = "Getting file from branch '" + branch + "'"
+        log_msg(log_message, "notice", phase="update")
+
+        download_file = update_ports.get_url(branch)
+
+        # Downloading (if the package in the cache isn't up to date)
+        os.makedirs(CACHE, exist_ok=True)
+        with timings.span("update", "download") as span:
+            status = downloader.get(download_file, PORT_CACHE, cache=True)
+            if status and status != "not_modified":
+                span["bytes"] = os.path.getsize(PORT_CACHE)
+                span["files"] = 1
+
+        if not status:
+            log_msg("Downloading of " + download_file + " failed", "error", phase="update")
+            sys.exit(1)
+        elif status == "not_modified":
+            print(_("The Port system package in the cache is up to date"))
+
+    def member_path(name, prefix):
+        """
+        Function for getting the path of the archive member relative to the
+        `prefix` directory of the archive (e.g. `ports/base/vim/install` ->
+        `base/vim/install`).
+
+        Returns `None` for the members outside of `prefix` and for the
+        unsafe paths (absolute or with `..`).
+        """
+
+        parts = [part for part in name.split("/") if part not in ("", ".")]
+
+        if name.startswith("/") or ".." in parts or not parts or parts[0] != prefix:
+            return None
+
+        return "/".join(parts[1:])
+
+    def unsafe_member(file, member, links, allow_absolute=False):
+        """
+        Function for checking the archive member before unpacking it
+
+        - `file` - the member path relative to the target directory (see
+          `member_path()`);
+        - `links` - the symbolic links (relative paths) already created
+          from this archive;
+        - `allow_absolute` - the target directory is `/`, so the links
+          can't point outside of it.
+
+        The member is unsafe if it's written through or over a symbolic
+        link created from the archive, or if it's a symbolic link whose
+        target is absolute, outside the target directory or goes through
+        another symbolic link of the archive.
+        """
+
+        parts = file.split("/")
+        if any("/".join(parts[:index]) in links for index in range(1, len(parts) + 1)):
+            return True
+
+        if member.issym() and not allow_absolute:
+            if member.linkname.startswith("/"):
+                return True
+
+            # Цель проверяется по компонентам: `..` после ссылки из архива
+            # ведёт не в тот каталог, который получается при нормализации пути
+            target = parts[:-1]
+            for part in member.linkname.split("/"):
+                if target and "/".join(target) in links:
+                    return True
+
+                if part == "..":
+                    if not target:
+                        return True
+                    target.pop()
+                elif part not in ("", "."):
+                    target.append(part)
+
+        return False
+
+    def safe_members(tar):
+        """
+        Generator of the archive members for `TarFile.extractall()`
+
+        The members are checked with the same rules as in
+        `extract_stream()`; `tarfile.TarError` is raised for the unsafe one.
+        """
+
+        links = set()
+
+        for member in tar:
+            parts = [part for part in member.name.split("/") if part not in ("", ".")]
+            if not parts:
+                continue
+
+            file = "/".join(parts)
+            unsafe = (member.name.startswith("/") or ".." in parts
+                      or not (member.isfile() or member.isdir() or member.issym() or member.islnk())
+                      or update_ports.unsafe_member(file, member, links))
+
+            if member.islnk():
+                link = [part for part in member.linkname.split("/") if part not in ("", ".")]
+                unsafe = (unsafe or member.linkname.startswith("/") or ".." in link or not link
+                          or update_ports.unsafe_member("/".join(link), member, links))
+
+            if unsafe:
+                raise tarfile.TarError(_("Unsafe path in the package: {}").format(member.name))
+
+            if member.issym():
+                links.add(file)
+
+            yield member
+
+    def extract_stream(fileobj, target_dir, ports=None, prefix="ports"):
+        """
+        Function for unpacking the Port system package from the stream
+        (e.g. HTTP response) without saving the package.
+
+        Usage:
+        `update_ports.extract_stream(fileobj, target_dir, ports)`
+
+        * `fileobj` - file object with the `.txz` package;
+        * `target_dir` - where to unpack the files from `prefix` directory;
+        * `ports` - unpack only these ports (`None` - unpack all files).
+
+        Each block is decompressed and written once; the files hashes are
+        calculated at the same time. Returns the dict `{file: hash}` of the
+        unpacked files.
+        """
+
+        hashes = {}
+        links = set()
+
+        with timings.span("update", "stream") as span, tarfile.open(fileobj=fileobj, mode="r|xz") as tar:
+            for member in tar:
+                file = update_ports.member_path(member.name, prefix)
+                if not file:
+                    continue
+
+                if ports is not None and not any(file == port or file.startswith(port + "/") for port in ports):
+                    continue
+
+                if update_ports.unsafe_member(file, member, links):
+                    raise tarfile.TarError(_("Unsafe path in the package: {}").format(member.name))
+
+                path = target_dir + "/" + file
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+                if member.isdir():
+                    os.makedirs(path, exist_ok=True)
+                    os.chmod(path, (member.mode & 0o777) | 0o700)
+
+                elif member.issym():
+                    os.symlink(member.linkname, path)
+                    hashes[file] = "link:" + member.linkname
+                    links.add(file)
+
+                elif member.islnk():
+                    link = update_ports.member_path(member.linkname, prefix)
+                    if link not in hashes:
+                        continue
+
+                    os.link(target_dir + "/" + link, path, follow_symlinks=False)
+                    hashes[file] = hashes[link]
+
+                elif member.isfile():
+                    sha = hashlib.sha256()
+                    src = tar.extractfile(member)
+
+                    with open(path, "wb") as f:
+                        for block in iter(lambda: src.read(65536), b""):
+                            f.write(block)
+                            sha.update(block)
+
+                    os.chmod(path, member.mode & 0o777)
+                    os.utime(path, (member.mtime, member.mtime))
+                    hashes[file] = sha.hexdigest()
+
+                    span["bytes"] += member.size
+                    span["files"] += 1
+
+        return hashes
+
+    def incremental_ports(changes):
+        """
+        Function for getting the list of ports changed since the installed
+        Port system version
+
+        Returns `None` if only the whole Port system can be compared with
+        the new version.
+        """
+
+        if changes is None or changes["from"] is None or not os.path.isdir(PORTDIR):
+            return None
+
+        manifest = update_ports.load_manifest()
+        if manifest is None or manifest.get("update_number") != changes["from"]:
+            return None
+
+        return sorted(set(port.strip("/") for port in changes["ports"]))
+
+    def stream_install(branch, ports, changes):
+        """
+        Function for downloading and installing the Port system in one pass:
+        the package is unpacked while it's downloaded.
+
+        Usage:
+        `update_ports.stream_install(branch, ports, changes)`
+
+        If only the `ports` are changed, they are unpacked into the cache
+        and installed with `update_ports.apply_changes()`. Otherwise the
+        whole Port system is unpacked into the staging directory, which
+        replaces `PORTDIR`.
+
+        Returns `False` in case of error; then the package must be
+        downloaded and installed with `get_file()`, `unpack_file()` and
+        `install_file()`.
+        """
+
+        download_file = update_ports.get_url(branch)
+
+        with timings.span("update", "rmtree"):
+            if ports is not None:
+                target_dir = PORT
+                if os.path.isdir(PORT_CACHE_DIR):
+                    shutil.rmtree(PORT_CACHE_DIR)
+            else:
+                target_dir = PORTDIR + ".new"
+                if os.path.isdir(target_dir):
+                    shutil.rmtree(target_dir)
+
+        os.makedirs(target_dir)
+        log_msg("Streaming " + download_file + " to " + target_dir, "notice", phase="update")
+        print(_("Downloading and unpacking {}...").format(download_file))
+
+        # The installed Port system may be already unpacked from this package
+        manifest = update_ports.load_manifest() if os.path.isdir(PORTDIR) else None
+        headers = downloader.conditional_headers(download_file) if manifest else {}
+
+        release = None
+        try:
+            resp, release = downloader.request(download_file, headers)
+
+            if resp.status == 304:
+                resp.read()
+                release()
+                shutil.rmtree(target_dir)
+
+                print(_("The Port system package isn't changed"))
+                update_ports.save_manifest(manifest["files"])
+                return True
+
+            if resp.status != 200:
+                raise http.client.HTTPException("Unexpected HTTP status {}".format(resp.status))
+
+            hashes = update_ports.extract_stream(resp, target_dir, ports)
+            resp.read()
+            release()
+
+            validators = {
+                "etag": resp.getheader("ETag"),
+                "last_modified": resp.getheader("Last-Modified")
+            }
+
+        except (http.client.HTTPException, OSError, tarfile.TarError, EOFError, ValueError) as error:
+            # Недочитанный ответ - соединение нельзя вернуть в пул
+            if release is not None:
+                release(close=True)
+
+            log_msg("Streaming of " + download_file + " failed: " + str(error), "error", phase="update")
+            print(_("Error while downloading and unpacking the package: {}").format(error))
+            print(_("The package will be downloaded to the cache."))
+            shutil.rmtree(target_dir, ignore_errors=True)
+            return False
+
+        if ports is not None:
+            if not update_ports.apply_changes(PORT, PORTDIR, changes):
+                return False
+
+            downloader.remember(download_file, validators)
+            return True
+
+        with timings.span("update", "sync"):
+            os.sync() # Новые файлы должны оказаться на диске до переименования
+        update_ports.swap_dir(target_dir, PORTDIR)
+
+        print(_("Building the port index..."), end = " ")
+        ports_count = port_index.build()
+        update_ports.save_manifest(hashes)
+        downloader.remember(download_file, validators)
+        print(OK_MSG)
+        log_msg("Port index: {} ports".format(ports_count), "ok", phase="update")
+
+        return True
+
+    def unpack_file(file, extract_dir):
+        """
+        Function for unpacking files.
+
+        Usage:
+        
+        `update_ports.unpack_file(file, extract_dir)`
+        """
+
+        if os.path.isfile(file):
+            try:
+                with timings.span("update", "extract") as span:
+                    t = tarfile.open(file, 'r')
+                    t.extractall(path=extract_dir, members=update_ports.safe_members(t))
+
+                    for member in t.getmembers():
+                        if member.isfile():
+                            span["bytes"] += member.size
+                            span["files"] += 1
+
+            except tarfile.ReadError:
+                print(_("Package read error. Perhaps he is broken"))
+                sys.exit(1)
+
+            except tarfile.CompressionError:
+                print(_("Package unpacking error. The format is not supported"))
+                sys.exit(1)
+
+            except tarfile.TarError as error:
+                print(_("Package unpacking error: {}").format(error))
+                sys.exit(1)
+            
+            except:
+                print(_("Uknown error"))
+                sys.exit(1)
+        else:
+            print(_("Package searching error. He's not found. It may have not been downloaded, or a third-party program changed it's name during unpacking"))
+            sys.exit(1)
+    
+    def install_file(net_dir, target_dir):
+        """
+        Function for install Port system or CalmiraLinux documentation package.
+
+        Usage:
+
+        `update_ports.install_file(net_dir, target_dir)`
+
+        * `net_dir` - что копировать;
+        * `target_dir` - куда копировать.
+
+        The files are copied to the staging directory next to `target_dir`
+        (`target_dir.new`, on the same file system), which then replaces
+        `target_dir` with one rename. The previous version stays available
+        until this moment and is removed in the background. If copying
+        fails, the installed version isn't changed.
+
+        After installing the Port system the port index is rebuilt.
+        """
+
+        staging_dir = target_dir + ".new"
+
+        # Remains of the previous failed installation
+        if os.path.isdir(staging_dir):
+            with timings.span("update", "rmtree"):
+                shutil.rmtree(staging_dir)
+
+        # Copying
+        try:
+            print(_("Copying files..."))
+            with timings.span("update", "copytree") as span:
+                def copy(src, dst):
+                    shutil.copy2(src, dst)
+                    span["bytes"] += os.path.getsize(dst)
+                    span["files"] += 1
+
+                shutil.copytree(net_dir, staging_dir, symlinks=True, copy_function=copy)
+        except:
+            print(_("Uknown error of copy target files"))
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            sys.exit(1)
+
+        with timings.span("update", "sync"):
+            os.sync() # Новые файлы должны оказаться на диске до переименования
+
+        update_ports.swap_dir(staging_dir, target_dir)
+
+        if target_dir == PORTDIR:
+            print(_("Building the port index..."), end = " ")
+            ports_count = port_index.build()
+            update_ports.save_manifest(update_ports.hash_tree(target_dir))
+            print(OK_MSG)
+            log_msg("Port index: {} ports".format(ports_count), "ok", phase="update")
+
+    def exchange(src, dst):
+        """
+        Function for atomic exchange of two paths (Linux `renameat2()` with
+        `RENAME_EXCHANGE`).
+
+        Returns `False` if it isn't supported by the system or file system.
+        """
+
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            renameat2 = libc.renameat2
+        except (OSError, AttributeError):
+            return False
+
+        AT_FDCWD = -100
+        RENAME_EXCHANGE = 2
+
+        if renameat2(AT_FDCWD, os.fsencode(src), AT_FDCWD, os.fsencode(dst), RENAME_EXCHANGE) != 0:
+            return False
+
+        return True
+
+    def swap_dir(staging_dir, target_dir):
+        """
+        Function for replacing `target_dir` with `staging_dir`
+
+        Usage:
+        `update_ports.swap_dir(staging_dir, target_dir)`
+
+        The directories are exchanged atomically if it's supported,
+        otherwise with two renames. The previous version of `target_dir`
+        is removed in the background.
+        """
+
+        old_dir = target_dir + ".old." + str(os.getpid())
+
+        with timings.span("update", "swap"):
+            if not os.path.isdir(target_dir):
+                os.rename(staging_dir, target_dir)
+            elif update_ports.exchange(staging_dir, target_dir):
+                os.rename(staging_dir, old_dir)
+            else:
+                os.rename(target_dir, old_dir)
+                os.rename(staging_dir, target_dir)
+
+        log_msg("Installed " + target_dir, "ok", phase="update")
+
+        # Removing previous versions in the background
+        parent = os.path.dirname(target_dir) or "."
+        prefix = os.path.basename(target_dir) + ".old."
+        old_dirs = [
+            parent + "/" + name for name in os.listdir(parent)
+            if name.startswith(prefix)
+        ]
+
+        if old_dirs:
+            subprocess.Popen(["rm", "-rf", "--"] + old_dirs,
+                             stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL, start_new_session=True)
+
+    def file_hash(file):
+        """
+        Function for getting SHA256 hash of the file (or of the link target
+        for symbolic links)
+        """
+
+        if os.path.islink(file):
+            return "link:" + os.readlink(file)
+
+        sha = hashlib.sha256()
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(65536), b""):
+                sha.update(block)
+
+        return sha.hexdigest()
+
+    def walk_files(directory):
+        """
+        Function for getting all files in the directory (relative paths)
+        """
+
+        for root, dirs, files in os.walk(directory):
+            # Символические ссылки на каталоги копируются как ссылки
+            for name in dirs + files:
+                path = root + "/" + name
+                if name in files or os.path.islink(path):
+                    yield os.path.relpath(path, directory)
+
+    def hash_tree(directory):
+        """
+        Function for getting hashes of all files in the directory
+
+        Returns the dict `{relative_path: hash}`.
+        """
+
+        with timings.span("update", "hash") as span:
+            hashes = {
+                file: update_ports.file_hash(directory + "/" + file)
+                for file in update_ports.walk_files(directory)
+            }
+            span["files"] = len(hashes)
+
+        return hashes
+
+    def save_manifest(files):
+        """
+        Function for saving hashes of the installed Port system files
+        (`PORT_MANIFEST`) with the update number of the installed metadata
+        """
+
+        manifest = {
+            "update_number": update_ports.get_update_number(METADATA),
+            "files": files
+        }
+
+        with timings.span("update", "manifest") as span:
+            with open(PORT_MANIFEST + ".tmp", "w") as f:
+                json.dump(manifest, f)
+            os.replace(PORT_MANIFEST + ".tmp", PORT_MANIFEST)
+
+            span["bytes"] = os.path.getsize(PORT_MANIFEST)
+            span["files"] = len(files)
+
+    def load_manifest():
+        """
+        Function for loading hashes of the installed Port system files
+
+        Returns `None` if the file doesn't exist or is broken.
+        """
+
+        try:
+            with open(PORT_MANIFEST) as f:
+                manifest = json.load(f)
+            manifest["files"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+        return manifest
+
+    def copy_file(src, dst):
+        """
+        Function for replacing one file of the installed Port system. The
+        file is copied to the temporary file and then renamed, so readers
+        never see a partially written file.
+        """
+
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = dst + ".port-utils-tmp"
+
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), tmp)
+        else:
+            shutil.copy2(src, tmp)
+
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        os.replace(tmp, dst)
+
+    def apply_changes(net_dir, target_dir, changes):
+        """
+        Function for installing only the changed files of the Port system.
+
+        Usage:
+        `update_ports.apply_changes(net_dir, target_dir, changes)`
+
+        * `net_dir` - unpacked new version of the Port system;
+        * `target_dir` - installed Port system;
+        * `changes` - the changes returned by `update_ports.update_meta()`.
+
+        Only directories of the ports from `changes` are compared with the
+        new version (by the file hashes from `PORT_MANIFEST`); the new and
+        changed files are written, the removed ones are deleted. If the
+        changes are unknown, the whole tree is compared, but still only the
+        changed files are written.
+
+        Returns `False` if the changes can't be applied (the Port system or
+        its file hashes aren't installed); `install_file()` must be used then.
+        """
+
+        manifest = update_ports.load_manifest()
+
+        if manifest is None or not os.path.isdir(target_dir) or not os.path.isdir(net_dir):
+            return False
+
+        files = manifest["files"]
+
+        if changes is not None and changes["from"] is not None and changes["from"] == manifest.get("update_number"):
+            ports = sorted(set(port.strip("/") for port in changes["ports"]))
+            print(_("Applying the changes of {} ports...").format(len(ports)))
+
+            new_files = {}
+            old_files = []
+
+            for port in ports:
+                if os.path.isdir(net_dir + "/" + port):
+                    for file in update_ports.walk_files(net_dir + "/" + port):
+                        new_files[port + "/" + file] = None
+
+                old_files += [file for file in files if file.startswith(port + "/")]
+        else:
+            # Неизвестно, какие порты изменены - сравниваем всё дерево
+            print(_("Comparing the whole Port system with the new version..."))
+            ports = None
+            new_files = dict.fromkeys(update_ports.walk_files(net_dir))
+            old_files = list(files)
+
+        written = 0
+        removed = 0
+
+        with timings.span("update", "apply") as span:
+            for file in new_files:
+                file_hash = update_ports.file_hash(net_dir + "/" + file)
+                target = target_dir + "/" + file
+
+                if files.get(file) == file_hash and os.path.lexists(target):
+                    continue
+
+                update_ports.copy_file(net_dir + "/" + file, target)
+                files[file] = file_hash
+                written += 1
+                span["bytes"] += os.lstat(target).st_size
+
+                # Запись в буфер лога дешёвая - можно логировать каждый файл
+                log_msg("Written " + file, "ok", phase="update")
+
+            for file in old_files:
+                if file in new_files:
+                    continue
+
+                target = target_dir + "/" + file
+                if os.path.lexists(target):
+                    os.remove(target)
+
+                del files[file]
+                removed += 1
+
+                log_msg("Removed " + file, "ok", phase="update")
+
+            # Удаление опустевших каталогов удалённых портов
+            for port in ports or []:
+                if not os.path.isdir(net_dir + "/" + port) and os.path.isdir(target_dir + "/" + port):
+                    shutil.rmtree(target_dir + "/" + port)
+
+            span["files"] = written + removed
+
+        update_ports.save_manifest(files)
+
+        print(_("Files written: {0}, removed: {1}").format(written, removed))
+        log_msg("Incremental update: {0} written, {1} removed".format(written, removed), "ok", phase="update")
+
+        if target_dir == PORTDIR:
+            if ports is None:
+                port_index.build()
+            else:
+                port_index.update(ports)
+
+        return True
+
+class port_functions():
+    """
+    Other functions for Port system
+    """
+    def clean_sys(mode):
+        """
+        Function for cleaning system
+
+        Work modes:
+        - `cache` - clean the cache;
+        - `log` - clean the log dir.
+        """
+
+        check_root()
+        
+        if mode == "cache":
+            # Очистка кеша
+            print(_("Checking for cache existence..."), end = " ")
+
+            if os.path.isdir(CACHE):
+                print(OK_MSG)
+                print(_("Removing {}...").format(CACHE))
+
+                try:
+                    shutil.rmtree(CACHE)
+                except:
+                    print(_("Error removing directory {}").format(CACHE))
+                    sys.exit(1)
+                
+                print(_("Make {}...").format(CACHE))
+                try:
+                    os.makedirs(CACHE)
+                except:
+                    print(_("Error making {}").format(CACHE))
+                    sys.exit(1)
+            else:
+                print(_("Fail: cache directory not found"))
+                sys.exit(1)
+
+        elif mode == "log":
+            # Очистка лога
+            print(_("Checking for log files existence..."))
+
+            # Записи, ещё не сброшенные в лог, не должны создать его заново
+            logger.flush()
+
+            log_files = []
+            for log in "main", "debug":
+                file = logger.path(log)
+                print(_("Checking file {}...").format(file), end = " ")
+                if os.path.isfile(file):
+                    print(OK_MSG)
+                    log_files.append(file)
+                else:
+                    print(FAIL_MSG)
+
+                # Сжатые старые логи
+                for index in range(1, logger.keep + 1):
+                    if os.path.isfile("{0}.{1}.gz".format(file, index)):
+                        log_files.append("{0}.{1}.gz".format(file, index))
+
+                if log in logger.files:
+                    logger.files.pop(log)[1].close()
+
+            if not log_files:
+                sys.exit(1)
+
+            for file in log_files:
+                try:
+                    os.remove(file)
+                except:
+                    print(_("Error removing file {}").format(file))
+                    sys.exit(1)
+
+        elif mode == "src":
+            # Очистка директории /usr/src
+
+            src_dir = "/usr/src"
+            print(_("Checking for src directory existence..."), end = " ")
+            
+            if os.path.isdir(src_dir):
+                print(OK_MSG)
+            else:
+                print(FAIL_MSG)
+                file_non_exists = True
+            
+            if file_non_exists == True:
+                sys.exit(1)
+            
+            print(_("Removing {}...").format(src_dir))
+            try:
+                shutil.rmtree(src_dir)
+            except:
+                print(_("Error removing directory {}").format(src_dir))
+                sys.exit(1)
+            
+            print(_("Make {}...").format(src_dir))
+            try:
+                os.makedirs(src_dir)
+            except:
+                print(_("Error making {}").format(src_dir))
+                sys.exit(1)
+
+class port_lock(object):
+    """
+    Lock of the Port system and the ports database (`database_lock_file`).
+
+    The read-only commands (`--info`, `--list`, ...) take the shared lock,
+    so they can work at the same time; the commands which change the
+    system (`--install`, `--remove`, `--update`) take the exclusive lock.
+    The lock is a `fcntl` lock of the file, so it's released by the kernel
+    when the process exits (the lock file itself may remain). The
+    commands which ask the user take the shared lock while waiting for
+    the answer and replace it with the exclusive lock after it.
+
+    Usage:
+    `port_lock.acquire(exclusive, timeout)`
+    """
+
+    fd        = None
+    exclusive = False
+    timeout   = None    # Время ожидания (`--wait`); по умолчанию - `lock_timeout`
+
+    def acquire(exclusive=False, timeout=None):
+        """
+        Function for taking the lock
+
+        Waits `timeout` seconds (`port_lock.timeout` or the `lock_timeout`
+        setting by default) if the lock is taken by another process. Returns `False` if the lock
+        isn't taken.
+        """
+
+        if port_lock.fd is not None and (port_lock.exclusive or not exclusive):
+            return True
+
+        if timeout is None:
+            timeout = port_lock.timeout
+        if timeout is None:
+            timeout = settings.get("lock_timeout")
+
+        if port_lock.fd is None:
+            try:
+                if exclusive:
+                    os.makedirs(os.path.dirname(database_lock_file), exist_ok=True)
+                    port_lock.fd = os.open(database_lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+                else:
+                    # Открытый на запись файл позволяет потом взять исключительную блокировку
+                    try:
+                        port_lock.fd = os.open(database_lock_file, os.O_RDWR)
+                    except PermissionError:
+                        port_lock.fd = os.open(database_lock_file, os.O_RDONLY)
+            except FileNotFoundError:
+                # Файл блокировки создаётся при первом изменении системы
+                return True
+            except OSError as error:
+                print(_("Error opening {0}: {1}").format(database_lock_file, error.strerror))
+                return False
+
+        # Пока исключительная блокировка не получена, разделяемая
+        # сохраняется; её получению мешают разделяемые блокировки других
+        # процессов. Исключительная блокировка требует файла, открытого на
+        # запись (иначе - EBADF).
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        deadline = time.monotonic() + timeout
+        waiting = False
+
+        while True:
+            try:
+                fcntl.lockf(port_lock.fd, operation | fcntl.LOCK_NB)
+                break
+            except OSError as error:
+                if error.errno not in (errno.EAGAIN, errno.EACCES):
+                    print(_("Error locking {0}: {1}").format(database_lock_file, error.strerror))
+                    return False
+
+                if time.monotonic() >= deadline:
+                    print(_("An instance of the program is already running. Complete it before accessing the database."))
+                    return False
+
+                if not waiting:
+                    print(_("Waiting for another instance of the program..."))
+                    waiting = True
+
+                time.sleep(0.1)
+
+        port_lock.exclusive = exclusive
+
+        if exclusive:
+            os.ftruncate(port_lock.fd, 0)
+            os.write(port_lock.fd, "{}\n".format(os.getpid()).encode())
+
+        return True
+
+    def downgrade():
+        """
+        Function for replacing the exclusive lock with the shared lock:
+        read-only commands can work then, other changing commands are
+        still waiting
+        """
+
+        if port_lock.fd is not None and port_lock.exclusive:
+            fcntl.lockf(port_lock.fd, fcntl.LOCK_SH)
+            port_lock.exclusive = False
+
+class ports_db(object):
+    """
+    Database of the installed ports (`DATABASE`).
+
+    The database uses the WAL journal, so the readers aren't blocked by
+    the writer. One connection is opened per process; the statements are
+    kept in `ports_db.sql` and passed with parameters, so they are
+    compiled once and then taken from the statement cache of the
+    connection.
+
+    The schema version is saved in `PRAGMA user_version`; the old
+    databases (without the version) are migrated automatically.
+
+    Usage:
+    ```
+    with ports_db.transaction():
+        ports_db.add(port, config)
+        ports_db.remove(name)
+    ```
+    """
+
+    version = 3
+
+    legacy_columns = ("name", "version", "maintainer", "description", "priority")
+
+    def migrate_legacy(conn):
+        """
+        Returns the migration from the `ports` table of `ports_manage`
+
+        The old versions of `ports_manage` created the table without some
+        columns (e.g. `description`, `priority`); they are `NULL` in the
+        new table.
+        """
+
+        columns = set(row[1] for row in conn.execute("PRAGMA table_info(ports)"))
+        if not columns:
+            columns = set(ports_db.legacy_columns)
+
+        select = ", ".join(column if column in columns else "NULL" for column in ports_db.legacy_columns)
+
+        return """
+        CREATE TABLE IF NOT EXISTS ports (
+            name TEXT, version TEXT, maintainer TEXT,
+            description TEXT, priority TEXT
+        );
+        CREATE TABLE ports_new (
+            name TEXT PRIMARY KEY, port TEXT, version TEXT, release TEXT,
+            maintainer TEXT, description TEXT, priority TEXT, installed REAL
+        );
+        INSERT OR REPLACE INTO ports_new (name, version, maintainer, description, priority)
+            SELECT {0} FROM ports
+            WHERE {1} IS NOT NULL;
+        DROP TABLE ports;
+        ALTER TABLE ports_new RENAME TO ports;
+        CREATE INDEX ports_port ON ports(port);
+        INSERT OR IGNORE INTO ports (name, version, maintainer, description, priority) VALUES
+            ('ports', 'lx4/v1.1', 'Linuxoid85', 'Ports system for CalmiraLinux', 'system'),
+            ('port-utils', 'v1.0a2', 'Linuxoid85', 'Port system software', 'system');
+        """.format(select, "name" if "name" in columns else "NULL")
+
+    # migrations[N] - переход от версии N к версии N + 1 (SQL или функция,
+    # которая возвращает SQL для базы данных)
+    migrations = [
+        migrate_legacy,
+        """
+        CREATE TABLE files (
+            path TEXT NOT NULL, port TEXT NOT NULL, size INTEGER,
+            mode INTEGER, sha256 TEXT, mtime REAL,
+            PRIMARY KEY (path, port)
+        );
+        CREATE INDEX files_port ON files(port);
+        """,
+        """
+        ALTER TABLE ports ADD COLUMN build_hash TEXT;
+        """,
+    ]
+
+    sql = {
+        "add": """INSERT OR REPLACE INTO ports
+                  (name, port, version, release, maintainer, description, priority, installed, build_hash)
+                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        "remove": "DELETE FROM ports WHERE name = ?",
+        "add_file": "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+        "remove_files": "DELETE FROM files WHERE port = ?",
+        "files": "SELECT path, port, size, mode, sha256, mtime FROM files WHERE port = ? ORDER BY path",
+        "all_files": "SELECT path, port, size, mode, sha256, mtime FROM files ORDER BY port, path",
+        "name": "SELECT name FROM ports WHERE name = ? OR port = ?",
+        "owner": """SELECT files.port, ports.port FROM files
+                    LEFT JOIN ports ON ports.name = files.port WHERE files.path = ?""",
+        "get": "SELECT * FROM ports WHERE name = ?",
+        "installed": "SELECT name FROM ports",
+        "installed_ports": "SELECT name, port FROM ports",
+        "build_hash": "SELECT build_hash FROM ports WHERE port = ?"
+    }
+
+    conn     = None
+    writable = False
+    depth    = 0                # Глубина вложенных транзакций
+
+    def connect(write=False):
+        """
+        Returns the connection to `DATABASE`
+
+        If `write` is `True`, the database is created (or migrated) if
+        it's needed; otherwise `None` is returned when there's no database.
+        """
+
+        if ports_db.conn is not None and (ports_db.writable or not write):
+            return ports_db.conn
+
+        if ports_db.conn is not None:
+            ports_db.conn.close()
+            ports_db.conn = None
+
+        if write:
+            os.makedirs(os.path.dirname(DATABASE), exist_ok=True)
+            conn = sqlite3.connect(DATABASE, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            ports_db.migrate(conn)
+        else:
+            if not os.path.isfile(DATABASE):
+                return None
+
+            try:
+                conn = sqlite3.connect("file:" + DATABASE + "?mode=ro", uri=True,
+                                       timeout=30, isolation_level=None)
+                conn.execute("PRAGMA user_version").fetchone()
+            except sqlite3.OperationalError:
+                # Без прав на запись в каталог базы данных WAL не открыть;
+                # после завершения записи база данных полностью в основном файле
+                conn = sqlite3.connect("file:" + DATABASE + "?immutable=1", uri=True,
+                                       isolation_level=None)
+
+        conn.row_factory = sqlite3.Row
+        ports_db.conn = conn
+        ports_db.writable = write
+
+        return conn
+
+    def migrate(conn):
+        """
+        Function for updating the database schema to `ports_db.version`
+        """
+
+        current = conn.execute("PRAGMA user_version").fetchone()[0]
+
+        for number in range(current, ports_db.version):
+            print_dbg("Migrating {0} to the schema version {1}".format(DATABASE, number + 1))
+
+            migration = ports_db.migrations[number]
+            if callable(migration):
+                migration = migration(conn)
+
+            conn.executescript("BEGIN IMMEDIATE;" + migration
+                               + "PRAGMA user_version = {};COMMIT;".format(number + 1))
+
+    @contextlib.contextmanager
+    def transaction():
+        """
+        Write transaction; nested transactions are joined to the outer one
+
+        Usage:
+        `with ports_db.transaction() as conn: ...`
+        """
+
+        conn = ports_db.connect(write=True)
+
+        if ports_db.depth:
+            ports_db.depth += 1
+            try:
+                yield conn
+            finally:
+                ports_db.depth -= 1
+            return
+
+        conn.execute("BEGIN IMMEDIATE")
+        ports_db.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            ports_db.depth = 0
+
+    def add(port, config, files=(), build_hash=None):
+        """
+        Function for adding the port (its `config.json` data), its
+        installed files (`(path, size, mode, sha256, mtime)`) and its
+        build hash (see `build_ports.build_hash()`) to the database
+        """
+
+        with ports_db.transaction() as conn:
+            conn.execute(ports_db.sql["add"], (
+                config["name"], port.strip("/"), config.get("version"), config.get("release"),
+                config.get("maintainer"), config.get("description"), config.get("priority"),
+                time.time(), build_hash
+            ))
+            conn.execute(ports_db.sql["remove_files"], (config["name"],))
+            conn.executemany(ports_db.sql["add_file"], (
+                (path, config["name"], size, mode, sha256, mtime)
+                for path, size, mode, sha256, mtime in files
+            ))
+
+    def remove(name):
+        """
+        Function for removing the port (and its files list) from the database
+        """
+
+        with ports_db.transaction() as conn:
+            conn.execute(ports_db.sql["remove_files"], (name,))
+            return conn.execute(ports_db.sql["remove"], (name,)).rowcount
+
+    def name(port):
+        """
+        Returns the name of the installed port by its name or directory
+        (e.g. `base/editors/vim`)
+        """
+
+        conn = ports_db.connect()
+        if conn is None:
+            return None
+
+        row = conn.execute(ports_db.sql["name"], (port, port.strip("/"))).fetchone()
+        return row[0] if row else None
+
+    def files(name=None):
+        """
+        Returns the installed files of the port (or of all ports if `name`
+        is `None`)
+        """
+
+        conn = ports_db.connect()
+        if conn is None:
+            return []
+
+        if name is None:
+            return conn.execute(ports_db.sql["all_files"]).fetchall()
+
+        return conn.execute(ports_db.sql["files"], (name,)).fetchall()
+
+    def owner(path):
+        """
+        Returns `(name, port)` of the installed ports, which declare the
+        file (see `build_ports.installed_files()`)
+        """
+
+        conn = ports_db.connect()
+        if conn is None:
+            return []
+
+        return [tuple(row) for row in conn.execute(ports_db.sql["owner"], (path,))]
+
+    def installed_ports():
+        """
+        Returns `(names, ports)` - names and directories (e.g.
+        `base/editors/vim`) of the installed ports
+        """
+
+        try:
+            conn = ports_db.connect()
+            if conn is None:
+                return set(), set()
+
+            rows = conn.execute(ports_db.sql["installed_ports"]).fetchall()
+        except sqlite3.Error:
+            return set(), set()
+
+        return set(row[0] for row in rows), set(row[1] for row in rows if row[1])
+
+    def build_hash(port):
+        """
+        Returns the build hash saved when the port was installed (or `None`)
+        """
+
+        conn = ports_db.connect()
+        if conn is None:
+            return None
+
+        row = conn.execute(ports_db.sql["build_hash"], (port.strip("/"),)).fetchone()
+        return row[0] if row else None
+
+    def get(name):
+        """
+        Returns the database record of the installed port (or `None`)
+        """
+
+        conn = ports_db.connect()
+        if conn is None:
+            return None
+
+        return conn.execute(ports_db.sql["get"], (name,)).fetchone()
+
+    def installed():
+        """
+        Returns names of the installed ports
+        """
+
+        try:
+            conn = ports_db.connect()
+            if conn is None:
+                return set()
+
+            return set(row[0] for row in conn.execute(ports_db.sql["installed"]))
+        except sqlite3.Error:
+            return set()
+
+class port_index(object):
+    """
+    Index of all ports in the Port system.
+
+    The index is a SQLite database (`PORT_INDEX`) with the base
+    information and dependencies of every port from `PORTDIR`. It is
+    rebuilt each time the Port system is installed, so reading the port
+    information doesn't require walking `PORTDIR` and parsing the
+    `config.json` files.
+
+    Usage:
+    `port_index.build()` - rebuild the index;
+    `port_index.get(port)` - get the port config;
+    `port_index.list()` - get list of ports;
+    `port_index.deps(port)` - get port dependencies;
+    `port_index.search(query)` - find ports by words of the name,
+    description and maintainer;
+    `port_index.suggest(query)` - correct the misspelled query;
+    `port_index.resolve(port)` - get the port by its short name;
+    `port_index.rdeps(port)` - get the installed ports which depend on
+    the port.
+    """
+
+    version = 4 # Версия схемы индекса (PRAGMA user_version)
+
+    deps_types = [
+        'required', 'runtime', 'optional',
+        'recommend', 'before', 'conflict'
+    ]
+
+    schema = """
+        CREATE TABLE ports (
+            port TEXT PRIMARY KEY, name TEXT, version TEXT, release TEXT,
+            priority TEXT, maintainer TEXT, description TEXT, config TEXT
+        );
+        CREATE TABLE deps (
+            port TEXT, type TEXT, dep TEXT
+        );
+        CREATE INDEX deps_port ON deps(port);
+        CREATE INDEX deps_dep ON deps(dep);
+        CREATE INDEX ports_name ON ports(name);
+    """
+
+    # Полнотекстовый поиск; если SQLite собран без FTS5, используется
+    # обратный индекс в таблице `words`
+    search_schema = """
+        CREATE VIRTUAL TABLE search USING fts5(
+            name, description, maintainer, prefix='2 3'
+        );
+    """
+
+    words_schema = """
+        CREATE TABLE words (word TEXT, port INTEGER);
+        CREATE INDEX words_word ON words(word);
+        CREATE INDEX words_port ON words(port);
+    """
+
+    # Словарь для исправления опечаток: триграммы всех слов и имён портов
+    vocab_schema = """
+        CREATE TABLE vocab (
+            trigram TEXT, word TEXT, PRIMARY KEY (trigram, word)
+        ) WITHOUT ROWID;
+    """
+
+    fuzzy_candidates = 50 # Число слов словаря, сравниваемых с опечаткой
+
+    def scan(port_dir):
+        """
+        Function for finding ports (directories with `config.json`)
+
+        Usage:
+        `port_index.scan(port_dir)`
+
+        Returns the generator of `(port, config)` pairs, where `port` is a
+        port name (e.g. `base/editors/vim`) and `config` is a parsed
+        `config.json` of this port.
+        """
+
+        for root, dirs, files in os.walk(port_dir):
+            if "config.json" not in files:
+                dirs.sort()
+                continue
+
+            dirs[:] = [] # Вложенных портов нет, дальше не спускаемся
+            port = os.path.relpath(root, port_dir)
+
+            try:
+                with open(root + "/config.json") as f:
+                    config = json.load(f)
+            except (OSError, ValueError):
+                log_msg("Port index: broken config of '" + port + "'", "error")
+                continue
+
+            yield port, config
+
+    def rows(port, config):
+        """
+        Function for getting the index rows of the port
+
+        Returns the `(port_row, deps_rows)` pair for the `ports` and
+        `deps` tables.
+        """
+
+        port_row = (
+            port, config.get("name"), config.get("version"),
+            config.get("release"), config.get("priority"),
+            config.get("maintainer"), config.get("description"),
+            json.dumps(config)
+        )
+
+        port_deps = config.get("deps") or {}
+        deps_rows = [
+            (port, dep_type, dep.strip("/"))
+            for dep_type in port_index.deps_types
+            for dep in port_deps.get(dep_type) or []
+        ]
+
+        return port_row, deps_rows
+
+    def build(port_dir=None, index_file=None):
+        """
+        Function for (re)building the port index
+
+        Usage:
+        `port_index.build(port_dir, index_file)`
+
+        - `port_dir` - Port system directory (default: `PORTDIR`);
+        - `index_file` - index file (default: `PORT_INDEX`).
+
+        The new index is written in the temporary file of this process,
+        which then atomically replaces the previous one, so the index can
+        be rebuilt by several processes at the same time (e.g. by
+        `port_index.check()` under the shared lock). Returns the number of
+        indexed ports.
+        """
+
+        port_dir = port_dir or PORTDIR
+        index_file = index_file or PORT_INDEX
+        index_tmp = "{0}.{1}.tmp".format(index_file, os.getpid())
+
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        if os.path.isfile(index_tmp):
+            os.remove(index_tmp)
+
+        ports = []
+        deps  = []
+
+        with timings.span("index", "scan") as span:
+            for port, config in port_index.scan(port_dir):
+                port_row, deps_rows = port_index.rows(port, config)
+                ports.append(port_row)
+                deps += deps_rows
+
+            span["files"] = len(ports)
+
+        with timings.span("index", "write") as span:
+            conn = sqlite3.connect(index_tmp)
+            replaced = False
+            try:
+                conn.executescript(port_index.schema)
+                conn.executescript(port_index.vocab_schema)
+                try:
+                    conn.executescript(port_index.search_schema)
+                except sqlite3.OperationalError:
+                    conn.executescript(port_index.words_schema)
+
+                with conn:
+                    conn.executemany("INSERT INTO ports VALUES (?,?,?,?,?,?,?,?)", ports)
+                    conn.executemany("INSERT INTO deps VALUES (?,?,?)", deps)
+                    port_index.add_words(conn)
+                conn.execute("PRAGMA user_version = {}".format(port_index.version))
+                conn.close()
+
+                os.replace(index_tmp, index_file)
+                replaced = True
+            finally:
+                conn.close()
+                if not replaced and os.path.isfile(index_tmp):
+                    os.remove(index_tmp)
+
+            span["bytes"] = os.path.getsize(index_file)
+
+        return len(ports)
+
+    def update(ports, port_dir=None, index_file=None):
+        """
+        Function for updating the index entries of the changed ports
+
+        Usage:
+        `port_index.update(ports)`
+
+        - `ports` - list of updated, added or removed ports.
+
+        If the index doesn't exist, it's built from scratch.
+        """
+
+        port_dir = port_dir or PORTDIR
+        index_file = index_file or PORT_INDEX
+
+        if port_index.get_version(index_file) != port_index.version:
+            return port_index.build(port_dir, index_file)
+
+        conn = sqlite3.connect(index_file)
+        try:
+            with conn:
+                for port in ports:
+                    port = port.strip("/")
+                    port_index.remove_words(conn, port)
+                    conn.execute("DELETE FROM ports WHERE port=?", (port,))
+                    conn.execute("DELETE FROM deps WHERE port=?", (port,))
+
+                    try:
+                        with open(port_dir + "/" + port + "/config.json") as f:
+                            config = json.load(f)
+                    except (OSError, ValueError):
+                        continue # Порт удалён
+
+                    port_row, deps_rows = port_index.rows(port, config)
+                    conn.execute("INSERT INTO ports VALUES (?,?,?,?,?,?,?,?)", port_row)
+                    conn.executemany("INSERT INTO deps VALUES (?,?,?)", deps_rows)
+                    port_index.add_words(conn, port)
+        finally:
+            conn.close()
+
+        return len(ports)
+
+    def get_version(index_file=None):
+        """
+        Returns the schema version of the index (`None` if there's no index)
+        """
+
+        conn = port_index.connect(index_file)
+        if conn is None:
+            return None
+
+        try:
+            return conn.execute("PRAGMA user_version").fetchone()[0]
+        except sqlite3.Error:
+            return None
+        finally:
+            conn.close()
+
+    def has_fts(conn):
+        """
+        Checks whether the index uses the FTS5 table for searching
+        """
+
+        return conn.execute("SELECT 1 FROM sqlite_master WHERE name='search'").fetchone() is not None
+
+    def tokens(*texts):
+        """
+        Returns the set of the lowercase words of the texts
+        """
+
+        return set(word for text in texts if text for word in re.findall(r"\w+", str(text).lower()))
+
+    def trigrams(word):
+        """
+        Returns the set of the trigrams of the word (with the word bounds)
+        """
+
+        word = " " + word + " "
+        return set(word[index:index + 3] for index in range(len(word) - 2))
+
+    def add_words(conn, port=None):
+        """
+        Function for adding the port (or all ports) to the search index
+        and to the vocabulary of the fuzzy search
+        """
+
+        where, params = ("WHERE port=?", (port,)) if port is not None else ("", ())
+        rows = conn.execute("SELECT rowid, name, description, maintainer FROM ports " + where, params).fetchall()
+
+        if port_index.has_fts(conn):
+            conn.execute("INSERT INTO search (rowid, name, description, maintainer) "
+                         "SELECT rowid, name, description, maintainer FROM ports " + where, params)
+        else:
+            conn.executemany("INSERT INTO words VALUES (?,?)", (
+                (word, row[0]) for row in rows for word in port_index.tokens(*row[1:])
+            ))
+
+        # Слова удалённых портов остаются в словаре - они только не дают результатов
+        words = set()
+        for row in rows:
+            words |= port_index.tokens(*row[1:])
+            if row[1]:
+                words.add(str(row[1]).lower())
+
+        conn.executemany("INSERT OR IGNORE INTO vocab VALUES (?,?)", (
+            (trigram, word) for word in words for trigram in port_index.trigrams(word)
+        ))
+
+    def remove_words(conn, port):
+        """
+        Function for removing the port from the search index
+        """
+
+        table = "search WHERE rowid" if port_index.has_fts(conn) else "words WHERE port"
+        conn.execute("DELETE FROM " + table + " IN (SELECT rowid FROM ports WHERE port=?)", (port,))
+
+    def check():
+        """
+        Function for checking that the index exists and has the current
+        schema; the index is rebuilt otherwise (if it's possible)
+        """
+
+        if port_index.get_version() == port_index.version:
+            return True
+
+        # Другой процесс может перестраивать индекс одновременно с этим:
+        # каждый пишет свой временный файл (см. `port_index.build()`)
+        if os.path.isdir(PORTDIR) and os.access(os.path.dirname(PORT_INDEX), os.W_OK):
+            print_dbg("Rebuilding the port index {}".format(PORT_INDEX))
+            port_index.build()
+            return True
+
+        return False
+
+    def connect(index_file=None):
+        """
+        Function for opening the port index in read-only mode
+
+        Usage:
+        `port_index.connect(index_file)`
+
+        Returns `None` if the index doesn't exist.
+        """
+
+        index_file = index_file or PORT_INDEX
+
+        if not os.path.isfile(index_file):
+            return None
+
+        try:
+            return sqlite3.connect("file:" + index_file + "?mode=ro", uri=True)
+        except sqlite3.Error:
+            return None
+
+    def get(port):
+        """
+        Function for getting the port config from the index
+
+        Usage:
+        `port_index.get(port)`
+
+        - `port` - port name (e.g. `base/editors/vim`).
+
+        Returns `None` if the index or port isn't found.
+        """
+
+        conn = port_index.connect()
+        if conn is None:
+            return None
+
+        try:
+            row = conn.execute("SELECT config FROM ports WHERE port=?",
+                               (port.strip("/"),)).fetchone()
+        except sqlite3.Error:
+            row = None
+        finally:
+            conn.close()
+
+        if row is None:
+            return None
+
+        return json.loads(row[0])
+
+    def list():
+        """
+        Function for getting list of ports from the index
+
+        Usage:
+        `port_index.list()`
+
+        Returns the list of `(port, version, priority)` or `None` if the
+        index doesn't exist.
+        """
+
+        conn = port_index.connect()
+        if conn is None:
+            return None
+
+        try:
+            return conn.execute("SELECT port, version, priority FROM ports ORDER BY port").fetchall()
+        finally:
+            conn.close()
+
+    def deps(port):
+        """
+        Function for getting the port dependencies from the index
+
+        Usage:
+        `port_index.deps(port)`
+
+        Returns the dict with the dependencies types (`required`,
+        `runtime`, etc.) as keys or `None` if the index doesn't exist.
+        """
+
+        conn = port_index.connect()
+        if conn is None:
+            return None
+
+        port_deps = {dep_type: [] for dep_type in port_index.deps_types}
+
+        try:
+            for dep_type, dep in conn.execute("SELECT type, dep FROM deps WHERE port=? ORDER BY rowid",
+                                              (port.strip("/"),)):
+                port_deps[dep_type].append(dep)
+        finally:
+            conn.close()
+
+        return port_deps
+
+    def search(query, limit=None):
+        """
+        Function for searching ports by the words of their names,
+        descriptions and maintainers
+
+        Usage:
+        `port_index.search(query, limit)`
+
+        Every word of the query is a prefix of the word of the port (`vi`
+        finds `vim`); all words must be found. Returns the list of
+        `(port, version, description)` or `None` if the index doesn't exist.
+        """
+
+        conn = port_index.connect()
+        if conn is None:
+            return None
+
+        words = sorted(port_index.tokens(query))
+        if not words:
+            return []
+
+        try:
+            if port_index.has_fts(conn):
+                match = " ".join('"' + word + '"*' for word in words)
+                rows = conn.execute("""
+                    SELECT ports.port, ports.version, ports.description FROM search
+                    JOIN ports ON ports.rowid = search.rowid
+                    WHERE search MATCH ? ORDER BY ports.name != ?, rank
+                """, (match, query)).fetchall()
+            else:
+                # Префикс слова - диапазон [word, word + '\uffff') в индексе words_word
+                found = None
+                for word in words:
+                    ids = set(row[0] for row in conn.execute(
+                        "SELECT port FROM words WHERE word >= ? AND word < ?", (word, word + "\uffff")))
+                    found = ids if found is None else found & ids
+
+                rows = conn.execute("""
+                    SELECT port, version, description FROM ports
+                    WHERE rowid IN ({}) ORDER BY name != ?, port
+                """.format(",".join(str(rowid) for rowid in found)), (query,)).fetchall()
+        finally:
+            conn.close()
+
+        return rows[:limit] if limit else rows
+
+    def similar_words(conn, word, count=3):
+        """
+        Returns the words of the vocabulary similar to the word
+
+        The candidates having the most common trigrams with the word are
+        selected by SQL, so the whole vocabulary isn't read; only they are
+        compared by `difflib`.
+        """
+
+        trigrams = sorted(port_index.trigrams(word))
+
+        candidates = [row[0] for row in conn.execute("""
+            SELECT word FROM vocab WHERE trigram IN ({})
+            GROUP BY word ORDER BY COUNT(*) DESC LIMIT ?
+        """.format(",".join("?" * len(trigrams))), trigrams + [port_index.fuzzy_candidates])]
+
+        return difflib.get_close_matches(word, candidates, n=count)
+
+    def suggest(query):
+        """
+        Function for correcting the misspelled search query
+
+        Usage:
+        `port_index.suggest(query)`
+
+        Every word of the query is replaced by the most similar word of
+        the port names, descriptions and maintainers. Returns the
+        corrected query or `None` if there are no corrections.
+        """
+
+        conn = port_index.connect()
+        if conn is None:
+            return None
+
+        try:
+            words = []
+            for word in re.findall(r"\w+", query.lower()):
+                similar = port_index.similar_words(conn, word, 1)
+                words.append(similar[0] if similar else word)
+        finally:
+            conn.close()
+
+        suggestion = " ".join(words)
+        return suggestion if suggestion != " ".join(re.findall(r"\w+", query.lower())) else None
+
+    def similar_names(name, count=3):
+        """
+        Returns the port names similar to the name
+        """
+
+        conn = port_index.connect()
+        if conn is None:
+            return []
+
+        try:
+            similar = port_index.similar_words(conn, name.lower(), count * 3)
+            names = set(row[0].lower() for row in conn.execute(
+                "SELECT DISTINCT name FROM ports WHERE lower(name) IN ({})".format(",".join("?" * len(similar))),
+                similar))
+        finally:
+            conn.close()
+
+        return [word for word in similar if word in names][:count]
+
+    def print_search(query):
+        """
+        Function for printing the search results
+
+        Usage:
+        `port_index.print_search(query)`
+
+        If nothing is found, the query is corrected (see
+        `port_index.suggest()`) and the ports found by it are printed.
+        """
+
+        if not port_index.check():
+            print(_("Port index {} not found. Update the Port system.").format(PORT_INDEX))
+            return 1
+
+        ports = port_index.search(query)
+
+        if not ports:
+            suggestion = port_index.suggest(query)
+            ports = port_index.search(suggestion) if suggestion else None
+            if not ports:
+                print(_("Nothing found"))
+                return 1
+
+            print(_("Nothing found. Results for '{}':").format(suggestion))
+
+        for port, version, description in ports:
+            print("{0} {1} - {2}".format(port, version, description))
+
+        return 0
+
+    def find_name(name):
+        """
+        Returns the list of `(port, version, description)` of ports with
+        the name
+        """
+
+        conn = port_index.connect()
+        if conn is None:
+            return []
+
+        try:
+            return conn.execute("SELECT port, version, description FROM ports WHERE name=? ORDER BY port",
+                                (name,)).fetchall()
+        finally:
+            conn.close()
+
+    def resolve(port):
+        """
+        Function for getting the port by its short name (e.g. `vim` ->
+        `base/editors/vim`)
+
+        Usage:
+        `port_index.resolve(port)`
+
+        Returns the port as is if it's a port directory or the name isn't
+        found. Exits if the name is ambiguous.
+        """
+
+        if "/" in port.strip("/") or os.path.isdir(PORTDIR + "/" + port.strip("/")):
+            return port
+
+        if not port_index.check():
+            return port
+
+        ports = port_index.find_name(port)
+
+        if len(ports) == 1:
+            print_dbg("Port '{0}' -> {1}".format(port, ports[0][0]))
+            return ports[0][0]
+
+        if len(ports) > 1:
+            print(_("Port name '{}' is ambiguous, specify one of:").format(port))
+            for found, version, description in ports:
+                print(" - {}".format(found))
+            sys.exit(1)
+
+        similar = port_index.similar_names(port)
+        if similar:
+            print(_("Port '{0}' not found. Did you mean: {1}?").format(port, ", ".join(similar)))
+            sys.exit(1)
+
+        return port
+
+    def rdeps(port, installed=None, dep_types=None):
+        """
+        Function for getting the installed ports which depend on the port
+        (directly or through other installed ports)
+
+        Usage:
+        `port_index.rdeps(port, installed, dep_types)`
+
+        - `installed` - `(names, ports)` of the installed ports (read from
+          `DATABASE` by default);
+        - `dep_types` - dependency types (`required` and `runtime` by default).
+
+        Returns the list of `(port, dep_type, via)`, where `via` is the
+        port, whose dependency is `port`, or `None` if the index doesn't exist.
+        """
+
+        conn = port_index.connect()
+        if conn is None:
+            return None
+
+        if installed is None:
+            installed = ports_db.installed_ports()
+        names, ports = installed
+
+        dep_types = list(dep_types or deps_resolver.install_deps)
+        found = []
+        seen = {port.strip("/")}
+        level = [port.strip("/")]
+
+        try:
+            # Обход в ширину: на каждом уровне - один запрос по индексу deps_dep
+            while level:
+                rows = conn.execute("""
+                    SELECT deps.port, deps.type, deps.dep FROM deps
+                    JOIN ports ON ports.port = deps.port
+                    WHERE deps.dep IN ({0}) AND deps.type IN ({1})
+                    AND (ports.port IN (SELECT value FROM json_each(?)) OR ports.name IN (SELECT value FROM json_each(?)))
+                    ORDER BY deps.port
+                """.format(",".join("?" * len(level)), ",".join("?" * len(dep_types))),
+                    level + dep_types + [json.dumps(sorted(ports)), json.dumps(sorted(names))]).fetchall()
+
+                level = []
+                for dependent, dep_type, dep in rows:
+                    if dependent in seen:
+                        continue
+
+                    seen.add(dependent)
+                    level.append(dependent)
+                    found.append((dependent, dep_type, dep))
+        finally:
+            conn.close()
+
+        return found
+
+    def print_rdeps(port):
+        """
+        Function for printing the installed ports which depend on the port
+
+        Usage:
+        `port_index.print_rdeps(port)`
+        """
+
+        if not port_index.check():
+            print(_("Port index {} not found. Update the Port system.").format(PORT_INDEX))
+            return 1
+
+        dependents = port_index.rdeps(port)
+
+        if not dependents:
+            print(_("There are no installed ports which depend on {}").format(port))
+            return 0
+
+        for dependent, dep_type, via in dependents:
+            print(_("{0} ({1} dependency of {2})").format(dependent, dep_type, via))
+
+        return 0
+
+    def print_list():
+        """
+        Function for print list of ports
+
+        Usage:
+        `port_index.print_list()`
+        """
+
+        ports = port_index.list()
+
+        if ports is None:
+            print(_("Port index {} not found. Update the Port system.").format(PORT_INDEX))
+            sys.exit(1)
+
+        for port, version, priority in ports:
+            print("{0} {1} ({2})".format(port, version, priority))
+
+class deps_resolver(object):
+    """
+    Dependency resolver.
+
+    Builds the dependency graph of the requested ports from the port index
+    and returns the build plan - all ports that must be installed,
+    ordered so that every port is built after its dependencies.
+
+    Usage:
+    `deps_resolver.plan(ports)`
+
+    Dependencies types:
+    - `required`, `runtime` - are installed with the port;
+    - `before` - the port must be installed before these ports (only
+      changes the order of ports in the plan);
+    - `conflict` - these ports must not be installed with the port;
+    - `optional`, `recommend` - aren't installed automatically.
+    """
+
+    install_deps = ("required", "runtime")
+
+    cache = {} # port -> dependencies (из индекса)
+
+    class error(Exception):
+        """Resolving error (cycle, conflict or not found port)"""
+
+    def get_deps(port, conn):
+        """
+        Function for getting the port dependencies (memoized)
+
+        Returns `None` if the port isn't in the index.
+        """
+
+        if port in deps_resolver.cache:
+            return deps_resolver.cache[port]
+
+        if conn.execute("SELECT 1 FROM ports WHERE port=?", (port,)).fetchone() is None:
+            deps = None
+        else:
+            deps = {dep_type: [] for dep_type in port_index.deps_types}
+            for dep_type, dep in conn.execute("SELECT type, dep FROM deps WHERE port=? ORDER BY rowid", (port,)):
+                deps[dep_type].append(dep.strip("/"))
+
+        deps_resolver.cache[port] = deps
+        return deps
+
+    def get_installed():
+        """
+        Function for getting names of the installed ports from `DATABASE`
+        """
+
+        return ports_db.installed()
+
+    def plan(ports, installed=None, with_deps=True):
+        """
+        Function for getting the build plan
+
+        Usage:
+        `deps_resolver.plan(ports, installed, with_deps)`
+
+        - `ports` - the requested ports (e.g. `['base/editors/vim']`);
+        - `installed` - names of the installed ports (default: from
+          `DATABASE`); installed dependencies aren't added to the plan
+          (the requested ports are always added);
+        - `with_deps` - if `False`, only `ports` are ordered.
+
+        The graph is walked once, so the time is linear in the number of
+        ports and dependencies in the closure.
+
+        Returns the ordered list of ports. Raises `deps_resolver.error`
+        if a dependency isn't found, there is a dependency cycle or the
+        ports conflict.
+        """
+
+        conn = port_index.connect()
+        if conn is None:
+            raise deps_resolver.error(_("Port index {} not found. Update the Port system.").format(PORT_INDEX))
+
+        if installed is None:
+            installed = deps_resolver.get_installed()
+
+        closure = []  # Порты в порядке обхода в глубину (зависимости первыми)
+        state = {}    # port -> "visiting" / "done"
+        roots = {root.strip("/") for root in ports}
+
+        try:
+            for root in ports:
+                root = root.strip("/")
+                if state.get(root) == "done":
+                    continue
+
+                if deps_resolver.get_deps(root, conn) is None:
+                    raise deps_resolver.error(_("Port '{0}' NOT found in {1}").format(root, PORTDIR))
+
+                # Обход в глубину без рекурсии
+                stack = [(root, iter(deps_resolver.children(root, conn, with_deps)))]
+                path = [root]
+                state[root] = "visiting"
+
+                while stack:
+                    port, children = stack[-1]
+
+                    for dep in children:
+                        deps = deps_resolver.get_deps(dep, conn)
+                        if deps is None:
+                            raise deps_resolver.error(_("Dependency '{0}' of port '{1}' NOT found in {2}").format(dep, port, PORTDIR))
+
+                        if state.get(dep) == "visiting":
+                            cycle = path[path.index(dep):] + [dep]
+                            raise deps_resolver.error(_("Dependency cycle: {}").format(" -> ".join(cycle)))
+
+                        if state.get(dep) == "done":
+                            continue
+
+                        # Запрошенный порт попадает в план, даже если он установлен
+                        if dep not in roots and deps_resolver.port_name(dep, conn) in installed:
+                            state[dep] = "done"
+                            continue
+
+                        state[dep] = "visiting"
+                        path.append(dep)
+                        stack.append((dep, iter(deps_resolver.children(dep, conn, with_deps))))
+                        break
+                    else:
+                        stack.pop()
+                        path.pop()
+                        state[port] = "done"
+                        closure.append(port)
+
+            deps_resolver.check_conflicts(closure, installed, conn)
+
+        finally:
+            conn.close()
+
+        return deps_resolver.order(closure)
+
+    def children(port, conn, with_deps=True):
+        """
+        Returns the dependencies of the port installed with it
+        """
+
+        if not with_deps:
+            return []
+
+        deps = deps_resolver.get_deps(port, conn)
+        return [dep for dep_type in deps_resolver.install_deps for dep in deps[dep_type]]
+
+    def port_name(port, conn):
+        """
+        Returns the port name from its config (as it's saved in `DATABASE`)
+        """
+
+        row = conn.execute("SELECT name FROM ports WHERE port=?", (port,)).fetchone()
+        return row[0] if row else None
+
+    def check_conflicts(closure, installed, conn):
+        """
+        Function for checking the conflicts between the ports of the plan
+        and the installed ports
+        """
+
+        planned = set(closure)
+
+        for port in closure:
+            for dep in deps_resolver.cache[port]["conflict"]:
+                name = deps_resolver.port_name(dep, conn) or os.path.basename(dep)
+
+                if dep in planned or name in installed:
+                    raise deps_resolver.error(_("Port '{0}' conflicts with '{1}'").format(port, dep))
+
+    def edges(ports):
+        """
+        Function for getting the order constraints between the ports
+
+        Returns the `(after, count)` pair: `after[port]` - ports which must
+        be built after `port`, `count[port]` - number of ports which must
+        be built before `port`.
+        """
+
+        after = {port: [] for port in ports}
+        count = {port: 0 for port in ports}
+
+        for port in ports:
+            deps = deps_resolver.cache[port]
+            prev_ports = set(dep for dep_type in deps_resolver.install_deps for dep in deps[dep_type])
+
+            for dep in prev_ports:
+                if dep in after and dep != port:
+                    after[dep].append(port)
+                    count[port] += 1
+
+            for dep in set(deps["before"]):
+                if dep in after and dep != port:
+                    after[port].append(dep)
+                    count[dep] += 1
+
+        return after, count
+
+    def order(closure):
+        """
+        Function for topological sorting of the ports
+
+        `closure` is already ordered by the dependencies; here the `before`
+        dependencies are taken into account too.
+        """
+
+        position = {port: index for index, port in enumerate(closure)}
+        after, count = deps_resolver.edges(closure)
+
+        ready = [position[port] for port in closure if count[port] == 0]
+        heapq.heapify(ready)
+        result = []
+
+        while ready:
+            port = closure[heapq.heappop(ready)]
+            result.append(port)
+
+            for next_port in after[port]:
+                count[next_port] -= 1
+                if count[next_port] == 0:
+                    heapq.heappush(ready, position[next_port])
+
+        if len(result) != len(closure):
+            cycle = [port for port in closure if count[port] > 0]
+            raise deps_resolver.error(_("Dependency cycle: {}").format(", ".join(cycle)))
+
+        return result
+
+class build_scheduler(object):
+    """
+    Parallel build scheduler.
+
+    Builds the ports of the build plan in `jobs` job slots: a port is
+    started as soon as all its dependencies (from the plan) are built, so
+    independent ports are built at the same time. If a port fails, the
+    ports depending on it aren't built.
+
+    The job slots are shared with `make` through the GNU make jobserver
+    (`MAKEFLAGS`), so the total number of jobs of all builds is limited by
+    `jobs`, too.
+
+    Usage:
+    `build_scheduler.run(plan, jobs, build, on_done)`
+    """
+
+    def max_jobs():
+        """
+        Returns the maximum number of job slots
+
+        The tokens are written to the jobserver pipe before the builds
+        start, so their number must be less than the pipe capacity.
+        """
+
+        return min(4 * (os.cpu_count() or 1), 1024)
+
+    def jobserver(jobs):
+        """
+        Function for creating the jobserver pipe with `jobs - 1` tokens
+        (one job slot is owned by the program itself)
+
+        Returns the `(read_fd, write_fd)` pair.
+        """
+
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b"+" * (jobs - 1))
+
+        return read_fd, write_fd
+
+    def run(plan, jobs, build, on_done=None):
+        """
+        Function for building the ports
+
+        Usage:
+        `build_scheduler.run(plan, jobs, build, on_done)`
+
+        - `plan` - the ordered ports (from `deps_resolver.plan()`);
+        - `jobs` - number of job slots;
+        - `build` - function `build(port, env, pass_fds)`, which builds the
+          port and returns its return code;
+        - `on_done` - function `on_done(port)`, which is called (in the main
+          thread) after the port is built successfully.
+
+        Returns the dict `{port: status}`, where status is `ok`, `fail` or
+        `skip` (a dependency failed).
+        """
+
+        jobs = max(1, int(jobs))
+        if jobs > build_scheduler.max_jobs():
+            print(_("{0} Too many jobs ({1}), {2} are used").format(WARN_WSG, jobs, build_scheduler.max_jobs()))
+            jobs = build_scheduler.max_jobs()
+
+        after, count = deps_resolver.edges(plan)
+        position = {port: index for index, port in enumerate(plan)}
+
+        read_fd, write_fd = build_scheduler.jobserver(jobs)
+        env = dict(os.environ)
+        env["MAKEFLAGS"] = (env.get("MAKEFLAGS", "") + " -j{0} --jobserver-auth={1},{2}".format(jobs, read_fd, write_fd)).strip()
+
+        slot_lock = threading.Lock()
+        implicit_slot = [True] # Свободен ли собственный слот программы
+
+        def worker(port):
+            # Каждая сборка занимает один слот: собственный слот программы
+            # или токен из jobserver
+            with slot_lock:
+                own_slot = implicit_slot[0]
+                implicit_slot[0] = False
+
+            if not own_slot:
+                os.read(read_fd, 1)
+
+            try:
+                return build(port, env, (read_fd, write_fd))
+            finally:
+                if own_slot:
+                    with slot_lock:
+                        implicit_slot[0] = True
+                else:
+                    os.write(write_fd, b"+")
+
+        status = {}
+        ready = [position[port] for port in plan if count[port] == 0]
+        heapq.heapify(ready)
+        running = {}
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+                while ready or running:
+                    while ready and len(running) < jobs:
+                        port = plan[heapq.heappop(ready)]
+                        running[pool.submit(worker, port)] = port
+
+                    done, pending = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                    for future in done:
+                        port = running.pop(future)
+
+                        try:
+                            returncode = future.result()
+                        except (OSError, subprocess.SubprocessError) as error:
+                            log_msg("Build failed: " + str(error), "error", phase="build", port=port)
+                            returncode = 1
+
+                        if returncode == 0:
+                            status[port] = "ok"
+                            if on_done is not None:
+                                on_done(port)
+
+                            for next_port in after[port]:
+                                count[next_port] -= 1
+                                if count[next_port] == 0 and next_port not in status:
+                                    heapq.heappush(ready, position[next_port])
+                        else:
+                            status[port] = "fail"
+                            build_scheduler.skip_dependents(port, after, status)
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+        return status
+
+    def skip_dependents(port, after, status):
+        """
+        Function for marking all ports depending on the failed port as
+        skipped
+        """
+
+        stack = list(after[port])
+
+        while stack:
+            next_port = stack.pop()
+            if next_port in status:
+                continue
+
+            status[next_port] = "skip"
+            stack += after[next_port]
+
+class distfiles(object):
+    """
+    Cache of the port sources (`DISTFILES`).
+
+    The sources are declared in the `sources` list of `config.json`:
+    ```
+    "sources": [
+        {"url": "https://ftp.gnu.org/gnu/nano/nano-5.9.tar.xz", "sha256": "..."}
+    ]
+    ```
+
+    A file is saved in `DISTFILES/<sha256>/<file name>` (or in
+    `DISTFILES/url-<URL hash>/<file name>` if the checksum isn't declared)
+    only after its checksum is checked, so the cached files aren't
+    checked again. The paths of the port sources are passed to the
+    `install` script in the `PORT_SOURCES` variable.
+    """
+
+    workers = 4     # Число одновременно скачиваемых файлов
+
+    locks      = {} # Файл -> блокировка (один файл скачивается один раз)
+    locks_lock = threading.Lock()
+
+    stop = threading.Event() # Установлено - скачивание прерывается
+
+    def sources(port):
+        """
+        Returns the list of `{"url": ..., "sha256": ...}` of the port
+        """
+
+        config = port_index.get(port)
+        if config is None:
+            try:
+                with open(build_ports.port_files(port)[1]) as f:
+                    config = json.load(f)
+            except (OSError, ValueError):
+                return []
+
+        return [{"url": source} if isinstance(source, str) else source
+                for source in config.get("sources") or []]
+
+    def path(source):
+        """
+        Returns the cache file of the source or `None` if the source has
+        a wrong file name or checksum (they must not point outside of
+        `DISTFILES`)
+        """
+
+        name = source.get("file") or os.path.basename(urllib.parse.urlsplit(source["url"]).path) or "source"
+        name = os.path.basename(str(name))
+
+        if name in ("", ".", ".."):
+            return None
+
+        if source.get("sha256"):
+            key = str(source["sha256"]).lower()
+            if not re.fullmatch("[0-9a-f]{64}", key):
+                return None
+        else:
+            key = "url-" + hashlib.sha256(source["url"].encode()).hexdigest()[:16]
+
+        return "{0}/{1}/{2}".format(DISTFILES, key, name)
+
+    def fetch(source, quiet=False):
+        """
+        Function for downloading the source to the cache (if it isn't
+        there)
+
+        Returns the cache file or `None` in case of error (or if
+        `distfiles.stop` is set).
+        """
+
+        file = distfiles.path(source)
+        if file is None:
+            print(_("{0} Wrong file name or checksum of the source: {1}").format(FAIL_MSG, source.get("url")))
+            log_msg("Wrong source {}".format(source), "error", phase="fetch")
+            return None
+
+        with distfiles.locks_lock:
+            lock = distfiles.locks.setdefault(file, threading.Lock())
+
+        with lock:
+            if os.path.isfile(file):
+                return file
+
+            if distfiles.stop.is_set():
+                return None
+
+            return distfiles.download(source, file, quiet)
+
+    def download(source, file, quiet=False):
+        """
+        Function for downloading the source and checking its checksum
+        """
+
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        tmp = file + ".download"
+
+        downloader.local.quiet = quiet
+        try:
+            if not quiet:
+                print(_("Downloading {}...").format(source["url"]))
+
+            with timings.span("fetch", "download") as span:
+                if not downloader.get(source["url"], tmp, stop=distfiles.stop):
+                    return None
+
+                span["bytes"] = os.path.getsize(tmp)
+                span["files"] = 1
+        finally:
+            downloader.local.quiet = False
+
+        if source.get("sha256"):
+            checksum = update_ports.file_hash(tmp)
+            if checksum != source["sha256"].lower():
+                os.remove(tmp)
+                print(_("{0} Checksum mismatch: {1}").format(FAIL_MSG, source["url"]))
+                log_msg("Checksum mismatch: {0} ({1} instead of {2})".format(source["url"], checksum, source["sha256"]),
+                        "error", phase="fetch")
+                return None
+
+        os.replace(tmp, file)
+        log_msg("Fetched " + source["url"], "ok", phase="fetch")
+
+        return file
+
+    def fetch_ports(ports, pool, quiet=False):
+        """
+        Function for starting the downloading of the sources of the ports
+        (in the order of `ports`) in the thread pool
+
+        Returns the dict `{port: [futures]}`.
+        """
+
+        return {
+            port: [pool.submit(distfiles.fetch, source, quiet) for source in distfiles.sources(port)]
+            for port in ports
+        }
+
+    def wait(futures):
+        """
+        Function for waiting for the sources of the port
+
+        Returns the list of files or `None` if some source isn't downloaded.
+        """
+
+        files = [future.result() for future in futures]
+        return None if None in files else files
+
+    def fetch_only(ports):
+        """
+        Function for downloading the sources of the ports (`--fetch-only`)
+
+        Returns `True` if all sources are downloaded.
+        """
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=distfiles.workers) as pool:
+            futures = distfiles.fetch_ports(ports, pool)
+
+            failed = [port for port in ports if distfiles.wait(futures[port]) is None]
+
+        count = sum(len(port_futures) for port_futures in futures.values())
+        print(_("Sources: {0}, ports with errors: {1}").format(count, len(failed)))
+
+        for port in failed:
+            print(_("{0} Sources of '{1}' aren't downloaded").format(FAIL_MSG, port))
+
+        return not failed
+
+class build_runner(object):
+    """
+    Runner of the port scripts (`install`, `remove`).
+
+    The script is started without a shell; its stdout and stderr are read
+    from one pipe and written to the log file (and to the terminal, if
+    it's needed). The last lines of the output are kept in memory for the
+    error report. When the script exits, the log is compressed.
+
+    Usage:
+    `returncode, log_file, tail = build_runner.run(script, log_file, env, pass_fds, quiet)`
+    """
+
+    tail_lines = 30     # Число последних строк вывода для отчёта об ошибке
+    chunk_size = 65536
+
+    run_id = None       # Идентификатор запуска программы (для имён логов)
+
+    def log_file(port, action="build"):
+        """
+        Returns the log file of the port script for this run of the program
+        (e.g. `BUILD_LOGDIR/base_editors_vim/20211115-120000-1234-build.log`)
+        """
+
+        if build_runner.run_id is None:
+            build_runner.run_id = "{0}-{1}".format(datetime.now().strftime("%Y%m%d-%H%M%S"), os.getpid())
+
+        return "{0}/{1}/{2}-{3}.log".format(BUILD_LOGDIR, port.strip("/").replace("/", "_"),
+                                             build_runner.run_id, action)
+
+    def run(script, log_file, env=None, pass_fds=(), quiet=False):
+        """
+        Function for running the script
+
+        The script without `#!` is run by `/bin/sh` (like the ports
+        scripts were run before).
+
+        Returns `(returncode, log_file, tail)`: the exit code of the script
+        (negative if it's killed by a signal), the compressed log file and
+        the last lines of the output.
+        """
+
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+
+        command = [script]
+        try:
+            with open(script, "rb") as f:
+                if f.read(2) != b"#!":
+                    command = ["/bin/sh", script]
+        except OSError:
+            pass # Ошибка будет выведена при запуске
+
+        tail = collections.deque(maxlen=build_runner.tail_lines)
+        rest = b""
+
+        with open(log_file, "wb") as log:
+            try:
+                process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                           stdin=subprocess.DEVNULL, env=env, pass_fds=pass_fds)
+            except OSError as error:
+                message = _("Error running {0}: {1}").format(script, error.strerror)
+                log.write((message + "\n").encode())
+                tail.append(message)
+                returncode = 127
+            else:
+                with process.stdout:
+                    for chunk in iter(lambda: process.stdout.read1(build_runner.chunk_size), b""):
+                        log.write(chunk)
+
+                        if not quiet:
+                            sys.stdout.buffer.write(chunk)
+                            sys.stdout.flush()
+
+                        lines = (rest + chunk).split(b"\n")
+                        rest = lines.pop()
+                        tail.extend(lines[-build_runner.tail_lines:])
+
+                returncode = build_runner.wait(process)
+
+        if rest:
+            tail.append(rest)
+
+        log_file = build_runner.compress(log_file)
+        tail = [line if isinstance(line, str) else line.decode(errors="replace") for line in tail]
+
+        return returncode, log_file, tail
+
+    def wait(process):
+        """
+        Function for waiting for the script; returns its exit code
+
+        The CPU time of the script is added to the timing spans of the
+        thread (see `timings.add_children_cpu()`).
+        """
+
+        try:
+            pid, status, usage = os.wait4(process.pid, 0)
+        except ChildProcessError:
+            return process.wait()
+
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        timings.add_children_cpu(usage)
+
+        return process.returncode
+
+    def compress(log_file):
+        """
+        Function for compressing the log file; returns the new file name
+        """
+
+        try:
+            with open(log_file, "rb") as src, gzip.open(log_file + ".gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(log_file)
+        except OSError:
+            return log_file
+
+        return log_file + ".gz"
+
+    def print_tail(tail):
+        """
+        Function for printing the last lines of the script output
+        """
+
+        for line in tail:
+            print("    | " + line)
+
+class binary_packages(object):
+    """
+    Cache of the binary packages of ports (`PACKAGE_CACHE`).
+
+    After the port is built, its declared files (see
+    `build_ports.installed_files()`) are packed into
+    `<name>-<version>-<release>-<arch>.tar.gz`; the next installation of
+    the same port version unpacks the package instead of building it.
+
+    The declared files may be only a part of the installed ones, so the
+    packages are created only for the ports with `"complete_files": true`
+    in `config.json` (the `bins`, `libs` and `dirs` lists contain all
+    files installed by the port). Other packages are marked as partial
+    and aren't installed.
+
+    Package contents:
+    - `port.json` - the port, its config, the installed files list and
+      the `partial` flag;
+    - `root/...` - the installed files.
+    """
+
+    def arch():
+        """
+        Returns the system architecture (`distroArch` from `CALM_RELEASE`)
+        """
+
+        try:
+            with open(CALM_RELEASE) as f:
+                return json.load(f)["distroArch"]
+        except (OSError, ValueError, KeyError):
+            return os.uname().machine
+
+    def package_file(config):
+        """
+        Returns the binary package file of the port version
+        """
+
+        name = "{0}-{1}-{2}-{3}.tar.gz".format(config.get("name"), config.get("version"),
+                                                config.get("release"), binary_packages.arch())
+
+        return PACKAGE_CACHE + "/" + name.replace("/", "_")
+
+    def create(port, config, files, build_hash=None):
+        """
+        Function for packing the installed files of the port
+
+        Usage:
+        `binary_packages.create(port, config, files, build_hash)`
+
+        - `files` - list of `(path, size, mode, sha256, mtime)`;
+        - `build_hash` - see `build_ports.build_hash()`.
+        """
+
+        package = binary_packages.package_file(config)
+        os.makedirs(PACKAGE_CACHE, exist_ok=True)
+
+        info = json.dumps({"port": port, "config": config, "files": files,
+                           "build_hash": build_hash,
+                           "partial": not config.get("complete_files", False)}).encode()
+        member = tarfile.TarInfo("port.json")
+        member.size = len(info)
+        member.mtime = int(time.time())
+
+        with tarfile.open(package + ".tmp", "w:gz", compresslevel=6) as tar:
+            tar.addfile(member, io.BytesIO(info))
+
+            for path, size, mode, sha256, mtime in files:
+                tar.add(path, "root" + path, recursive=False)
+
+        os.replace(package + ".tmp", package)
+        log_msg("Binary package " + package, "ok", phase="package", port=port)
+
+        return package
+
+    def metadata(package):
+        """
+        Returns `port.json` of the package (or `None` if it can't be read)
+        """
+
+        try:
+            with tarfile.open(package, "r:gz") as tar:
+                return json.load(tar.extractfile("port.json"))
+        except (OSError, tarfile.TarError, ValueError, KeyError, AttributeError):
+            return None
+
+    def usable(package, build_hash):
+        """
+        Returns `True` if the package can be installed instead of building
+        the port: it's complete and built from the same port files (see
+        `build_ports.build_hash()`)
+        """
+
+        info = binary_packages.metadata(package) if os.path.isfile(package) else None
+
+        return info is not None and not info.get("partial", True) and info.get("build_hash") == build_hash
+
+    def install(package, root="/"):
+        """
+        Function for unpacking the binary package to the system
+
+        Usage:
+        `binary_packages.install(package, root)`
+
+        - `root` - the directory where the package is unpacked.
+
+        The files are replaced atomically (a running program can be
+        replaced). The partial package isn't installed (`ValueError`).
+        Returns `(config, files)` of the package.
+        """
+
+        root = root.rstrip("/")
+        links = set()
+        extracted = set() # Распакованные файлы (цели жёстких ссылок)
+
+        with tarfile.open(package, "r:gz") as tar:
+            info = json.load(tar.extractfile("port.json"))
+
+            # Пакеты старого формата не содержат флага и считаются неполными
+            if info.get("partial", True):
+                raise ValueError(_("The binary package {} is partial").format(package))
+
+            for member in tar:
+                file = update_ports.member_path(member.name, "root")
+                if not file:
+                    continue
+
+                # Файлы не записываются через ссылки, созданные из пакета
+                if update_ports.unsafe_member(file, member, links, allow_absolute=True):
+                    raise tarfile.TarError(_("Unsafe path in the package: {}").format(member.name))
+
+                path = root + "/" + file
+                tmp = path + ".port-utils.tmp"
+
+                if member.isdir():
+                    os.makedirs(path, exist_ok=True)
+                    os.chmod(path, member.mode & 0o7777)
+                    continue
+
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+                if member.issym():
+                    os.symlink(member.linkname, tmp)
+                    links.add(file)
+                elif member.isfile():
+                    src = tar.extractfile(member)
+                    with open(tmp, "wb") as f:
+                        shutil.copyfileobj(src, f, 65536)
+                elif member.islnk():
+                    # Повторные inode (например, gzip и gunzip) упакованы как жёсткие ссылки
+                    target = update_ports.member_path(member.linkname, "root")
+                    if target not in extracted:
+                        raise tarfile.TarError(_("Unsafe path in the package: {}").format(member.name))
+
+                    os.link(root + "/" + target, tmp, follow_symlinks=False)
+                else:
+                    raise tarfile.TarError(_("Unsupported file type in the package: {}").format(member.name))
+
+                # chown сбрасывает биты setuid и setgid, поэтому права меняются после него
+                if os.getuid() == 0 and not member.islnk():
+                    os.lchown(tmp, member.uid, member.gid)
+
+                if member.isfile():
+                    os.chmod(tmp, member.mode & 0o7777)
+                    os.utime(tmp, (member.mtime, member.mtime))
+
+                os.replace(tmp, path)
+                extracted.add(file)
+
+        # Время изменения файлов - время распаковки (для `--verify`)
+        files = []
+        for path, size, mode, sha256, mtime in info["files"]:
+            try:
+                files.append((path, size, mode, sha256, os.lstat(root + path).st_mtime))
+            except OSError:
+                pass
+
+        return info["config"], files
+
+class info_ports(object):
+    def __init__(self, port, only_deps=False):
+        self.port    = port
+        ports = [port] if isinstance(port, str) else list(port)
+
+        failed = False
+        for index, info_port in enumerate(ports):
+            if len(ports) > 1:
+                print(("\n" if index else "") + _("Port: {}").format(info_port))
+
+            port_data = info_ports.get_config(info_port)
+
+            if port_data is None or info_ports.info_port(port_data, only_deps):
+                failed = True
 
-        Usage:
-        `port_files.lock_db()`
-        """
-        message = "port-utils database was locked\n"
+        if failed:
+            sys.exit(1)
 
-        if os.path.isfile(database_lock_file):
-            print(_("Error: the database already locked!"))
-            return 1
-        else:
-            try:
-                f = open(database_lock_file, 'w')
-                for index in message:
-                    f.write(index)
-                return 0
-            except:
-                return 1
-    
-    # Checking lock database
-    def check_lock_db(self):
+    def get_config(port):
         """
-        Function for checking lock database
+        Function for getting the port config
 
         Usage:
-        `port_files.check_lock_db()`
-        """
-        if os.path.isfile(database_lock_file):
-            print(_("An instance of the program is already running. Complete it before accessing the database."))
-            return 1
-        else:
-            return 0
+        `info_ports.get_config(port)`
 
-class info_ports(object):
-    def __init__(self, port, only_deps=False):
-        self.port    = port
+        The config is taken from the port index. If the port isn't indexed
+        (e.g. the index wasn't built yet), it's read from `config.json`.
+        Returns `None` (the error is printed) if the config can't be read.
+        """
 
-        port_name    = PORTDIR   + "/" + port
-        port_json    = port_name + "/config.json"
+        port_data = port_index.get(port)
+        if port_data is not None:
+            return port_data
 
-        build_ports.check_port(port_name, port_json)
+        port_json = PORTDIR + "/" + port + "/config.json"
 
-        info_ports.info_port(port_json, only_deps)
-    
-    def info_port(port_json, only_deps=False):
-        # Base information
         try:
             f = open(port_json)
         except FileNotFoundError:
             print(_("File {} not found").format(port_json))
-            sys.exit(1)
-        
+            return None
+
         try:
             port_data = json.load(f)
+        except ValueError:
+            print(_("Error reading {}").format(port_json))
+            return None
+        finally:
+            f.close()
 
+        return port_data
+
+    def info_port(port_data, only_deps=False):
+        # Base information
+        try:
             if only_deps == False:
                 print(_("Name: {}").format(port_data["name"]))
                 print(_("Version: {}").format(port_data["version"]))
                 print(_("Maintainer: {}").format(port_data["maintainer"]))
                 print(_("Priority: {}").format(port_data["priority"]))
                 print(_("Calmira release: {}").format(port_data["release"]))
-            
-            # FIXME: добавить проверку на наличие определённой
-            # категории зависимостей, т.к. в config.json могут
-            # отсутствовать некоторые поля, которые выводятся здесь.
+
+            deps = port_data.get("deps") or {}
+
             print(_("Depends:"))
-            print(_("Required: \n{}").format(port_data["deps"]["required"]))
-            print(_("\nRuntime: \n{}").format(port_data["deps"]["runtime"]))
-            print(_("\nOptional: \n{}").format(port_data["deps"]["optional"]))
-            print(_("\nRecommend: \n{}").format(port_data["deps"]["recommend"]))
-            print(_("\nBefore: \n{}").format(port_data["deps"]["before"]))
-            print(_("\nConflicts: \n{}").format(port_data["deps"]["conflict"]))
+            print(_("Required: \n{}").format(deps.get("required", [])))
+            print(_("\nRuntime: \n{}").format(deps.get("runtime", [])))
+            print(_("\nOptional: \n{}").format(deps.get("optional", [])))
+            print(_("\nRecommend: \n{}").format(deps.get("recommend", [])))
+            print(_("\nBefore: \n{}").format(deps.get("before", [])))
+            print(_("\nConflicts: \n{}").format(deps.get("conflict", [])))
 
             return_code = 0
 
         except:
             print(_("Uknown error"))
             return_code = 1
-        
-        finally:
-            f.close()
-            sys.exit(return_code)
+
+        return return_code
+
+    def print_owner(path):
+        """
+        Function for printing the installed ports, which declare the file
+
+        Usage:
+        `info_ports.print_owner(path)`
+        """
+
+        owners = ports_db.owner(os.path.abspath(path))
+
+        # Путь может указывать на файл через символическую ссылку
+        if not owners and os.path.realpath(path) != os.path.abspath(path):
+            owners = ports_db.owner(os.path.realpath(path))
+
+        if not owners:
+            print(_("{} isn't declared by any installed port").format(path))
+            return 1
+
+        for name, port in owners:
+            print(_("{0} is declared by {1} ({2})").format(path, name, port))
+
+        return 0
 
 class build_ports(object):
     """
@@ -827,55 +4564,196 @@ class build_ports(object):
     TODO: add an `__init__()` function for choose work
     mode and other works...
     """
-    def __init__(self, port):
+    def __init__(self, port, with_deps=True, jobs=1, binary=False, fetch_only=False):
         self.port = port
+        ports = [port] if isinstance(port, str) else list(port)
+
+        # Вычисление списка портов для сборки
+        port_index.check()
+
+        try:
+            with timings.span("build", "resolve") as span:
+                plan = deps_resolver.plan(ports, with_deps=with_deps)
+                span["files"] = len(plan)
+        except deps_resolver.error as error:
+            print(_("Error: {}").format(error))
+            sys.exit(1)
 
-        # Вычисление данных порта
-        port_path    = PORTDIR   + "/" + port
-        port_json    = port_path + "/config.json"
-        port_install = port_path + "/install"
-        port_remove  = port_path + "/remove"
-        
         # Вызов нужных функций
-        build_ports.check_port(port_path, port_json, port_install, port_remove)
+        for plan_port in plan:
+            build_ports.check_port(*build_ports.port_files(plan_port))
+
+        if fetch_only:
+            sys.exit(0 if distfiles.fetch_only(plan) else 1)
         
+        # Пока пользователь отвечает, другие экземпляры могут читать данные
         print(_("Checking database lock..."))
-        if port_files.check_lock_db():
+        if port_lock.acquire(exclusive=False):
             print(OK_MSG)
             
             # Print deps
-            print(_("These dependencies need to be satisfied (installed) before or after building the port {}:").format(port))
-            info_ports(port, only_deps=True)
+            for port in ports:
+                print(_("These dependencies need to be satisfied (installed) before or after building the port {}:").format(port))
+                info_ports(port, only_deps=True)
+
+            print(_("\nThese ports will be built and installed (in this order):"))
+            for plan_port in plan:
+                print(" - {}".format(plan_port))
+
             dialog_msg(return_code=1)
 
-            # Building and installing port package
-            build_ports.install_file(port_install)
-            build_ports.add_in_db(port, port_json)
+            if not port_lock.acquire(exclusive=True):
+                sys.exit(1)
+
+            # Building and installing port packages
+            results = {}
+            configs = {}
+            hashes = {}
+            not_fetched = []
+            use_packages = binary or settings.get("binary_packages")
+
+            def build(plan_port, env, pass_fds):
+                # Хеш вычисляется до сборки: сборка может менять каталог порта
+                hashes[plan_port] = build_ports.build_hash(plan_port)
+
+                with open(build_ports.port_files(plan_port)[1]) as f:
+                    package = binary_packages.package_file(json.load(f))
+
+                # Пакет той же версии, но собранный из других файлов порта, не подходит
+                if use_packages and binary_packages.usable(package, hashes[plan_port]):
+                    print(_("Installing {0} from the binary package {1}...").format(plan_port, package))
+
+                    try:
+                        with timings.span("build", "unpack", plan_port) as span:
+                            configs[plan_port] = binary_packages.install(package)
+                            span["bytes"] = os.path.getsize(package)
+                            span["files"] = len(configs[plan_port][1])
+                        return 0
+                    except (OSError, tarfile.TarError, ValueError, KeyError) as error:
+                        # Повреждённый пакет - собираем порт из исходников
+                        log_msg("Broken binary package " + package + ": " + str(error), "error",
+                                phase="package", port=plan_port)
+
+                # Исходники скачиваются заранее, пока собираются предыдущие порты
+                with timings.span("build", "fetch", plan_port):
+                    sources = distfiles.wait(fetches[plan_port])
+                if sources is None:
+                    not_fetched.append(plan_port)
+                    return 1
+
+                env = dict(env, DISTFILES=DISTFILES, PORT_SOURCES=" ".join(sources))
+
+                port_install = build_ports.port_files(plan_port)[2]
+                log_file = build_runner.log_file(plan_port)
+
+                if jobs > 1:
+                    print(_("Building {0} (log: {1})...").format(plan_port, log_file))
+
+                with timings.span("build", "build", plan_port):
+                    returncode, log_file, tail = build_ports.install_port(port_install, log_file, env, pass_fds, quiet=jobs > 1)
+                results[plan_port] = (returncode, log_file, tail)
+
+                if returncode == 0:
+                    # Список файлов вычисляется до транзакции, чтобы не держать
+                    # блокировку базы данных во время хеширования
+                    with timings.span("build", "files", plan_port) as span:
+                        configs[plan_port] = build_ports.port_config(plan_port)
+                        span["files"] = len(configs[plan_port][1])
+                        span["bytes"] = sum(size or 0 for path, size, mode, sha256, mtime in configs[plan_port][1])
+
+                    # Неполный список файлов - пакет бы не заменил сборку
+                    if use_packages and configs[plan_port][0].get("complete_files"):
+                        try:
+                            with timings.span("build", "package", plan_port) as span:
+                                package = binary_packages.create(plan_port, *configs[plan_port], build_hash=hashes[plan_port])
+                                span["bytes"] = os.path.getsize(package)
+                                span["files"] = len(configs[plan_port][1])
+                        except (OSError, tarfile.TarError) as error:
+                            print(_("{0} Error creating the binary package of '{1}': {2}").format(WARN_WSG, plan_port, error))
+
+                return returncode
+
+            def on_done(plan_port):
+                if jobs > 1:
+                    print(_("{0} Port '{1}' is installed").format(OK_MSG, plan_port))
+
+                built.append((plan_port, configs[plan_port], hashes.get(plan_port)))
+
+            # Во время сборки можно просматривать информацию о портах
+            port_lock.downgrade()
+
+            built = []
+            fetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=distfiles.workers)
+            try:
+                fetches = distfiles.fetch_ports(plan, fetch_pool, quiet=True)
+                status = build_scheduler.run(plan, jobs, build, on_done)
+            finally:
+                # Скачивание источников, которые уже не нужны, прерывается
+                distfiles.stop.set()
+                fetch_pool.shutdown(wait=True, cancel_futures=True)
+                distfiles.stop.clear()
+
+                # Все собранные порты добавляются в базу данных одной транзакцией
+                with timings.span("build", "db") as span, ports_db.transaction():
+                    for plan_port, (package, files), build_hash in built:
+                        build_ports.add_in_db(plan_port, package, files, build_hash)
+                        span["files"] += len(files)
+
+            failed = [plan_port for plan_port in plan if status.get(plan_port) == "fail"]
+            skipped = [plan_port for plan_port in plan if status.get(plan_port) == "skip"]
+
+            for plan_port in failed:
+                if plan_port in not_fetched:
+                    print(_("{0} Sources of '{1}' aren't downloaded").format(FAIL_MSG, plan_port))
+                    continue
+
+                returncode, log_file, tail = results.get(plan_port, (None, build_runner.log_file(plan_port), []))
+                print(_("{0} Error building port '{1}' (code: {2}, log: {3})").format(FAIL_MSG, plan_port, returncode, log_file))
+                log_msg("Build failed with code {0}, log: {1}".format(returncode, log_file), "fail",
+                        phase="build", port=plan_port)
+
+                # Для параллельной сборки вывод не показывался - выводим его конец
+                if jobs > 1:
+                    build_runner.print_tail(tail)
+            for plan_port in skipped:
+                print(_("{0} Port '{1}' isn't built: its dependencies failed").format(WARN_WSG, plan_port))
+
+            if len(plan) > 1:
+                print(_("Installed: {0}, failed: {1}, skipped: {2}").format(len(built), len(failed), len(skipped)))
+
+            if failed:
+                sys.exit(1)
         else:
             print(FAIL_MSG)
             sys.exit(1)
-        
+
+    def port_files(port):
+        """
+        Returns the port directory and paths to its `config.json`,
+        `install` and `remove` files
+        """
+
+        port_path = PORTDIR + "/" + port.strip("/")
+
+        return port_path, port_path + "/config.json", port_path + "/install", port_path + "/remove"
+
     # Checking for the existence of a port package
-    def check_port(self, port_name, json_file,
+    def check_port(port_name, json_file,
                    install_file, remove_file):
         """
         Function for checking for the existence of a port package
 
         Usage:
-        `build_ports.check_port(port)`
+        `build_ports.check_port(port_name, json_file, install_file, remove_file)`
 
-        `port` - the required port package
+        `port_name` - the required port package directory
         """
 
-        self.port_name = port_name
-        self.json_file = json_file
-        self.install_file = install_file
-        self.remove_file = remove_file
-
         # FIXME: переделать алгоритм проверки порта
 
         # Checking for file existence
         print(_("Port: {}").format(port_name))
+        NoFile = False
         
         for file in json_file, install_file:
             print(_("Checking {}...").format(file), end = " ")
@@ -897,77 +4775,235 @@ class build_ports(object):
 
 
     # Установка порта
-    def install_port(self, install_file):
-        self.install_file = install_file
+    def install_port(install_file, log_file=None, env=None, pass_fds=(), quiet=False):
+        """
+        Function for running the port install script
 
-        install_instruction = install_file + " 2>&1 |tee " + LOGDIR + "/port-utils-build.log"
-        build = subprocess.run(install_instruction, shell=True)
-        
-        return build.returncode
+        Usage:
+        `build_ports.install_port(install_file, log_file, env, pass_fds, quiet)`
+
+        The output is written to `log_file`; if `quiet` is `False`, it's
+        printed to stdout, too. Returns `(returncode, log_file, tail)` (see
+        `build_runner.run()`).
+        """
+
+        if log_file is None:
+            log_file = build_runner.log_file(os.path.relpath(os.path.dirname(install_file), PORTDIR))
+
+        return build_runner.run(install_file, log_file, env, pass_fds, quiet)
     
+    def port_config(port):
+        """
+        Returns the port config and the list of its installed files
+        """
+
+        with open(build_ports.port_files(port)[1], "r") as file:
+            package = json.load(file)
+
+        return package, build_ports.installed_files(package)
+
+    def installed_files(package):
+        """
+        Function for getting the files declared by the port (the `bins`,
+        `libs` and `dirs` lists of its config)
+
+        The `install` script isn't traced, so the files it installs
+        elsewhere aren't in the list.
+
+        Returns the list of `(path, size, mode, sha256, mtime)`.
+        """
+
+        paths = []
+
+        for name in package.get("bins") or []:
+            paths += build_ports.find_file(name, ("/bin", "/sbin", "/usr/bin", "/usr/sbin"))
+        for name in package.get("libs") or []:
+            paths += build_ports.find_file(name, ("/lib", "/lib64", "/usr/lib", "/usr/lib64"))
+
+        for directory in package.get("dirs") or []:
+            if not os.path.isdir(directory):
+                continue
+
+            paths.append(directory)
+            for root, dirs, files in os.walk(directory):
+                paths += [os.path.join(root, name) for name in dirs + files]
+
+        paths = sorted(set(paths))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+            return [record for record in pool.map(build_ports.file_record, paths) if record is not None]
+
+    def find_file(name, dirs):
+        """
+        Returns the installed file paths (the name may be an absolute
+        path or a file name in one of `dirs`)
+        """
+
+        if os.path.isabs(name):
+            return [name] if os.path.lexists(name) else []
+
+        return [directory + "/" + name for directory in dirs
+                if os.path.lexists(directory + "/" + name)]
+
+    def file_record(path):
+        """
+        Returns the manifest record `(path, size, mode, sha256, mtime)` of
+        the file (`sha256` is `None` for directories and special files)
+        """
+
+        try:
+            stat = os.lstat(path)
+            sha256 = update_ports.file_hash(path) if os.path.islink(path) or os.path.isfile(path) else None
+        except OSError:
+            return None
+
+        return path, stat.st_size, stat.st_mode, sha256, stat.st_mtime
+
+    def build_hash(port):
+        """
+        Function for getting the hash of everything the port build depends
+        on: the files of the port directory (`install`, `config.json`,
+        patches, ...) and the versions of its dependencies
+
+        Usage:
+        `build_ports.build_hash(port)`
+
+        Returns `None` if the port directory isn't found.
+        """
+
+        port = port.strip("/")
+        port_path = build_ports.port_files(port)[0]
+
+        if not os.path.isdir(port_path):
+            return None
+
+        sha = hashlib.sha256()
+
+        for file in sorted(update_ports.walk_files(port_path)):
+            sha.update("file {0} {1}\n".format(file, update_ports.file_hash(port_path + "/" + file)).encode())
+
+        port_deps = port_index.deps(port) or {}
+        for dep in sorted(set(dep for dep_type in deps_resolver.install_deps for dep in port_deps.get(dep_type, []))):
+            config = port_index.get(dep) or {}
+            sha.update("dep {0} {1} {2}\n".format(dep, config.get("version"), config.get("release")).encode())
+
+        return sha.hexdigest()
+
     # Добавление порта в базу данных
-    def add_in_db(self, port, json_file):
-        self.port = port
-        self.json_file = json_file
+    def add_in_db(port, package, files=(), build_hash=None):
+        print(_("Adding {} in database...").format(port))
 
-        if os.path.isfile(DATABASE):
-            print(_("Adding {} in database...").format(port))
-        else:
-            print(_("Error adding {} in database: database not found!").format(port))
+        try:
+            ports_db.add(port, package, files, build_hash)
+        except sqlite3.Error as error:
+            print(_("SQLite3 error: {}").format(error))
             return 1
-        
-        file    = open(json_file, "r")
-        package = json.load(file)
-        
-        package_data = [(package["name"], package["version"], package["maintainer"], package["description"], package["priority"])]
-        
-        conn   = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
-        cursor.execute("INSERT INTO ports VALUES (?,?,?,?,?);", package_data)
-        conn.commit()
 
 class remove_ports(object):
-    # Класс для удаления порта из системы.
+    # Класс для удаления порта (или нескольких портов) из системы.
     # TODO: добавить логирование
     def __init__(self, port):
         self.port = port
+        ports = [port] if isinstance(port, str) else list(port)
 
-        # Вычисление данных порта
-        port_path   = PORTDIR   + "/" + port
-        port_json   = port_path + "/config.json"
-        port_remove = port_path + "/remove"
-        
-        # Вызов нужных функций
-        if remove_ports.check_remove_port(port_path, port_json, port_remove):
-            pass
-        else:
-            sys.exit(1)
+        # Вычисление данных портов
+        names = {}
+        for remove_port in ports:
+            port_path   = PORTDIR   + "/" + remove_port
+            port_json   = port_path + "/config.json"
+            port_remove = port_path + "/remove"
 
-        f = open(port_remove)
-        portData = json.load(f)
+            # Вызов нужных функций
+            if not remove_ports.check_remove_port(port_path, port_json, port_remove):
+                sys.exit(1)
 
-        if portData["priority"] == "system":
-            print(_("This port package is systemic and cannot be removed"))
-            sys.exit(1)
+            with open(port_json) as f:
+                portData = json.load(f)
+
+            if portData["priority"] == "system":
+                print(_("This port package is systemic and cannot be removed"))
+                sys.exit(1)
+
+            names[remove_port] = portData["name"]
         
+        # Пока пользователь отвечает, другие экземпляры могут читать данные
         print(_("Checking database lock..."))
-        if port_files.check_lock_db():
+        if port_lock.acquire(exclusive=False):
             print(OK_MSG)
 
             # Print depends
-            print(_("These dependencies need to be satisfied (removed) before or after removing the installed port {}:").format(port))
-            info_ports(port, only_deps=True)
-            dialog_msg(return_code=1)
-            
-            # Removing port
-            remove_ports.remove_port(port_remove)
-            remove_ports.remove_from_db(port_path, port_json)
+            for remove_port in ports:
+                print(_("These dependencies need to be satisfied (removed) before or after removing the installed port {}:").format(remove_port))
+                info_ports(remove_port, only_deps=True)
+
+            # Установленные порты, которые сломаются после удаления (кроме
+            # удаляемых вместе с ними)
+            port_index.check()
+            installed_names, installed_ports = ports_db.installed_ports()
+            installed = (installed_names - set(names.values()),
+                         installed_ports - set(remove_port.strip("/") for remove_port in ports))
+
+            dependents = []
+            for remove_port in ports:
+                with timings.span("remove", "rdeps", remove_port):
+                    dependents += [(remove_port,) + dependent for dependent in port_index.rdeps(remove_port, installed) or []]
+
+            if dependents:
+                for remove_port in ports:
+                    port_dependents = [dependent for dependent in dependents if dependent[0] == remove_port]
+                    if not port_dependents:
+                        continue
+
+                    print(_("\n{0} These installed ports depend on {1} and may stop working:").format(WARN_WSG, remove_port))
+                    for removed, dependent, dep_type, via in port_dependents:
+                        print(_(" - {0} ({1} dependency of {2})").format(dependent, dep_type, via))
+
+                dialog_msg(_("Remove {} anyway? (y/n) ").format(", ".join(ports)), return_code=1)
+            else:
+                dialog_msg(return_code=1)
+
+            if not port_lock.acquire(exclusive=True):
+                sys.exit(1)
+
+            # Порты удаляются раньше своих зависимостей
+            try:
+                ports = list(reversed(deps_resolver.plan(ports, installed=set(), with_deps=False)))
+            except deps_resolver.error:
+                pass
+
+            # Removing ports
+            removed = []
+            failed = []
+            for remove_port in ports:
+                port_remove = PORTDIR + "/" + remove_port + "/remove"
+
+                with timings.span("remove", "remove", remove_port):
+                    returncode, log_file, tail = remove_ports.remove_port(port_remove)
+                if returncode != 0:
+                    print(_("{0} Error removing port '{1}' (code: {2}, log: {3})").format(FAIL_MSG, remove_port, returncode, log_file))
+                    log_msg("Remove failed with code {0}, log: {1}".format(returncode, log_file), "fail",
+                            phase="remove", port=remove_port)
+                    failed.append(remove_port)
+                    continue
+
+                removed.append(remove_port)
+
+            # Все удалённые порты удаляются из базы данных одной транзакцией
+            with timings.span("remove", "db"), ports_db.transaction():
+                for remove_port in removed:
+                    port_path = PORTDIR + "/" + remove_port
+                    remove_ports.remove_from_db(port_path, port_path + "/config.json")
+
+            if len(ports) > 1:
+                print(_("Removed: {0}, failed: {1}").format(len(removed), len(failed)))
+
+            if failed:
+                sys.exit(1)
         else:
             print(FAIL_MSG)
             sys.exit(1)
         
-    def check_remove_port(self, port_name, json_file, remove_file):
+    def check_remove_port(port_name, json_file, remove_file):
         """
         Function for checking for the existence of a port package
         
@@ -975,11 +5011,8 @@ class remove_ports(object):
         `remove_ports.check_remove_port(...)`
         """
 
-        self.port_name = port_name
-        self.json_file = json_file
-        self.remove_file = remove_file
-
         print(_("Port: {}").format(port_name))
+        NoFile = False
         
         for file in json_file, remove_file:
             print(_("Checking {}...").format(file), end = " ")
@@ -989,90 +5022,212 @@ class remove_ports(object):
                 print(FAIL_MSG)
                 NoFile = True
         
-        if NoFile:
-            sys.exit(1)
-        else:
-            return 0
+        return not NoFile
 
-    def remove_port(self, remove_file):
+    def remove_port(remove_file):
         """
         Function for remove port from system
         
         Usage:
         `remove_ports.remove_port(file)`
+
+        Returns `(returncode, log_file, tail)` (see `build_runner.run()`).
         """
 
-        self.remove_file = remove_file
-        
-        remove_instructions = remove_file + " 2>&1 |tee " + LOGDIR + "/port-utils-remove.log"
-        remove = subprocess.run(remove_instructions, shell = True)
-        
-        return remove.returncode
+        port = os.path.relpath(os.path.dirname(remove_file), PORTDIR)
+
+        return build_runner.run(remove_file, build_runner.log_file(port, "remove"))
         
-    def remove_from_db(self, port, json_file):
+    def remove_from_db(port, json_file):
         """
         Function for remove port package from database
         
         Usage:
-            remove_ports.remove_from_db(port)
+            remove_ports.remove_from_db(port, json_file)
             
-            'port' - port name (e.g. base/editors/emacs)
+            'port' - port directory (e.g. /usr/ports/base/editors/emacs)
         """
 
-        self.port = port
-        self.json_file = json_file
-        
-        if os.path.isfile(DATABASE):
-            print(_("Removing {} from database...").format(port))
-        else:
-            print(_("Error removing {} from database: database not found!").format(port))
+        with open(json_file, "r") as file:
+            package = json.load(file)
+
+        print(_("Removing {} from database...").format(port))
+
+        try:
+            if not ports_db.remove(package["name"]):
+                print(_("Error removing {} from database: port isn't installed!").format(port))
+                return 1
+        except sqlite3.Error as error:
+            print(_("SQLite3 error: {}").format(error))
             return 1
-        
-        file    = open(json_file, "r")
-        package = json.load(file)
-        
-        package_data = [(package["name"])]
-        
-        conn   = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
-        cursor.execute("DELETE FROM ports WHERE name=?", package_data)
-        conn.commit()
 
-class update_data(object):
+class verify_ports(object):
     """
-    Class for updating ports packages and other files
+    Class for checking the declared files of the installed ports (see
+    `build_ports.installed_files()`) against the sizes, permissions and
+    hashes saved in the database
+
+    Files are hashed only if their size or modification time differ from
+    the saved ones (or from the last verification, see `VERIFY_CACHE`);
+    with `full=True` all files are hashed.
     """
-    def update_port(self, port):
+
+    def __init__(self, port, full=False):
+        if port == "all":
+            files = ports_db.files()
+        else:
+            name = ports_db.name(port)
+            if name is None:
+                print(_("Port '{}' isn't installed").format(port))
+                sys.exit(1)
+
+            files = ports_db.files(name)
+
+        if not files:
+            print(_("There are no declared files to verify"))
+            sys.exit(1)
+
+        cache = verify_ports.load_cache()
+        workers = min(32, (os.cpu_count() or 1) * 4)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(lambda row: verify_ports.check_file(row, cache, full), files))
+
+        problems = {}
+        new_cache = {}
+        hashed = 0
+
+        for row, (status, stat_data, was_hashed) in zip(files, results):
+            hashed += was_hashed
+
+            if status is None:
+                if stat_data is not None:
+                    new_cache[row["path"]] = stat_data
+            else:
+                problems.setdefault(row["port"], []).append((row["path"], status))
+
+        for name in sorted(problems):
+            print(_("{0} Port '{1}':").format(FAIL_MSG, name))
+            for path, status in problems[name]:
+                print("    {0}: {1}".format(path, status))
+
+        print(_("Declared files checked: {0}, hashed: {1}, ports with problems: {2}").format(len(files), hashed, len(problems)))
+
+        # При проверке всех портов устаревшие записи кеша удаляются
+        if port != "all":
+            new_cache = dict(cache, **new_cache)
+
+        verify_ports.save_cache(new_cache)
+
+        sys.exit(1 if problems else 0)
+
+    def check_file(row, cache, full=False):
         """
-        Function for update port package
+        Function for checking the installed file
 
-        Usage:
-        `update_data.update_port(portname)`
+        Returns `(status, stat_data, hashed)`: `status` is `None` if the file
+        is OK, `stat_data` is the record for `VERIFY_CACHE`.
+        """
+
+        path = row["path"]
+
+        try:
+            stat = os.lstat(path)
+        except FileNotFoundError:
+            return _("missing"), None, False
+        except OSError as error:
+            return str(error), None, False
+
+        if row["mode"] is not None and stat.st_mode != row["mode"]:
+            return _("mode {0:o} (expected {1:o})").format(stat.st_mode, row["mode"]), None, False
+
+        if row["sha256"] is None:
+            return None, None, False
+
+        if not os.path.islink(path) and stat.st_size != row["size"]:
+            return _("size {0} (expected {1})").format(stat.st_size, row["size"]), None, False
+
+        stat_data = [stat.st_size, stat.st_mtime, row["sha256"]]
+
+        # Размер и время изменения те же - хешировать файл не нужно
+        if not full and (stat.st_mtime == row["mtime"] or cache.get(path) == stat_data):
+            return None, stat_data, False
+
+        try:
+            file_hash = update_ports.file_hash(path)
+        except OSError as error:
+            return str(error), None, True
+
+        if file_hash != row["sha256"]:
+            return _("checksum mismatch"), None, True
 
-        - `portname` e.g. base/editors/vim
+        return None, stat_data, True
+
+    def load_cache():
+        """
+        Function for loading `VERIFY_CACHE`
         """
 
-        self.port = port
-        port_path = PORTDIR   + "/" + port
-        port_json = port_path + "/config.json"
+        try:
+            with open(VERIFY_CACHE) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
 
-        print(_("Checking database lock..."))
-        if port_files.check_lock_db():
-            print(OK_MSG)
+    def save_cache(cache):
+        """
+        Function for saving `VERIFY_CACHE`
+        """
 
-            # Print deps
-            print(_("These dependencies need to be satisfied (updated) before or after update port {}:").format(port))
-            info_ports(port, only_deps=True)
-            dialog_msg(return_code=1)
+        try:
+            os.makedirs(os.path.dirname(VERIFY_CACHE), exist_ok=True)
+            with open(VERIFY_CACHE + ".tmp", "w") as f:
+                json.dump(cache, f)
+            os.replace(VERIFY_CACHE + ".tmp", VERIFY_CACHE)
+        except OSError:
+            pass # Кеш нужен только для ускорения проверки
+
+class update_data(object):
+    """
+    Class for updating ports packages and other files
+    """
+    def __init__(self, port, full=False, jobs=1, binary=False):
+        self.port = port
+
+        # Хеши зависят от версий зависимостей из индекса
+        port_index.check()
 
-            # Removing port
-            remove_ports.remove_from_db(port_path, port_json)
+        if port == "all":
+            ports = sorted(ports_db.installed_ports()[1])
         else:
-            print(FAIL_MSG)
-            sys.exit(0)
-        
-        build_ports(port) # Build the port package and add this into database
+            ports = [port.strip("/")]
+
+        changed = [port for port in ports if full or update_data.is_changed(port)]
+
+        print(_("Up to date: {0}, changed: {1}").format(len(ports) - len(changed), len(changed)))
+
+        if not changed:
+            return
+
+        build_ports(changed, jobs=jobs, binary=binary) # Build the port packages and update them in database
+
+    def is_changed(port):
+        """
+        Function for checking whether the port must be rebuilt: its files or
+        its dependencies versions are changed since it was installed
+
+        Usage:
+        `update_data.is_changed(port)`
+
+        - `port` e.g. base/editors/vim
+        """
+
+        build_hash = build_ports.build_hash(port)
+        if build_hash is None:
+            print(_("{0} Port '{1}' isn't found in {2}").format(WARN_WSG, port, PORTDIR))
+            return False
+
+        return build_hash != ports_db.build_hash(port)
 
 #################
 ##             ##
@@ -1080,34 +5235,124 @@ class update_data(object):
 ##             ##
 #################
 
-# Command line parsing
+def main(argv=None):
+    """
+    Main function of the program
+
+    Usage:
+    `main(argv)` (`sys.argv[1:]` by default)
+    """
+
+    global DATABASE
+
+    # Command line parsing
+    args = parse_args(argv)
+
+    timings.enabled = bool(args.timings)
+
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        if args.db:
+            DATABASE = os.path.abspath(args.db)
+
+        # Списки портов (`-` - из stdin, `@FILE` - из файла)
+        for arg in "install", "remove", "info":
+            if getattr(args, arg):
+                setattr(args, arg, read_ports(getattr(args, arg)))
+
+                if not getattr(args, arg):
+                    print(_("No ports are specified"))
+                    sys.exit(1)
+
+        # Блокировка системы портов
+        port_lock.timeout = args.wait
 
-if args.update:
-    # Update port system
-    update_ports(args.update)
+        if args.update or args.metadata or args.clean:
+            lock = port_lock.acquire(exclusive=True)
+        elif args.info or args.list or args.owner or args.verify or args.search or args.rdeps:
+            lock = port_lock.acquire(exclusive=False)
+        else:
+            lock = True
+
+        if not lock:
+            sys.exit(1)
+
+        # Короткие имена портов (`vim` -> `base/editors/vim`)
+        for arg in "install", "remove", "info":
+            if getattr(args, arg):
+                setattr(args, arg, list(dict.fromkeys(port_index.resolve(port) for port in getattr(args, arg))))
+
+        for arg in "rdeps", "upgrade":
+            if getattr(args, arg) and getattr(args, arg) != "all":
+                setattr(args, arg, port_index.resolve(getattr(args, arg)))
+
+        if args.update:
+            # Update port system
+            update_ports(args.update, full=args.full, stream=not args.no_stream)
+
+        elif args.install:
+            # Install port package
+            build_ports(args.install, with_deps=not args.no_deps,
+                        jobs=args.jobs or settings.get("jobs"), binary=args.binpkg,
+                        fetch_only=args.fetch_only)
+
+        elif args.upgrade:
+            # Rebuild the changed ports
+            update_data(args.upgrade, full=args.full,
+                        jobs=args.jobs or settings.get("jobs"), binary=args.binpkg)
 
-elif args.install:
-    # Install port package
-    build_ports(args.install)
+        elif args.remove:
+            # Remove port package
+            remove_ports(args.remove)
 
-elif args.remove:
-    # Remove port package
-    remove_ports(args.remove)
+        elif args.info:
+            # Info about port package
+            info_ports(args.info)
 
-elif args.info:
-    # Info about port package
-    info_ports(args.info)
+        elif args.list:
+            # List of ports
+            port_index.print_list()
 
-elif args.metadata:
-    # Get port system metadata
-    update_ports.update_meta(args.metadata)
+        elif args.search:
+            # Search ports
+            sys.exit(port_index.print_search(args.search))
 
-elif args.clean:
-    port_functions.clean_sys(args.clean)
+        elif args.rdeps:
+            # Reverse dependencies
+            sys.exit(port_index.print_rdeps(args.rdeps))
+
+        elif args.owner:
+            # Port owning the file
+            sys.exit(info_ports.print_owner(args.owner))
+
+        elif args.verify:
+            # Verify the installed files
+            verify_ports(args.verify, full=args.full)
+
+        elif args.metadata:
+            # Get port system metadata
+            update_ports.update_meta(args.metadata)
+
+        elif args.clean:
+            port_functions.clean_sys(args.clean)
+
+        elif args.about:
+            about_msg()
+
+        else:
+            print(_("Usage: port-utils -h"))
+            sys.exit(1)
+    finally:
+        if args.profile:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
 
-elif args.about:
-    about_msg()
+        if args.timings:
+            timings.report(args.timings)
 
-else:
-    print(_("Usage: port-utils -h"))
-    sys.exit(1)
+if __name__ == "__main__":
+    main()
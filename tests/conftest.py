@@ -0,0 +1,84 @@
+#
+# conftest.py - common fixtures of the port-utils tests
+# Copyright (C) 2021 Michail Krasnov
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+
+import os
+import json
+import importlib.util
+
+import pytest
+
+PORT_UTILS = os.path.dirname(os.path.abspath(__file__)) + "/../src/port-utils.py"
+
+def load():
+    """
+    Function for importing port-utils as the module
+    """
+
+    spec = importlib.util.spec_from_file_location("port_utils", PORT_UTILS)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+@pytest.fixture
+def pu(tmp_path):
+    """
+    port-utils with all files moved into the temporary directory
+    """
+
+    module = load()
+    work_dir = str(tmp_path)
+
+    module.LOGDIR           = work_dir + "/log"
+    module.LOGFILE          = module.LOGDIR + "/port-utils.log"
+    module.DBG_LOGFILE      = module.LOGDIR + "/port-utils-dbg.log"
+    module.user_log_dir     = module.LOGDIR
+    module.BUILD_LOGDIR     = module.LOGDIR + "/port-utils-build"
+    module.PORTDIR          = work_dir + "/usr/ports"
+    module.FILES_DIR        = work_dir + "/usr/share/ports"
+    module.PORT_INDEX       = module.FILES_DIR + "/index.db"
+    module.CACHE            = work_dir + "/var/cache/ports"
+    module.DOWNLOAD_CACHE   = module.CACHE + "/downloads.json"
+    module.PACKAGE_CACHE    = module.CACHE + "/packages"
+    module.CALM_RELEASE     = work_dir + "/etc/calm-release"
+    module.DATABASE         = work_dir + "/var/db/ports/ports.db"
+    module.SETTINGS         = work_dir + "/etc/port-utils.json"
+    module.database_lock_file = work_dir + "/var/lock/port-utils.lock"
+
+    for directory in module.LOGDIR, module.FILES_DIR, module.CACHE:
+        os.makedirs(directory, exist_ok=True)
+
+    return module
+
+def make_port(pu, port, required=()):
+    """
+    Function for creating the port in `PORTDIR`
+    """
+
+    port_dir = pu.PORTDIR + "/" + port
+    os.makedirs(port_dir, exist_ok=True)
+
+    config = {
+        "name": port.split("/")[-1],
+        "version": "1.0",
+        "description": "test port",
+        "maintainer": "test",
+        "priority": "user",
+        "release": "1.1",
+        "deps": {"required": list(required)},
+        "bins": [], "libs": [], "dirs": []
+    }
+
+    with open(port_dir + "/config.json", "w") as f:
+        json.dump(config, f)
+
+    with open(port_dir + "/install", "w") as f:
+        f.write("#!/bin/sh\nexit 0\n")
+    os.chmod(port_dir + "/install", 0o755)
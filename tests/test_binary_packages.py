@@ -0,0 +1,68 @@
+#
+# test_binary_packages.py - tests of the binary packages of ports
+# Copyright (C) 2021 Michail Krasnov
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+
+import os
+import stat
+import tarfile
+
+import pytest
+
+CONFIG = {"name": "pk", "version": "1", "release": "1.1", "complete_files": True}
+
+@pytest.fixture
+def files(tmp_path):
+    """
+    Installed files of the port: a setuid program, its hard link and a
+    symbolic link
+    """
+
+    bin_dir = tmp_path / "inst" / "bin"
+    bin_dir.mkdir(parents=True)
+
+    program = bin_dir / "tool"
+    program.write_bytes(b"#!/bin/sh\n")
+    os.chmod(program, 0o4755)
+    os.link(program, bin_dir / "tool2")
+    os.symlink("tool", bin_dir / "tool3")
+
+    return [str(bin_dir), str(program), str(bin_dir / "tool2"), str(bin_dir / "tool3")]
+
+def package(pu, files, config=CONFIG):
+    records = [pu.build_ports.file_record(path) for path in files]
+    return pu.binary_packages.create("t/pk", dict(config), records, build_hash="hash")
+
+def test_install(pu, files, tmp_path):
+    root = tmp_path / "root"
+    config, installed = pu.binary_packages.install(package(pu, files), str(root))
+
+    program = str(root) + files[1]
+    assert config["name"] == "pk"
+    assert len(installed) == len(files)
+
+    with open(program, "rb") as f:
+        assert f.read() == b"#!/bin/sh\n"
+    assert stat.S_IMODE(os.stat(program).st_mode) == 0o4755
+
+    # Жёсткая ссылка установлена как ссылка на тот же файл
+    assert os.path.samefile(program, str(root) + files[2])
+    assert os.readlink(str(root) + files[3]) == "tool"
+
+def test_hard_links_are_packed(pu, files):
+    with tarfile.open(package(pu, files)) as tar:
+        assert tar.getmember("root" + files[2]).islnk()
+
+def test_partial_package_is_refused(pu, files, tmp_path):
+    partial = package(pu, files, dict(CONFIG, complete_files=False))
+
+    with pytest.raises(ValueError):
+        pu.binary_packages.install(partial, str(tmp_path / "root"))
+
+    assert not os.path.exists(str(tmp_path / "root"))
+    assert not pu.binary_packages.usable(partial, "hash")
@@ -0,0 +1,46 @@
+#
+# test_deps_resolver.py - tests of the dependency resolver
+# Copyright (C) 2021 Michail Krasnov
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+
+import pytest
+
+from conftest import make_port
+
+@pytest.fixture
+def tree(pu):
+    """
+    `t/d` requires `t/a` and `t/b`, `t/b` requires `t/a`
+    """
+
+    make_port(pu, "t/a")
+    make_port(pu, "t/b", ["t/a"])
+    make_port(pu, "t/d", ["t/a", "t/b"])
+    pu.port_index.build()
+
+    return pu
+
+def test_plan_orders_dependencies(tree):
+    assert tree.deps_resolver.plan(["t/d"], installed=set()) == ["t/a", "t/b", "t/d"]
+
+def test_plan_skips_installed_dependencies(tree):
+    assert tree.deps_resolver.plan(["t/d"], installed={"a", "b"}) == ["t/d"]
+
+@pytest.mark.parametrize("ports", [["t/b", "t/a"], ["t/a", "t/b"], ["t/d", "t/a"]])
+def test_plan_keeps_installed_requested_ports(tree, ports):
+    # Запрошенный порт - установленная зависимость предыдущего
+    plan = tree.deps_resolver.plan(ports, installed={"a", "b"})
+    assert sorted(plan) == sorted(ports)
+
+def test_plan_requested_port_after_its_dependent(tree):
+    plan = tree.deps_resolver.plan(["t/b", "t/a"], installed={"a"})
+    assert plan.index("t/a") < plan.index("t/b")
+
+def test_plan_not_found(tree):
+    with pytest.raises(tree.deps_resolver.error):
+        tree.deps_resolver.plan(["t/none"], installed=set())
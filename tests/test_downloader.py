@@ -0,0 +1,193 @@
+#
+# test_downloader.py - tests of the HTTP downloader
+# Copyright (C) 2021 Michail Krasnov
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+
+import os
+import threading
+import http.server
+
+import pytest
+
+DATA = bytes(range(256)) * 64 # 16 KiB
+ETAG = '"test-etag"'
+
+class handler(http.server.BaseHTTPRequestHandler):
+    """
+    HTTP server of one file (`DATA`) with `Range` and `ETag` support
+
+    Server attributes:
+    - `ranges` - if `False`, the `Range` header is ignored;
+    - `drop` - number of the next responses which are interrupted after
+      the half of the body;
+    - `requests` - list of the request headers.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers, path=self.path))
+
+        # Подписанная ссылка, которая меняется при каждом запросе
+        if self.path == "/redirect":
+            self.server.signatures += 1
+            self.send_response(302)
+            self.send_header("Location", "/file?signature={}".format(self.server.signatures))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.send_header("ETag", ETAG)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        start, end = 0, len(DATA) - 1
+        content_range = self.headers.get("Range")
+
+        if content_range and self.server.ranges:
+            start, end = content_range.split("=")[1].split("-")
+            start, end = int(start), min(int(end or len(DATA) - 1), len(DATA) - 1)
+
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(start, end, len(DATA)))
+        else:
+            self.send_response(200)
+
+        body = DATA[start:end + 1]
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", ETAG)
+        self.end_headers()
+
+        if self.server.drop and len(body) > 1:
+            self.server.drop -= 1
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server():
+    srv = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    srv.daemon_threads = True
+    srv.ranges = True
+    srv.drop = 0
+    srv.requests = []
+    srv.signatures = 0
+
+    thread = threading.Thread(target=srv.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+
+    yield srv
+
+    srv.shutdown()
+    srv.server_close()
+
+@pytest.fixture
+def downloader(pu, server):
+    pu.downloader.segment_min = 1024 # Файл скачивается несколькими сегментами
+    return pu.downloader
+
+def url(server, path="/file"):
+    return "http://127.0.0.1:{0}{1}".format(server.server_port, path)
+
+def read(file):
+    with open(file, "rb") as f:
+        return f.read()
+
+def test_segmented_download(downloader, server, tmp_path):
+    file = str(tmp_path / "file")
+
+    assert downloader.get(url(server), file) == "downloaded"
+    assert read(file) == DATA
+
+    ranges = [request["Range"] for request in server.requests if request.get("Range") != "bytes=0-0"]
+    assert len(ranges) == downloader.threads
+    assert not os.path.exists(file + ".part")
+    assert not os.path.exists(file + ".part.json")
+
+def test_resume_after_dropped_connection(downloader, server, tmp_path, monkeypatch):
+    monkeypatch.setattr(downloader, "threads", 1)
+    file = str(tmp_path / "file")
+
+    # Первый ответ с телом обрывается на середине
+    server.drop = 1
+    assert downloader.get(url(server), file) == "downloaded"
+    assert read(file) == DATA
+
+    # Повторный запрос продолжает сегмент с места обрыва
+    ranges = [request.get("Range") for request in server.requests]
+    assert ranges[-1] == "bytes={0}-{1}".format(len(DATA) // 2, len(DATA) - 1)
+
+def test_resume_after_interrupted_download(downloader, server, tmp_path, monkeypatch):
+    monkeypatch.setattr(downloader, "threads", 1)
+    monkeypatch.setattr(downloader, "retries", 0)
+    file = str(tmp_path / "file")
+
+    server.drop = 1
+    assert downloader.get(url(server), file) is False
+    assert os.path.getsize(file + ".part0") == len(DATA) // 2
+
+    assert downloader.get(url(server), file) == "downloaded"
+    assert read(file) == DATA
+    assert server.requests[-1]["Range"] == "bytes={0}-{1}".format(len(DATA) // 2, len(DATA) - 1)
+
+def test_not_modified(downloader, server, tmp_path):
+    file = str(tmp_path / "file")
+
+    assert downloader.get(url(server), file, cache=True) == "downloaded"
+    assert downloader.get(url(server), file, cache=True) == "not_modified"
+    assert server.requests[-1]["If-None-Match"] == ETAG
+    assert read(file) == DATA
+
+def test_changed_file_is_downloaded_again(downloader, server, tmp_path):
+    file = str(tmp_path / "file")
+
+    assert downloader.get(url(server), file, cache=True) == "downloaded"
+    with open(file, "ab") as f:
+        f.write(b"changed")
+
+    assert downloader.get(url(server), file, cache=True) == "downloaded"
+    assert read(file) == DATA
+
+def test_server_without_range(downloader, server, tmp_path):
+    server.ranges = False
+    file = str(tmp_path / "file")
+
+    assert downloader.get(url(server), file) == "downloaded"
+    assert read(file) == DATA
+    assert len(server.requests) == 1
+
+def test_resume_after_signed_redirect(downloader, server, tmp_path, monkeypatch):
+    monkeypatch.setattr(downloader, "threads", 1)
+    monkeypatch.setattr(downloader, "retries", 0)
+    file = str(tmp_path / "file")
+
+    server.drop = 1
+    assert downloader.get(url(server, "/redirect"), file) is False
+
+    # Адрес после перенаправления изменился, но загрузка продолжается
+    assert downloader.get(url(server, "/redirect"), file) == "downloaded"
+    assert read(file) == DATA
+    assert server.requests[-1]["Range"] == "bytes={0}-{1}".format(len(DATA) // 2, len(DATA) - 1)
+
+def test_dropped_response_without_range(downloader, server, tmp_path):
+    server.ranges = False
+    server.drop = 1
+    file = str(tmp_path / "file")
+
+    # Оборванное соединение не возвращается в пул
+    assert downloader.get(url(server), file) == "downloaded"
+    assert read(file) == DATA
+    assert all(conn.sock is not None for conns in downloader.pool.values() for conn in conns)
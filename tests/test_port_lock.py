@@ -0,0 +1,72 @@
+#
+# test_port_lock.py - tests of the Port system lock
+# Copyright (C) 2021 Michail Krasnov
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+
+import os
+import sys
+import subprocess
+
+import pytest
+
+# Блокировки `fcntl` принадлежат процессу, поэтому другой экземпляр -
+# отдельный процесс
+HOLDER = """
+import fcntl, os, sys
+fd = os.open(sys.argv[1], os.O_RDWR | os.O_CREAT, 0o644)
+fcntl.lockf(fd, fcntl.LOCK_EX if sys.argv[2] == "exclusive" else fcntl.LOCK_SH)
+print("locked", flush=True)
+sys.stdin.read()
+"""
+
+@pytest.fixture
+def holder(pu):
+    processes = []
+
+    def start(mode):
+        os.makedirs(os.path.dirname(pu.database_lock_file), exist_ok=True)
+        process = subprocess.Popen([sys.executable, "-c", HOLDER, pu.database_lock_file, mode],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        assert process.stdout.readline() == "locked\n"
+        processes.append(process)
+
+    yield start
+
+    for process in processes:
+        process.stdin.close()
+        process.wait()
+
+def test_shared_locks(pu, holder):
+    holder("shared")
+    assert pu.port_lock.acquire(exclusive=False, timeout=0.2)
+
+def test_exclusive_lock_waits_for_readers(pu, holder):
+    holder("shared")
+    assert not pu.port_lock.acquire(exclusive=True, timeout=0.2)
+
+def test_shared_lock_waits_for_writer(pu, holder):
+    holder("exclusive")
+    assert not pu.port_lock.acquire(exclusive=False, timeout=0.2)
+
+def test_upgrade(pu):
+    os.makedirs(os.path.dirname(pu.database_lock_file))
+    open(pu.database_lock_file, "w").close()
+
+    # Разделяемая блокировка (на время вопроса пользователю), затем исключительная
+    assert pu.port_lock.acquire(exclusive=False, timeout=0.2)
+    assert pu.port_lock.acquire(exclusive=True, timeout=0.2)
+    assert pu.port_lock.exclusive
+
+    with open(pu.database_lock_file) as f:
+        assert f.read() == "{}\n".format(os.getpid())
+
+def test_downgrade(pu, holder):
+    assert pu.port_lock.acquire(exclusive=True, timeout=0.2)
+    pu.port_lock.downgrade()
+
+    holder("shared")
@@ -0,0 +1,55 @@
+#
+# test_ports_db.py - tests of the database of the installed ports
+# Copyright (C) 2021 Michail Krasnov
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+
+import os
+import sqlite3
+
+import pytest
+
+@pytest.fixture
+def legacy(pu):
+    """
+    Function for creating the database of `ports_manage` with the
+    `ports` table of the given columns
+    """
+
+    def create(columns, rows):
+        os.makedirs(os.path.dirname(pu.DATABASE), exist_ok=True)
+        conn = sqlite3.connect(pu.DATABASE)
+        conn.execute("CREATE TABLE ports ({})".format(", ".join(column + " TEXT" for column in columns)))
+        conn.executemany("INSERT INTO ports VALUES ({})".format(",".join("?" * len(columns))), rows)
+        conn.commit()
+        conn.close()
+
+    return create
+
+def test_new_database(pu):
+    conn = pu.ports_db.connect(write=True)
+
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == pu.ports_db.version
+    assert "ports" in pu.ports_db.installed_ports()[0]
+
+def test_legacy_database(pu, legacy):
+    legacy(["name", "version", "maintainer", "description", "priority"],
+           [("vim", "8.2", "m", "editor", "user")])
+
+    conn = pu.ports_db.connect(write=True)
+    row = conn.execute("SELECT * FROM ports WHERE name = 'vim'").fetchone()
+
+    assert (row["version"], row["description"], row["priority"]) == ("8.2", "editor", "user")
+
+def test_legacy_database_without_columns(pu, legacy):
+    legacy(["name", "version", "maintainer"], [("vim", "8.2", "m")])
+
+    conn = pu.ports_db.connect(write=True)
+    row = conn.execute("SELECT * FROM ports WHERE name = 'vim'").fetchone()
+
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == pu.ports_db.version
+    assert (row["version"], row["description"], row["priority"]) == ("8.2", None, None)
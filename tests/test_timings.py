@@ -0,0 +1,59 @@
+#
+# test_timings.py - tests of the timing spans
+# Copyright (C) 2021 Michail Krasnov
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+
+import threading
+
+import pytest
+
+BUSY = "#!/bin/sh\ni=0\nwhile [ $i -lt 300000 ]; do i=$((i + 1)); done\n"
+IDLE = "#!/bin/sh\nsleep 1\n"
+
+@pytest.fixture
+def enabled(pu):
+    pu.timings.enabled = True
+    pu.timings.spans = []
+    yield pu.timings
+    pu.timings.enabled = False
+
+def run(pu, tmp_path, port, script):
+    path = tmp_path / port
+    path.write_text(script)
+    path.chmod(0o755)
+
+    with pu.timings.span("build", "build", port):
+        returncode, log_file, tail = pu.build_runner.run(str(path), str(tmp_path / "logs" / (port + ".log")),
+                                                         quiet=True)
+    assert returncode == 0
+
+def test_children_cpu_per_port(pu, tmp_path, enabled):
+    # Порты собираются параллельно (`--jobs 2`): время процессора скрипта
+    # одного порта не должно попадать в спан другого
+    threads = [threading.Thread(target=run, args=(pu, tmp_path, port, script))
+               for port, script in (("busy", BUSY), ("idle", IDLE))]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    spans = {record["port"]: record for record in enabled.spans}
+
+    assert spans["busy"]["children_cpu"] > 0.1
+    assert spans["idle"]["children_cpu"] < 0.05
+
+def test_returncode(pu, tmp_path):
+    script = tmp_path / "fail"
+    script.write_text("#!/bin/sh\nexit 3\n")
+    script.chmod(0o755)
+
+    assert pu.build_runner.run(str(script), str(tmp_path / "fail.log"), quiet=True)[0] == 3
+
+    script.write_text("#!/bin/sh\nkill -TERM $$\n")
+    assert pu.build_runner.run(str(script), str(tmp_path / "fail.log"), quiet=True)[0] == -15
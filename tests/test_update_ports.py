@@ -0,0 +1,131 @@
+#
+# test_update_ports.py - tests of unpacking the Port system package
+# Copyright (C) 2021 Michail Krasnov
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+
+import io
+import os
+import tarfile
+
+import pytest
+
+def archive(path, members):
+    """
+    Function for creating the `.txz` archive from the list of
+    `(name, type, data)`: `type` is `dir`, `file`, `sym` or `lnk` (`data`
+    is the link target)
+    """
+
+    with tarfile.open(path, "w:xz") as tar:
+        for name, kind, data in members:
+            member = tarfile.TarInfo(name)
+
+            if kind == "dir":
+                member.type = tarfile.DIRTYPE
+                member.mode = 0o755
+            elif kind == "sym":
+                member.type = tarfile.SYMTYPE
+                member.linkname = data
+            elif kind == "lnk":
+                member.type = tarfile.LNKTYPE
+                member.linkname = data
+            else:
+                member.size = len(data)
+                tar.addfile(member, io.BytesIO(data))
+                continue
+
+            tar.addfile(member)
+
+    return path
+
+def extract_stream(pu, package, target_dir):
+    os.makedirs(target_dir)
+    with open(package, "rb") as f:
+        return pu.update_ports.extract_stream(f, target_dir)
+
+def unpack_file(pu, package, target_dir):
+    os.makedirs(target_dir)
+    pu.update_ports.unpack_file(package, target_dir)
+
+GOOD = [
+    ("ports", "dir", None),
+    ("ports/a", "dir", None),
+    ("ports/a/config.json", "file", b"{}"),
+    ("ports/a/link", "sym", "config.json"),
+    ("ports/b", "sym", "a"),
+    ("ports/a/hard", "lnk", "ports/a/config.json")
+]
+
+UNSAFE = {
+    "absolute": [("ports/evil", "sym", "/tmp")],
+    "parent": [("ports/evil", "sym", "../..")],
+    "write_through_link": [("ports/evil", "sym", "a"), ("ports/evil/x", "file", b"x")],
+    "chained": [("ports/d", "dir", None), ("ports/d/q", "sym", ".."), ("ports/p", "sym", "d/q/..")],
+    "chained_deep": [("ports/d", "dir", None), ("ports/d/q", "sym", "."), ("ports/p", "sym", "d/q/../../x")]
+}
+
+def test_extract_stream(pu, tmp_path):
+    package = archive(str(tmp_path / "ports.txz"), GOOD)
+    target = str(tmp_path / "out")
+    hashes = extract_stream(pu, package, target)
+
+    assert os.path.realpath(target + "/b/config.json") == os.path.realpath(target + "/a/config.json")
+    assert os.path.samefile(target + "/a/hard", target + "/a/config.json")
+    assert hashes["a/link"] == "link:config.json"
+
+def test_unpack_file(pu, tmp_path):
+    package = archive(str(tmp_path / "ports.txz"), GOOD)
+    target = str(tmp_path / "out")
+    unpack_file(pu, package, target)
+
+    assert os.path.samefile(target + "/ports/a/hard", target + "/ports/a/config.json")
+
+@pytest.mark.parametrize("case", sorted(UNSAFE))
+def test_extract_stream_unsafe(pu, tmp_path, case):
+    package = archive(str(tmp_path / "ports.txz"), [("ports", "dir", None), ("ports/a", "dir", None)] + UNSAFE[case])
+
+    with pytest.raises(tarfile.TarError):
+        extract_stream(pu, package, str(tmp_path / "out"))
+
+@pytest.mark.parametrize("case", sorted(UNSAFE))
+def test_unpack_file_unsafe(pu, tmp_path, case):
+    package = archive(str(tmp_path / "ports.txz"), [("ports", "dir", None), ("ports/a", "dir", None)] + UNSAFE[case])
+
+    with pytest.raises(SystemExit):
+        unpack_file(pu, package, str(tmp_path / "out"))
+
+def test_hard_link_through_symlink(pu, tmp_path):
+    package = archive(str(tmp_path / "ports.txz"), [
+        ("ports", "dir", None),
+        ("ports/a", "dir", None),
+        ("ports/a/f", "file", b"f"),
+        ("ports/s", "sym", "a"),
+        ("ports/h", "lnk", "ports/s/f")
+    ])
+
+    # Цель ссылки не распакована как файл - ссылка не создаётся
+    target = str(tmp_path / "out")
+    extract_stream(pu, package, target)
+    assert not os.path.lexists(target + "/h")
+
+    with pytest.raises(SystemExit):
+        unpack_file(pu, package, str(tmp_path / "out2"))
+
+    assert not os.path.lexists(str(tmp_path / "out2/ports/h"))
+
+def test_hard_link_to_symlink_isnt_followed(pu, tmp_path):
+    package = archive(str(tmp_path / "ports.txz"), [
+        ("ports", "dir", None),
+        ("ports/s", "sym", "missing"),
+        ("ports/h", "lnk", "ports/s")
+    ])
+
+    target = str(tmp_path / "out")
+    extract_stream(pu, package, target)
+
+    assert os.readlink(target + "/h") == "missing"